@@ -0,0 +1,112 @@
+from psycopg2.extras import execute_values
+
+from util import LRUCache
+
+
+class AuthorResolver(object):
+    """
+    Resolves authors to ids and links them to articles in batches. Known names and ORCIDs are cached, the remaining
+    ones are looked up with one query each per batch, new authors are inserted with a single multi-row
+    INSERT ... RETURNING and the author/article pairs with a single INSERT ... ON CONFLICT DO NOTHING.
+
+    The matching is the same as linking the authors one by one: an author matches on ORCID first, then on name,
+    otherwise a new author is created.
+    """
+
+    def __init__(self, db, unit_of_work, cache_size=1000000, batch_size=1000):
+        """
+        :param db: the psycopg2 connection to use
+        :param unit_of_work: callable returning the context manager to run the writes in
+        :param cache_size: the maximum number of names and of ORCIDs kept in memory
+        :param batch_size: the number of authorships collected before they are written
+        """
+        self.db = db
+        self.unit_of_work = unit_of_work
+        self.names = LRUCache(cache_size)
+        self.orcids = LRUCache(cache_size)
+        self.batch_size = batch_size
+        self.pending = []  # tuples of (name, orcid, position, article id)
+
+    def add(self, authors, article_id):
+        """
+        :param authors: an iterable containing tuples of (author name, orcid (may be None), position of the author)
+        :param article_id: The id of the article inserted in the publications table.
+        """
+        for name, orcid, pos in authors:
+            self.pending.append((name, orcid, pos, article_id))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        pending = self.pending
+        self.pending = []
+
+        with self.unit_of_work():
+            with self.db.cursor() as cursor:
+                self.fetch_unknown(cursor, pending)
+
+                # Resolve in order, so an author created earlier in the batch is matched by the ones after it
+                new_authors = []
+                new_by_name = dict()
+                new_by_orcid = dict()
+                resolved = []  # author id, or the index of the new author as a 1-tuple
+                for name, orcid, pos, article_id in pending:
+                    author = None
+                    if orcid is not None:
+                        author = self.orcids.get(orcid)
+                        if author is None:
+                            author = new_by_orcid.get(orcid)
+
+                    if author is None:  # Try to match by name
+                        author = self.names.get(name)
+                        if author is None:
+                            author = new_by_name.get(name)
+
+                    if author is None:
+                        author = (len(new_authors),)
+                        new_authors.append((name, orcid))
+                        new_by_name[name] = author
+                        if orcid is not None:
+                            new_by_orcid[orcid] = author
+
+                    resolved.append(author)
+
+                new_ids = []
+                if len(new_authors) > 0:
+                    rows = execute_values(cursor, '''INSERT INTO authors (name, orcid) VALUES %s RETURNING id;''',
+                                          new_authors, page_size=len(new_authors), fetch=True)
+                    new_ids = [row[0] for row in rows]
+                    for (name, orcid), author_id in zip(new_authors, new_ids):
+                        self.names.put(name, author_id)
+                        if orcid is not None:
+                            self.orcids.put(orcid, author_id)
+
+                # Now, insert the author, article id pairs. The first position of an author in an article wins.
+                pairs = dict()
+                for (name, orcid, pos, article_id), author in zip(pending, resolved):
+                    author_id = new_ids[author[0]] if isinstance(author, tuple) else author
+                    if (author_id, article_id) not in pairs:
+                        pairs[(author_id, article_id)] = pos
+
+                execute_values(cursor, '''INSERT INTO author_paper_pairs (author_id, paper_id, author_position)
+                                          VALUES %s ON CONFLICT DO NOTHING;''',
+                               [(author_id, article_id, pos) for (author_id, article_id), pos in pairs.items()],
+                               page_size=len(pairs))
+
+    def fetch_unknown(self, cursor, pending):
+        # Look up all names and ORCIDs of the batch that are not cached with one query each
+        orcids = list({orcid for _, orcid, _, _ in pending if orcid is not None and orcid not in self.orcids})
+        if len(orcids) > 0:
+            cursor.execute("SELECT orcid, min(id) FROM authors WHERE orcid = ANY(%s) GROUP BY orcid;", [orcids])
+            for orcid, author_id in cursor.fetchall():
+                self.orcids.put(orcid, author_id)
+
+        names = list({name for name, _, _, _ in pending if name not in self.names})
+        if len(names) > 0:
+            cursor.execute("SELECT name, min(id) FROM authors WHERE name = ANY(%s) GROUP BY name;", [names])
+            for name, author_id in cursor.fetchall():
+                self.names.put(name, author_id)
@@ -0,0 +1,57 @@
+import os
+
+from joblib import delayed, Parallel
+
+from database_manager import DatabaseManager
+from fingerprint import FileFingerprint
+from util import ARCHIVE_EXTENSIONS, line_ranges
+
+
+def split_files(paths, chunk_size):
+    """
+    :return: a (path, byte range) task per chunk_size of the uncompressed files, a (path, None) task per other file
+    """
+    tasks = []
+    for path in paths:
+        if path.endswith(ARCHIVE_EXTENSIONS) or os.path.getsize(path) <= chunk_size:
+            tasks.append((path, None))
+        else:
+            tasks.extend((path, byte_range) for byte_range in line_ranges(path, chunk_size))
+    return tasks
+
+
+def ingest_chunked(paths, process_file, database_path="aip", chunk_size=2 ** 28, jobs=4, **database_options):
+    """
+    Parses the files in ranges of about chunk_size bytes aligned to the lines, see util.line_ranges, so a few huge
+    files do not keep a single core busy while the others are idle. Every range is parsed by process_file with its
+    own checkpoints, a file is added to parsed_files once all its ranges are parsed. A range that is done is skipped
+    when the files are parsed again, as long as the chunk_size is the same. No process reads a split file completely,
+    it is added by its fingerprint, see FileFingerprint.unhashed.
+    :param paths: the JSON lines files to parse
+    :param process_file: the function parsing a file, taking the path, the database path and the byte range
+    :param database_path: the database to write to
+    :param chunk_size: the size of the ranges in bytes
+    :param jobs: the number of processes
+    :param database_options: the options of the DatabaseManager of each process
+    :return: whether all files were parsed
+    """
+    tasks = split_files(paths, chunk_size)
+    chunked = sorted({path for path, byte_range in tasks if byte_range is not None})
+
+    fingerprints = {path: FileFingerprint(path) for path in chunked}
+    results = Parallel(n_jobs=jobs)(delayed(process_file)(path, database_path, byte_range=byte_range,
+                                                          **database_options)
+                                    for path, byte_range in tasks)
+
+    failed = {path for (path, _), succeeded in zip(tasks, results) if not succeeded}
+    database = DatabaseManager(location=database_path)
+    for path in chunked:
+        # A file no parser handles has no checkpoints, a file that was parsed before has none left
+        fingerprint = fingerprints[path]
+        fingerprint.unhashed()
+        ranges = sum(1 for task_path, _ in tasks if task_path == path)
+        if path not in failed and database.parsed_ranges(fingerprint) == ranges:
+            database.add_parsed_file(fingerprint)
+    database.close()
+
+    return len(failed) == 0
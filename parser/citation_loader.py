@@ -0,0 +1,261 @@
+import glob
+import logging
+import os
+
+import numpy as np
+import xxhash
+
+from database_manager import copy_rows
+
+logger = logging.getLogger(__name__)
+
+# An edge of a spill file: the semantic scholar ids of the citing and the cited paper, 40 hexadecimal characters each,
+# as 20 bytes
+EDGE_DTYPE = np.dtype([("citing", "S20"), ("cited", "S20")])
+
+
+def edge_spill_prefix(spill_dir, path):
+    # Files of the same name in different directories have different spills
+    path_hash = xxhash.xxh3_64_hexdigest(os.path.abspath(path).encode("utf-8", "surrogatepass"))
+    return os.path.join(spill_dir, "{0}-{1}-".format(os.path.basename(path), path_hash))
+
+
+def edge_spill_path(spill_dir, path, range_start=0):
+    """
+    :return: the spill file of the edges of the part of the corpus file starting at range_start, see EdgeSpill
+    """
+    return "{0}{1}.edges".format(edge_spill_prefix(spill_dir, path), range_start)
+
+
+def edge_spills(spill_dir, path):
+    """
+    :return: the spill files of all parts of the corpus file
+    """
+    return sorted(glob.glob(glob.escape(edge_spill_prefix(spill_dir, path)) + "*.edges"))
+
+
+def incomplete_edge_spills(spill_dir, path):
+    """
+    :return: the markers of the parts of the corpus file of which the spill is incomplete, see EdgeSpill.open
+    """
+    return sorted(glob.glob(glob.escape(edge_spill_prefix(spill_dir, path)) + "*.incomplete"))
+
+
+def read_edge_spill(spill, batch_size=1000000):
+    """
+    :return: the edges of the spill file in arrays of EDGE_DTYPE of at most batch_size edges
+    """
+    with open(spill, "rb") as file:
+        while True:
+            edges = np.fromfile(file, dtype=EDGE_DTYPE, count=batch_size)
+            if len(edges) == 0:
+                return
+            yield edges
+
+
+class EdgeSpill(object):
+    """
+    Writes the citations of the accepted papers of a Semantic Scholar file while the file is parsed, so the citations
+    can be loaded without reading the corpus again, see CitationLoader.add_edges. Every paper is written with a single
+    unbuffered write, the edges of the papers before a checkpoint of the file are on disk when the checkpoint is.
+    """
+
+    def __init__(self, spill_dir, path, range_start=0):
+        """
+        :param spill_dir: the directory of the spill files
+        :param path: the corpus file
+        :param range_start: the start of the part of the corpus file that is parsed, see chunked_ingest
+        """
+        self.spill = edge_spill_path(spill_dir, path, range_start)
+        self.marker = self.spill[:-len(".edges")] + ".incomplete"
+        os.makedirs(spill_dir, exist_ok=True)
+        self.file = None
+        self.skipped = 0
+
+    def open(self, resumed):
+        """
+        :param resumed: whether the parse resumes at a checkpoint, then the spill of the parse before is continued
+        """
+        if resumed and not os.path.exists(self.spill):
+            # The spill of the parse before is gone, e.g. its directory was cleared, so the edges before the
+            # checkpoint are missing. Mark the spills of the file incomplete, its citations are read from the file.
+            logger.warning("The edge spill %s to resume is missing, the citations are read from the corpus file.",
+                           self.spill)
+            open(self.marker, "wb").close()
+            return
+
+        if not resumed and os.path.exists(self.marker):
+            os.remove(self.marker)
+        self.file = open(self.spill, "ab" if resumed else "wb", buffering=0)
+
+    def add(self, publication_id, in_citations, out_citations):
+        if self.file is None:  # The spill is incomplete, see open
+            return
+        edges = [(citation, publication_id) for citation in in_citations]
+        edges.extend((publication_id, citation) for citation in out_citations)
+        try:
+            spilled = np.array([(bytes.fromhex(citing), bytes.fromhex(cited)) for citing, cited in edges
+                                if len(citing) == 40 and len(cited) == 40], dtype=EDGE_DTYPE)
+        except ValueError:  # Not a semantic scholar id
+            self.skipped += len(edges)
+            return
+        self.skipped += len(edges) - len(spilled)
+        if len(spilled) > 0:
+            self.file.write(spilled.tobytes())
+
+    def close(self):
+        if self.skipped > 0:
+            logger.warning("Skipped %s citations of %s with an id that is not a semantic scholar id.", self.skipped,
+                           self.spill)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CitationLoader(object):
+    """
+    Loads the citations of the Semantic Scholar corpus into the cites table. The semantic_scholar_id -> id mapping of
+    all publications is read once into a sorted key table, so the edges are resolved in memory instead of with a query
+    per citation. The resolved edges are deduplicated (every edge is listed in the inCitations of one paper and the
+    outCitations of the other) and copied into the cites table in large batches.
+    """
+
+    def __init__(self, db, batch_size=1000000):
+        """
+        :param db: the psycopg2 connection to use
+        :param batch_size: the number of (unresolved) edges collected before they are resolved and written
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.citing = []
+        self.cited = []
+        self.resolved = []  # Arrays of the positions of the citing and cited papers, see add_edges
+        self.pending = 0
+
+        self.keys = np.empty(0, dtype="S1")  # Sorted semantic scholar ids
+        self.ids = np.empty(0, dtype=object)  # The publication id of every key
+        self.load_publications()
+        self.binary_keys = None  # Sorted binary semantic scholar ids, see load_binary_keys
+        self.binary_rows = None  # The position of every binary key in keys
+
+    def load_publications(self, fetch_size=100000):
+        keys, ids = [], []
+        with self.db:
+            # A named cursor streams the rows instead of materializing the whole table
+            with self.db.cursor(name="citation_loader") as cursor:
+                cursor.itersize = fetch_size
+                cursor.execute('''SELECT semantic_scholar_id, id FROM publications
+                                  WHERE semantic_scholar_id IS NOT NULL;''')
+                for semantic_scholar_id, id in cursor:
+                    keys.append(semantic_scholar_id.encode("utf-8", "surrogatepass"))
+                    ids.append(id)
+
+        if len(keys) == 0:
+            return
+
+        keys = np.array(keys)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.ids = np.array(ids, dtype=object)[order]
+
+    def resolve(self, semantic_scholar_ids):
+        """
+        :param semantic_scholar_ids: a list of semantic scholar ids
+        :return: the positions of the matching publications in the key table, -1 if the id is unknown
+        """
+        if len(self.keys) == 0 or len(semantic_scholar_ids) == 0:
+            return np.full(len(semantic_scholar_ids), -1, dtype=np.int64)
+
+        keys = np.array([str(key).encode("utf-8", "surrogatepass") for key in semantic_scholar_ids])
+        rows = np.searchsorted(self.keys, keys)
+        rows[rows == len(self.keys)] = 0
+        found = self.keys[rows] == keys
+        return np.where(found, rows, -1).astype(np.int64)
+
+    def load_binary_keys(self):
+        # The ids of the spill files are 20 bytes, see EDGE_DTYPE
+        rows = [row for row, key in enumerate(self.keys) if len(key) == 40]
+        keys, binary_rows = [], []
+        for row in rows:
+            try:
+                keys.append(bytes.fromhex(self.keys[row].decode("ascii")))
+                binary_rows.append(row)
+            except ValueError:
+                continue
+
+        keys = np.array(keys, dtype="S20")
+        order = np.argsort(keys, kind="stable")
+        self.binary_keys = keys[order]
+        self.binary_rows = np.array(binary_rows, dtype=np.int64)[order]
+
+    def resolve_binary(self, keys):
+        """
+        :param keys: an array of binary semantic scholar ids
+        :return: the positions of the matching publications in the key table, -1 if the id is unknown
+        """
+        if self.binary_keys is None:
+            self.load_binary_keys()
+        if len(self.binary_keys) == 0 or len(keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+
+        rows = np.searchsorted(self.binary_keys, keys)
+        rows[rows == len(self.binary_keys)] = 0
+        found = self.binary_keys[rows] == keys
+        return np.where(found, self.binary_rows[rows], -1)
+
+    def add_edges(self, citing, cited):
+        """
+        :param citing: an array of the binary semantic scholar ids of the citing papers, see EDGE_DTYPE
+        :param cited: an array of the binary semantic scholar ids of the cited papers
+        """
+        self.resolved.append((self.resolve_binary(citing), self.resolve_binary(cited)))
+        self.pending += len(citing)
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def add(self, publication_id, in_citations, out_citations):
+        """
+        :param publication_id: the semantic scholar id of the paper
+        :param in_citations: the semantic scholar ids of the papers citing it
+        :param out_citations: the semantic scholar ids of the papers it cites
+        """
+        for in_citation in in_citations:
+            self.citing.append(in_citation)
+            self.cited.append(publication_id)
+
+        for out_citation in out_citations:
+            self.citing.append(publication_id)
+            self.cited.append(out_citation)
+
+        if len(self.citing) + self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.citing) == 0 and len(self.resolved) == 0:
+            return
+
+        citing = np.concatenate([self.resolve(self.citing)] + [rows for rows, _ in self.resolved])
+        cited = np.concatenate([self.resolve(self.cited)] + [rows for _, rows in self.resolved])
+        self.citing = []
+        self.cited = []
+        self.resolved = []
+        self.pending = 0
+
+        # Drop the edges to papers we do not have and deduplicate the rest
+        known = (citing >= 0) & (cited >= 0)
+        edges = np.unique(citing[known] * len(self.keys) + cited[known])
+        if len(edges) == 0:
+            return
+
+        citing_ids = self.ids[edges // len(self.keys)]
+        cited_ids = self.ids[edges % len(self.keys)]
+
+        with self.db:
+            with self.db.cursor() as cursor:
+                cursor.execute('''CREATE TEMPORARY TABLE IF NOT EXISTS cites_staging
+                                    (paper_id VARCHAR(64), cited_paper_id VARCHAR(64));''')
+                cursor.execute('''TRUNCATE cites_staging;''')
+                copy_rows(cursor, "cites_staging", ["paper_id", "cited_paper_id"], zip(citing_ids, cited_ids))
+                cursor.execute('''INSERT INTO cites (paper_id, cited_paper_id)
+                                  SELECT paper_id, cited_paper_id FROM cites_staging
+                                  ON CONFLICT (paper_id, cited_paper_id) DO NOTHING;''')
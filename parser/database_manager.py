@@ -1,18 +1,62 @@
+import contextlib
+import io
+import os
+import time
 from datetime import date, datetime
 
-import lxml
-import lxml.html
-import lxml.html.clean
 import psycopg2
-import xxhash
-from venue_mapper.venue_mapper import VenueMapper
 
 import tqdm
 
+import lookup_index
+import sanitizer
+from author_resolver import AuthorResolver
+from fingerprint import FileFingerprint
+from util import title_key
+from venue_matcher import VenueMatcher
+
+
+# Connections of closed managers per process and database, reused by the next manager in that process. Keyed by the
+# process too, as a forked child must not use the connections of its parent.
+idle_connections = dict()
+
+# The databases of which the schema was checked by this process already
+checked_schemas = set()
+
+# Managers shared by all callers in a process per process and database, see DatabaseManager.get_shared
+shared_managers = dict()
+
+
+def copy_value(value):
+    # Escape a value for the text format of COPY, None becomes NULL
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n") \
+        .replace("\r", "\\r").replace("\x00", "")
+
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    Streams the rows into the table with a single COPY, which is much cheaper than one INSERT per row.
+    :param cursor: cursor of the connection (and transaction) to use
+    :param table: name of the table to copy into
+    :param columns: the columns the values of every row map to
+    :param rows: an iterable containing tuples with a value per column
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert("COPY {0} ({1}) FROM STDIN;".format(table, ", ".join(columns)), buffer)
+
 
 class DatabaseManager(object):
 
-    def __init__(self, location="aip"):
+    def __init__(self, location="aip", bulk_ingest=False, bulk_batch_size=50000, use_lookup_index=False,
+                 commit_records=0, commit_interval_ms=0, author_batch_size=1000, author_cache_size=1000000,
+                 venue_cache_size=1000000, venue_cache_path=None, verify_full_hash=False,
+                 checkpoint_interval=10000):
         self.location = location
 
         user = "postgres"
@@ -20,20 +64,87 @@ class DatabaseManager(object):
         host = "localhost"
         port = "5432"
 
-        self.create_database(user, password, host, port, location)
+        self.db = self.connect(user, password, host, port, location)
+        self.closed = False
 
-        self.db = psycopg2.connect(user=user,
-                                   password=password,
-                                   host=host,
-                                   port=port,
-                                   dbname=location)
-        self.setup_db()
+        # Creating the tables is needed only once per process and database, after that reading the properties
+        # suffices. update_database does not touch the database when the schema is up to date.
+        if location not in checked_schemas or not self.load_properties():
+            self.setup_db()
+            checked_schemas.add(location)
         self.update_database()
         self.db.commit()
         self.did_up_version = False
         self.run_date_string = '{0:%Y-%m-%d_%H-%M-%S}'.format(datetime.now())
-        self.unknown_venue_dict = dict()
-        self.venue_mapper = VenueMapper()
+        # Memoizes the venue of every raw venue string, venue_cache_path shares the matches between workers and runs
+        self.venue_matcher = VenueMatcher(cache_size=venue_cache_size, cache_path=venue_cache_path)
+        self.venue_mapper = self.venue_matcher.mapper
+        self.unknown_venue_dict = self.venue_matcher.unknown_counts
+
+        # In bulk mode, papers are buffered and merged into publications with a handful of set-based statements
+        # instead of several round trips per paper, see flush_bulk_ingest
+        self.bulk_ingest = bulk_ingest
+        self.bulk_batch_size = bulk_batch_size
+        self.bulk_rows = []
+        self.staging_table = None
+
+        # The lookup index classifies most papers as insert or skip without querying the database. Every process
+        # keeps its own index and learns of the inserts of the others when its insert finds them. Without batching the
+        # inserts are guarded against the same paper being inserted by parallel workers, with batching they are not,
+        # see insert_new_article_if_unmatched
+        self.publication_index = lookup_index.PublicationIndex.from_database(self.db) if use_lookup_index else None
+
+        # Unit of work: group the writes of commit_records records, or of commit_interval_ms milliseconds, into one
+        # transaction instead of committing every write. Zero disables the limit, both zero disables batching.
+        self.commit_records = commit_records
+        self.commit_interval_ms = commit_interval_ms
+        self.batching = commit_records > 0 or commit_interval_ms > 0
+        self.batch_size = 0
+        self.batch_started = time.monotonic()
+        self.savepoint_state = None  # None, "open" for the current record or "stale" for a previous record
+
+        self.author_resolver = AuthorResolver(self.db, self.unit_of_work, cache_size=author_cache_size,
+                                              batch_size=author_batch_size)
+
+        # Files are recognized by their fingerprint, verify_full_hash also hashes every new file completely to
+        # recognize it by its content, e.g. a copy with another modification time or a file parsed before the
+        # fingerprints were introduced
+        self.verify_full_hash = verify_full_hash
+
+        # Checkpoints of the file being parsed, see resume_point. They are written with the commits of the batches
+        # and bulk merges, without either every checkpoint_interval records.
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_file = None
+        self.checkpoint_range = (0, None)
+        self.pending_checkpoint = None
+        self.checkpoint_countdown = checkpoint_interval
+
+    @staticmethod
+    def get_shared(location="aip"):
+        """
+        Returns the manager of the database shared by all callers in this process, e.g. the read-only helpers of
+        raw_db_access, instead of setting up a new manager and connection for every call.
+        """
+        manager = shared_managers.get((os.getpid(), location))
+        if manager is None or manager.closed or manager.db.closed:
+            manager = DatabaseManager(location=location)
+            shared_managers[(os.getpid(), location)] = manager
+        return manager
+
+    def connect(self, user, password, host, port, location):
+        # Reuse a connection of a closed manager if there is one
+        connections = idle_connections.get((os.getpid(), location), [])
+        while len(connections) > 0:
+            db = connections.pop()
+            if not db.closed:
+                return db
+
+        try:
+            return psycopg2.connect(user=user, password=password, host=host, port=port, dbname=location)
+        except psycopg2.OperationalError:
+            # Most likely the database does not exist yet
+            self.create_database(user, password, host, port, location)
+            return psycopg2.connect(user=user, password=password, host=host, port=port, dbname=location)
 
     def create_database(self, user, password, host, port, dbname):
         conn = psycopg2.connect(user=user,
@@ -68,7 +179,26 @@ class DatabaseManager(object):
             conn.autocommit = False
 
     def close(self):
-        self.db.close()
+        if self.closed:
+            return
+
+        self.flush_bulk_ingest()
+        self.author_resolver.flush()
+        self.commit_batch()
+        self.venue_matcher.close()
+        if self.staging_table is not None:
+            with self.db:
+                with self.db.cursor() as cursor:
+                    cursor.execute("DROP TABLE IF EXISTS {0};".format(self.staging_table))
+            self.staging_table = None
+
+        # Hand the connection to the next manager of this process instead of closing it
+        self.closed = True
+        try:
+            self.db.rollback()
+            idle_connections.setdefault((os.getpid(), self.location), []).append(self.db)
+        except psycopg2.Error:
+            self.db.close()
 
     def setup_db(self):
         # Create the publication table
@@ -115,9 +245,20 @@ class DatabaseManager(object):
                 cursor.execute('''CREATE INDEX IF NOT EXISTS ind_doi
                                         ON publications (doi);''')
 
+        self.load_properties()
+
+    def load_properties(self):
+        """
+        Reads the version of the data and of the schema.
+        :return: False if the properties table does not exist (anymore)
+        """
         query = "SELECT version, db_schema_version FROM properties"
         cursor = self.db.cursor()
-        cursor.execute(query)
+        try:
+            cursor.execute(query)
+        except psycopg2.errors.UndefinedTable:
+            self.db.rollback()
+            return False
 
         row = cursor.fetchone()
         if row is None:
@@ -130,6 +271,7 @@ class DatabaseManager(object):
         else:
             self.start_version = row[0]
             self.db_schema_version = row[1]
+        return True
 
     def update_database(self):
         """
@@ -374,27 +516,199 @@ class DatabaseManager(object):
 
                     self.db_schema_version = 10
                     cursor.execute("UPDATE properties SET db_schema_version = %s;", [self.db_schema_version])
+        if self.db_schema_version < 11:
+            # Titles are matched on the hash of their normalized form, see util.title_key
+            with self.db:
+                with self.db.cursor() as cursor:
+                    cursor.execute("ALTER TABLE publications ADD COLUMN title_key BIGINT;")
+                    self.backfill_title_keys(cursor)
+                    cursor.execute("CREATE INDEX ind_title_key ON publications (title_key);")
+
+                    self.db_schema_version = 11
+                    cursor.execute("UPDATE properties SET db_schema_version = %s;", [self.db_schema_version])
+        if self.db_schema_version < 12:
+            # Parsed files are recognized by their fingerprint first, see fingerprint.FileFingerprint
+            with self.db:
+                with self.db.cursor() as cursor:
+                    cursor.execute('''ALTER TABLE parsed_files ADD COLUMN size BIGINT, ADD COLUMN mtime_ns BIGINT,
+                                        ADD COLUMN sample_hash BIGINT;''')
+                    cursor.execute("CREATE INDEX ind_parsed_files_fingerprint ON parsed_files (size, sample_hash);")
+
+                    self.db_schema_version = 12
+                    cursor.execute("UPDATE properties SET db_schema_version = %s;", [self.db_schema_version])
+        if self.db_schema_version < 13:
+            # The progress through the files being parsed, see resume_point
+            with self.db:
+                with self.db.cursor() as cursor:
+                    cursor.execute('''CREATE TABLE ingest_checkpoints(
+                                            size BIGINT NOT NULL,
+                                            mtime_ns BIGINT NOT NULL,
+                                            sample_hash BIGINT NOT NULL,
+                                            path TEXT,
+                                            position BIGINT NOT NULL,
+                                            line BIGINT NOT NULL,
+                                            records BIGINT NOT NULL,
+                                            last_modified TIMESTAMP NOT NULL,
+                                            PRIMARY KEY (size, mtime_ns, sample_hash)
+                                        );''')
+
+                    self.db_schema_version = 13
+                    cursor.execute("UPDATE properties SET db_schema_version = %s;", [self.db_schema_version])
+        if self.db_schema_version < 14:
+            # A file can be parsed in byte ranges, each with its own checkpoints, see chunked_ingest
+            with self.db:
+                with self.db.cursor() as cursor:
+                    cursor.execute('''ALTER TABLE ingest_checkpoints ADD COLUMN range_start BIGINT NOT NULL DEFAULT 0,
+                                        ADD COLUMN range_end BIGINT;''')
+                    cursor.execute('''ALTER TABLE ingest_checkpoints DROP CONSTRAINT ingest_checkpoints_pkey,
+                                        ADD PRIMARY KEY (size, mtime_ns, sample_hash, range_start);''')
+
+                    self.db_schema_version = 14
+                    cursor.execute("UPDATE properties SET db_schema_version = %s;", [self.db_schema_version])
+        if self.db_schema_version < 15:
+            # The latest mdate of the records of the last DBLP dump that was parsed, see parse_dblp.parse
+            with self.db:
+                with self.db.cursor() as cursor:
+                    cursor.execute('''ALTER TABLE properties ADD COLUMN dblp_mdate date;''')
+
+                    self.db_schema_version = 15
+                    cursor.execute("UPDATE properties SET db_schema_version = %s;", [self.db_schema_version])
+
+    def backfill_title_keys(self, cursor, batch_size=100000):
+        # The keys are computed in Python, so stream the titles out and COPY the keys back in
+        cursor.execute('''CREATE TEMPORARY TABLE title_keys (id VARCHAR(64) NOT NULL, title_key BIGINT NOT NULL)
+                            ON COMMIT DROP;''')
+        with self.db.cursor(name="title_keys") as titles:
+            titles.itersize = batch_size
+            titles.execute("SELECT id, title FROM publications;")
+            while True:
+                rows = titles.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                copy_rows(cursor, "title_keys", ["id", "title_key"], [(id, title_key(title)) for id, title in rows])
+
+        cursor.execute('''UPDATE publications AS p SET title_key = t.title_key FROM title_keys AS t
+                            WHERE p.id = t.id;''')
+
+    def resolve_venue(self, raw_venue_string):
+        """
+        Maps the raw venue string of a paper to the abbreviation of a venue we are interested in.
+        :return: the abbreviation, or None if the venue is unknown
+        """
+        # Unknown venues are counted in unknown_venue_dict
+        return self.venue_matcher.match(raw_venue_string)
 
     def update_or_insert_paper(self, id, doi, title, abstract, raw_venue_string, year, volume,
                                is_semantic=False):
+        venue = self.resolve_venue(raw_venue_string)
+        if venue is None:
+            return False
+
+        return self.update_or_insert_paper_with_venue(id=id, doi=doi, title=title, abstract=abstract, venue=venue,
+                                                      year=year, volume=volume, is_semantic=is_semantic)
+
+    def update_paper(self, id, doi, title, abstract, raw_venue_string, year, volume):
+        """
+        Overwrites the title, venue, year and volume, and the DOI if one is given, of an existing publication, e.g.
+        of a DBLP record that was modified since the last dump, see parse_dblp.parse. The abstract is kept.
+        :return: whether the publication exists and was updated
+        """
+        venue = self.resolve_venue(raw_venue_string)
+        if venue is None:
+            return False
+
+        self.begin_record()
         title = self.sanitize_string(title)
-        # Title should not be longer than 512 characters, if they are, they are most likely corrupted
         if len(title) > 512:
             return False
 
-        abstract = self.sanitize_string(abstract)
-        raw_venue_string = str(raw_venue_string).strip()
-        venue = self.venue_mapper.get_abbreviation(raw_venue_string)
+        with self.unit_of_work():
+            with self.db.cursor() as cursor:
+                cursor.execute('''UPDATE publications SET title = %s, title_key = %s, venue = %s, year = %s,
+                                    volume = %s, doi = coalesce(%s, doi) WHERE id = %s;''',
+                               [title, title_key(title), venue, year, volume, doi, id])
+                updated = cursor.rowcount == 1
+
+        if updated:
+            if self.publication_index is not None:
+                self.publication_index.add(id=id, doi=doi, title=title, abstract=abstract)
+            self.update_version_and_date()
+        return updated
 
-        # If we cannot match the venue, we will keep the count in a dict to later analyze if we missed important venues
-        if venue is None:
-            if raw_venue_string not in self.unknown_venue_dict:
-                self.unknown_venue_dict[raw_venue_string] = 0
+    def replace_authors_for_article(self, authors, article_id):
+        """
+        Links the article to the given authors instead of its current ones, see add_authors_for_article.
+        """
+        with self.unit_of_work():
+            with self.db.cursor() as cursor:
+                cursor.execute("DELETE FROM author_paper_pairs WHERE paper_id = %s;", [article_id])
+        self.add_authors_for_article(authors=authors, article_id=article_id)
 
-            self.unknown_venue_dict[raw_venue_string] += 1
+    def add_publications(self, publications):
+        """
+        Writes a batch of publications of which the venue is resolved, see update_or_insert_paper_with_venue.
+        :param publications: the pipeline.PublicationRecords
+        :return: the amount of publications that modified the database
+        """
+        modified = 0
+        for publication in publications:
+            if self.update_or_insert_paper_with_venue(id=publication.id, doi=publication.doi, title=publication.title,
+                                                      abstract=publication.abstract, venue=publication.venue,
+                                                      year=publication.year, volume=publication.volume,
+                                                      is_semantic=publication.is_semantic,
+                                                      linked_id=publication.linked_id):
+                modified += 1
+        return modified
+
+    def update_or_insert_paper_with_venue(self, id, doi, title, abstract, venue, year, volume, is_semantic=False,
+                                          sanitized=False, linked_id=None):
+        """
+        Like update_or_insert_paper, for a paper of which the venue is already resolved with resolve_venue.
+        :param sanitized: whether the title and abstract are sanitized already, e.g. by a PartitionRouter
+        :param linked_id: the id of the publication the paper is linked to by its source, e.g. the AMiner paper of a
+        MAG paper, see oag_linkage. If that publication exists, the paper only fills it in and is not matched.
+        """
+        self.begin_record()
+        if not sanitized:
+            title = self.sanitize_string(title)
+        # Title should not be longer than 512 characters, if they are, they are most likely corrupted
+        if len(title) > 512:
             return False
 
+        if not sanitized:
+            abstract = self.sanitize_string(abstract)
+
+        if self.bulk_ingest:
+            self.stage_paper(id=id, doi=doi, title=title, abstract=abstract, venue=venue, year=year, volume=volume,
+                             is_semantic=is_semantic, linked_id=linked_id)
+            return True
+
+        if linked_id is not None:
+            succeeded, data_modified = self.try_to_update_using_link(linked_id=linked_id, doi=doi, abstract=abstract)
+            if succeeded:
+                if self.publication_index is not None and data_modified:
+                    self.publication_index.add(id=linked_id, doi=doi, title=title, abstract=abstract)
+                if data_modified:
+                    self.update_version_and_date()
+                return data_modified
+
+        if self.publication_index is not None:
+            action = self.publication_index.classify(doi=doi, title=title, abstract=abstract, is_semantic=is_semantic)
+            if action == lookup_index.SKIP:
+                return False
+
+            if action == lookup_index.INSERT:
+                if self.insert_new_article_if_unmatched(id=id, title=title, abstract=abstract, doi=doi, venue=venue,
+                                                        year=year, volume=volume, is_semantic=is_semantic):
+                    self.publication_index.add(id=id, doi=doi, title=title, abstract=abstract)
+                    self.update_version_and_date()
+                    return True
+
+                # Another worker inserted a matching publication in the meantime, learn it and match as usual
+                self.load_into_publication_index(doi=doi, title=title)
+
         did_modify_data = False
+        inserted = False
 
         # Try to match on DOI first
         succeeded, data_modified = self.try_to_update_using_doi(doi=doi, abstract=abstract,
@@ -414,6 +728,13 @@ class DatabaseManager(object):
             self.insert_new_article(id=id, title=title, abstract=abstract, doi=doi, venue=venue, year=year,
                                     volume=volume, is_semantic=is_semantic, original_id=id)
             did_modify_data = True
+            inserted = True
+
+        if self.publication_index is not None:
+            if inserted:
+                self.publication_index.add(id=id, doi=doi, title=title, abstract=abstract)
+            elif did_modify_data:
+                self.publication_index.fill_in(doi=doi, title=title, abstract=abstract)
 
         # If we modified data, update the database version and modification date if not done already
         if did_modify_data:
@@ -421,6 +742,37 @@ class DatabaseManager(object):
             return True
         return False
 
+    def try_to_update_using_link(self, linked_id, doi, abstract):
+        """
+        Fills in the missing abstract and DOI of the publication with the linked id.
+        :return: whether the publication exists and whether its data was modified
+        """
+        cursor = self.db.cursor()
+        cursor.execute("SELECT abstract, doi FROM publications WHERE id = %s;", [linked_id])
+        row = cursor.fetchone()
+        if row is None:
+            return False, False
+
+        arguments = []
+        query_part = ""
+        if (row[0] is None or len(row[0]) == 0) and (abstract is not None and len(abstract) > 0):
+            query_part += " abstract = %s,"
+            arguments.append(abstract)
+
+        if (row[1] is None or len(row[1]) == 0) and (doi is not None and len(doi) > 0):
+            query_part += " doi = %s,"
+            arguments.append(doi)
+
+        if len(query_part) == 0:
+            return True, False  # Succeeded but did not modify data
+
+        arguments.append(linked_id)
+        query = "UPDATE publications SET {0} WHERE id = %s;".format(query_part.rstrip(","))
+        with self.unit_of_work():
+            with self.db.cursor() as cursor:
+                cursor.execute(query, arguments)
+        return True, True
+
     def try_to_update_using_doi(self, doi, abstract, is_semantic, original_id):
 
         query = "SELECT abstract, n_citations FROM publications WHERE doi = %s;"
@@ -436,14 +788,14 @@ class DatabaseManager(object):
             succeeded = True
             if len(row[0]) == 0 and len(abstract) > 0:
                 query = "UPDATE publications set abstract = %s WHERE doi = %s;"
-                with self.db:
+                with self.unit_of_work():
                     with self.db.cursor() as cursor:
                         cursor.execute(query, [abstract, doi])
                 data_modified = True
 
             if is_semantic:
                 query = "UPDATE publications set semantic_scholar_id = %s WHERE doi = %s;"
-                with self.db:
+                with self.unit_of_work():
                     with self.db.cursor() as cursor:
                         cursor.execute(query, [original_id, doi])
                 data_modified = True
@@ -455,18 +807,19 @@ class DatabaseManager(object):
         if (abstract is None or len(abstract) == 0) and (doi is None or len(doi) == 0):
             return True, False
 
-        query = "SELECT count(*) FROM publications WHERE title like %s;"
+        key = title_key(title)
+        query = "SELECT count(*) FROM publications WHERE title_key = %s;"
         cursor = self.db.cursor()
-        cursor.execute(query, [title])
+        cursor.execute(query, [key])
         match_count = cursor.fetchone()[0]
 
         if match_count == 0:
             return False, False  # Couldn't find a match and thus not modify any data
 
         if match_count == 1:
-            query = "SELECT abstract, doi, n_citations FROM publications WHERE title like %s;"
+            query = "SELECT abstract, doi, n_citations FROM publications WHERE title_key = %s;"
             cursor = self.db.cursor()
-            cursor.execute(query, [title])
+            cursor.execute(query, [key])
             row = cursor.fetchone()
 
             # Check if the abstract (index 0) and DOI (index 1) are filled in
@@ -489,22 +842,22 @@ class DatabaseManager(object):
 
             query_part = query_part.rstrip(",")
 
-            arguments.append(title)
+            arguments.append(key)
 
-            query = "UPDATE publications SET {0} WHERE title like %s;".format(query_part)
-            with self.db:
+            query = "UPDATE publications SET {0} WHERE title_key = %s;".format(query_part)
+            with self.unit_of_work():
                 with self.db.cursor() as cursor:
                     cursor.execute(query, arguments)
                     if is_semantic:
-                        cursor.execute("UPDATE publications set semantic_scholar_id = %s WHERE title = %s;", [original_id, title])
+                        cursor.execute("UPDATE publications set semantic_scholar_id = %s WHERE title_key = %s;", [original_id, key])
                         # Only update the id in case it has exactly 1 match on the title
 
         elif match_count > 1:
             # Multiple articles with the exact same title? Well then... best effort based on venue and year
-            query = "UPDATE publications set abstract = %s WHERE title like %s AND venue = %s and year = %s and volume = %s;".format(
+            query = "UPDATE publications set abstract = %s WHERE title_key = %s AND venue = %s and year = %s and volume = %s;".format(
                 ", doi = %s" if doi is not None and len(doi) > 0 else ""
             )
-            arguments = [abstract, title, venue, year, volume, doi]
+            arguments = [abstract, key, venue, year, volume, doi]
             if doi is not None and len(doi) > 0:  # We will set the DOI too; add it to the arguments
                 arguments.insert(2, doi)
 
@@ -513,7 +866,7 @@ class DatabaseManager(object):
             # re-submitted articles which contained errors, we ignore these cases as we then need to filter by issue
             # which lacks in the semantic scholar data.
             try:
-                with self.db:
+                with self.unit_of_work():
                     with self.db.cursor() as cursor:
                         cursor.execute(query, arguments)
             except Exception as ex:
@@ -524,61 +877,322 @@ class DatabaseManager(object):
 
     def insert_new_article(self, id, title, abstract, doi, venue, year, volume, is_semantic, original_id):
         # We cannot update an existing row, so we assume this is a new entry.
-        with self.db:
+        with self.unit_of_work():
             with self.db.cursor() as cursor:
                 if is_semantic:
                     cursor.execute(
-                        "INSERT INTO publications (id, venue, year, volume, title, doi, abstract, semantic_scholar_id) VALUES(%s, %s, %s, %s, %s, %s, %s, %s);",
-                        (id, venue, year, volume, title, doi, abstract, original_id))
+                        "INSERT INTO publications (id, venue, year, volume, title, title_key, doi, abstract, semantic_scholar_id) VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s);",
+                        (id, venue, year, volume, title, title_key(title), doi, abstract, original_id))
                 else:
                     cursor.execute(
-                        "INSERT INTO publications (id, venue, year, volume, title, doi, abstract) VALUES(%s, %s, %s, %s, %s, %s, %s);",
-                        (id, venue, year, volume, title, doi, abstract))
+                        "INSERT INTO publications (id, venue, year, volume, title, title_key, doi, abstract) VALUES(%s, %s, %s, %s, %s, %s, %s, %s);",
+                        (id, venue, year, volume, title, title_key(title), doi, abstract))
+
+    def insert_new_article_if_unmatched(self, id, title, abstract, doi, venue, year, volume, is_semantic):
+        """
+        Inserts the article in a single round trip, unless a publication with the same DOI or title exists already.
+        Without batching, parallel workers check and insert the same title or DOI one after the other: an advisory
+        lock per key is held until the insert commits. With batching the inserts of another worker are only seen once
+        its batch commits, so two workers can still insert the same paper, see use_lookup_index.
+        :return: whether the article was inserted
+        """
+        key = title_key(title)
+        locks = []
+        if not self.batching:
+            # Taken in order, so two workers never wait for each other's second lock
+            locks = sorted({key} if doi is None or len(doi) == 0 else {key, lookup_index.key_of(doi) - 2 ** 63})
+        with self.unit_of_work():
+            with self.db.cursor() as cursor:
+                cursor.execute(
+                    "".join("SELECT pg_advisory_xact_lock(%s);" for _ in locks) +
+                    '''INSERT INTO publications (id, venue, year, volume, title, title_key, doi, abstract,
+                                                 semantic_scholar_id)
+                    SELECT %s, %s, %s, %s, %s, %s, %s, %s, %s
+                    WHERE NOT EXISTS (SELECT 1 FROM publications WHERE doi = %s OR title_key = %s);''',
+                    locks + [id, venue, year, volume, title, key, doi, abstract, id if is_semantic else None, doi,
+                             key])
+                return cursor.rowcount == 1
+
+    def load_into_publication_index(self, doi, title):
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT id, doi, title, abstract FROM publications WHERE doi = %s OR title_key = %s;''',
+                       [doi, title_key(title)])
+        for id, doi, title, abstract in cursor.fetchall():
+            self.publication_index.add(id=id, doi=doi, title=title, abstract=abstract)
 
     def add_authors_for_article(self, authors, article_id):
         """
+        Links the authors to the article. The authors are resolved and written in batches, see AuthorResolver.
         :param authors: an iterable containing tuples of (author name, orcid (may be None), position of the author in the article)
         :param article_id: The id of the article inserted in the publications table.
         :return:
         """
-        for name, orcid, pos in authors:
-            author_id = None
-            if orcid is not None:
-                cursor = self.db.cursor()
-                cursor.execute("SELECT id from authors where orcid = %s;", [orcid])
-                query_result = cursor.fetchone()
-                if query_result is not None:
-                    author_id = query_result[0]
-
-            if author_id is None:  # Try to match by name
-                cursor = self.db.cursor()
-                cursor.execute("SELECT id from authors where name = %s;", [name])
-                query_result = cursor.fetchone()
-                if query_result is not None:
-                    author_id = query_result[0]
+        self.author_resolver.add(authors, article_id)
+
+    def stage_paper(self, id, doi, title, abstract, venue, year, volume, is_semantic, linked_id=None):
+        """
+        Buffers a sanitized paper with a known venue for the next set-based merge. Empty DOIs are stored as NULL so
+        they never match each other.
+        """
+        if doi is not None:
+            doi = str(doi).strip()
+            if len(doi) == 0:
+                doi = None
+
+        self.bulk_rows.append((len(self.bulk_rows), id, venue, year, volume, title, title_key(title), doi,
+                               abstract if abstract is not None else "", id if is_semantic else None, linked_id))
+
+        if len(self.bulk_rows) >= self.bulk_batch_size:
+            self.flush_bulk_ingest()
+
+    def flush_bulk_ingest(self):
+        """
+        COPYs the buffered papers into an UNLOGGED staging table and merges them into publications. The merge follows
+        the same precedence as update_or_insert_paper: a DOI match first, then a title match, else an insert.
+        """
+        if len(self.bulk_rows) == 0:
+            return
+
+        # The merge commits on its own, take any batched writes along
+        self.commit_batch()
+
+        if self.staging_table is None:
+            # One staging table per process, so parallel workers do not see each other's rows
+            self.staging_table = "publications_staging_{0}".format(os.getpid())
+
+        with self.db:
+            with self.db.cursor() as cursor:
+                cursor.execute('''CREATE UNLOGGED TABLE IF NOT EXISTS {0}
+                                    (seq INTEGER NOT NULL,
+                                    id VARCHAR(64) NOT NULL,
+                                    venue VARCHAR(64) NOT NULL,
+                                    year INTEGER,
+                                    volume VARCHAR(32),
+                                    title VARCHAR(512) NOT NULL,
+                                    title_key BIGINT NOT NULL,
+                                    doi VARCHAR(128),
+                                    abstract TEXT NOT NULL,
+                                    semantic_scholar_id VARCHAR(64),
+                                    linked_id VARCHAR(64),
+                                    match_id VARCHAR(64),
+                                    match_count INTEGER,
+                                    doi_match BOOLEAN NOT NULL DEFAULT false,
+                                    pending_insert BOOLEAN NOT NULL DEFAULT false
+                                    );'''.format(self.staging_table))
+                cursor.execute("TRUNCATE {0};".format(self.staging_table))
+                copy_rows(cursor, self.staging_table,
+                          ["seq", "id", "venue", "year", "volume", "title", "title_key", "doi", "abstract",
+                           "semantic_scholar_id", "linked_id"],
+                          self.bulk_rows)
+                cursor.execute("ANALYZE {0};".format(self.staging_table))
+                did_modify_data = self.merge_staged_papers(cursor)
+                self.write_checkpoint(cursor)
+
+        self.bulk_rows = []
+        if did_modify_data:
+            self.update_version_and_date()
+
+    def merge_staged_papers(self, cursor):
+        staging = self.staging_table
+
+        # Without an abstract or DOI there is nothing to fill in and such papers are never inserted either,
+        # see try_to_update_using_title
+        cursor.execute("DELETE FROM {0} WHERE abstract = '' AND doi IS NULL;".format(staging))
+
+        # The papers linked to an existing publication fill it in, see try_to_update_using_link
+        cursor.execute('''UPDATE {0} AS s SET match_id = p.id, match_count = 1
+                            FROM publications AS p
+                            WHERE s.linked_id IS NOT NULL AND p.id = s.linked_id;'''.format(staging))
+
+        while True:
+            # Match on DOI first
+            cursor.execute('''UPDATE {0} AS s SET match_id = p.id, match_count = 1, doi_match = true
+                                FROM publications AS p
+                                WHERE s.match_id IS NULL AND s.doi IS NOT NULL AND p.doi = s.doi;'''.format(staging))
+
+            # Then on title, keeping track of titles that occur multiple times
+            cursor.execute('''UPDATE {0} AS s SET match_id = t.id, match_count = t.n
+                                FROM (SELECT p.title_key, min(p.id) AS id, count(*) AS n
+                                      FROM publications AS p
+                                      WHERE p.title_key IN (SELECT title_key FROM {0} WHERE match_id IS NULL)
+                                      GROUP BY p.title_key) AS t
+                                WHERE s.match_id IS NULL AND s.title_key = t.title_key;'''.format(staging))
+
+            # The remaining papers are new. Insert the first occurrence of every DOI and title; later occurrences are
+            # matched against the inserted rows in the next round, like they would be when inserted one by one. The
+            # occurrences are ranked in one pass over the staged rows, a self-join on title or DOI is quadratic.
+            cursor.execute('''UPDATE {0} AS s SET match_id = s.id, match_count = 0, pending_insert = true
+                                FROM (SELECT seq,
+                                        row_number() OVER (PARTITION BY title_key ORDER BY seq) AS title_rank,
+                                        row_number() OVER (PARTITION BY doi ORDER BY seq) AS doi_rank
+                                      FROM {0} WHERE match_id IS NULL) AS f
+                                WHERE s.seq = f.seq AND f.title_rank = 1
+                                AND (s.doi IS NULL OR f.doi_rank = 1);'''.format(staging))
+            if cursor.rowcount == 0:
+                break
+
+            cursor.execute('''INSERT INTO publications (id, venue, year, volume, title, title_key, doi, abstract,
+                                                          semantic_scholar_id)
+                                SELECT id, venue, year, volume, title, title_key, doi, abstract, semantic_scholar_id
+                                FROM {0} WHERE pending_insert
+                                ON CONFLICT DO NOTHING;'''.format(staging))
+            cursor.execute("UPDATE {0} SET pending_insert = false WHERE pending_insert;".format(staging))
+
+        # Fill in missing abstracts and DOIs of unique matches, the first staged value wins. The semantic scholar id
+        # is overwritten by the last staged value, unless another publication already uses it. Like
+        # try_to_update_using_doi and try_to_update_using_title, the id is only taken from a paper matched on DOI, or
+        # on title if it is the one filling in the abstract or DOI.
+        cursor.execute('''UPDATE publications AS p SET
+                            abstract = CASE WHEN coalesce(p.abstract, '') = '' AND f.abstract IS NOT NULL
+                                            THEN f.abstract ELSE p.abstract END,
+                            doi = CASE WHEN coalesce(p.doi, '') = '' AND f.doi IS NOT NULL
+                                       THEN f.doi ELSE p.doi END,
+                            semantic_scholar_id = CASE WHEN f.semantic_scholar_id IS NOT NULL AND NOT EXISTS (
+                                                      SELECT 1 FROM publications AS q
+                                                      WHERE q.semantic_scholar_id = f.semantic_scholar_id
+                                                      AND q.id <> p.id)
+                                                  THEN f.semantic_scholar_id ELSE p.semantic_scholar_id END
+                            FROM (SELECT match_id,
+                                    (array_agg(abstract ORDER BY seq) FILTER (WHERE abstract <> ''))[1] AS abstract,
+                                    (array_agg(doi ORDER BY seq) FILTER (WHERE doi IS NOT NULL))[1] AS doi,
+                                    (array_agg(semantic_scholar_id ORDER BY seq DESC)
+                                        FILTER (WHERE semantic_scholar_id IS NOT NULL AND sets_id))[1]
+                                        AS semantic_scholar_id
+                                  FROM (SELECT s.match_id, s.seq, s.abstract, s.doi, s.semantic_scholar_id,
+                                          s.doi_match
+                                          OR (coalesce(o.abstract, '') = ''
+                                              AND s.seq = min(s.seq) FILTER (WHERE s.abstract <> '') OVER w)
+                                          OR (coalesce(o.doi, '') = ''
+                                              AND s.seq = min(s.seq) FILTER (WHERE s.doi IS NOT NULL) OVER w)
+                                          AS sets_id
+                                        FROM {0} AS s JOIN publications AS o ON o.id = s.match_id
+                                        WHERE s.match_count = 1
+                                        WINDOW w AS (PARTITION BY s.match_id)) AS m
+                                  GROUP BY match_id) AS f
+                            WHERE p.id = f.match_id;'''.format(staging))
+        did_modify_data = cursor.rowcount > 0
+
+        # Multiple articles with the same title, best effort based on venue, year and volume
+        cursor.execute('''UPDATE publications AS p SET
+                            abstract = CASE WHEN coalesce(p.abstract, '') = '' THEN f.abstract ELSE p.abstract END,
+                            doi = CASE WHEN coalesce(p.doi, '') = '' AND f.doi IS NOT NULL
+                                       THEN f.doi ELSE p.doi END
+                            FROM (SELECT DISTINCT ON (title_key, venue, year, volume) title_key, venue, year, volume,
+                                    abstract, doi
+                                  FROM {0} WHERE match_count > 1
+                                  ORDER BY title_key, venue, year, volume, seq) AS f
+                            WHERE p.title_key = f.title_key AND p.venue = f.venue AND p.year = f.year
+                            AND p.volume = f.volume;'''.format(staging))
+        did_modify_data = did_modify_data or cursor.rowcount > 0
+
+        cursor.execute("SELECT count(*) FROM {0} WHERE match_count = 0;".format(staging))
+        return did_modify_data or cursor.fetchone()[0] > 0
+
+    def begin_record(self):
+        """
+        Marks the start of a new record for the unit of work, committing the batch once it is full or old enough.
+        """
+        if not self.batching:
+            return
+
+        if self.savepoint_state == "open":
+            self.savepoint_state = "stale"
+
+        self.batch_size += 1
+        if (0 < self.commit_records < self.batch_size) or \
+                (0 < self.commit_interval_ms <= (time.monotonic() - self.batch_started) * 1000):
+            self.commit_batch()
+            self.batch_size = 1
+
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        """
+        Wraps the writes of a record. Without batching this is the same as `with self.db:`, committing right away.
+        With batching the writes join the batch transaction in a savepoint per record, so a failing record is rolled
+        back on its own and does not take the rest of the batch with it.
+        """
+        if not self.batching:
+            with self.db:
+                yield
+            return
+
+        if self.savepoint_state != "open":
+            with self.db.cursor() as cursor:
+                # Release the savepoint of the previous record in the same round trip
+                if self.savepoint_state == "stale":
+                    cursor.execute("RELEASE SAVEPOINT record; SAVEPOINT record;")
                 else:
-                    with self.db:
-                        with self.db.cursor() as cursor:
-                            cursor.execute('INSERT INTO authors (name, orcid) VALUES (%s,%s) RETURNING id;',
-                                           (name, orcid))
-                            author_id = cursor.fetchone()[0]
+                    cursor.execute("SAVEPOINT record;")
+            self.savepoint_state = "open"
 
-            # Now, insert the author, article id pair.
-            cursor = self.db.cursor()
-            cursor.execute("SELECT author_id from author_paper_pairs WHERE author_id = %s AND paper_id = %s;",
-                           [str(author_id), str(article_id)])
-            query_result = cursor.fetchone()
-            if not query_result:  # Entry doesn't exist, so add it.
-                with self.db:
-                    with self.db.cursor() as cursor:
-                        cursor.execute('INSERT INTO author_paper_pairs (author_id, paper_id, author_position) VALUES (%s,%s,%s);',
-                                       (author_id, article_id, pos))
+        try:
+            yield
+        except Exception:
+            with self.db.cursor() as cursor:
+                cursor.execute("ROLLBACK TO SAVEPOINT record;")
+            raise
+
+    @contextlib.contextmanager
+    def record_transaction(self):
+        """
+        Commits all writes of a record at once, e.g. a DBLP paper and its authors. Without batching the paper would be
+        committed right away and its authors only with the next batch of the AuthorResolver, so a parse resumed after a
+        crash would find the paper and never add them. With batching the record is part of the batch already.
+        """
+        if self.batching or self.bulk_ingest:
+            yield
+            return
+
+        # The units of work of the record join one transaction, in a savepoint like a batched record
+        self.batching = True
+        try:
+            yield
+            self.author_resolver.flush()
+        except Exception:
+            self.db.rollback()
+            raise
+        else:
+            self.db.commit()
+        finally:
+            self.batching = False
+            self.savepoint_state = None
+
+    def commit_batch(self):
+        # Commit the checkpoint together with the writes of the records it covers. Staged papers are not written
+        # yet, then the checkpoint waits for the merge, see flush_bulk_ingest.
+        if self.pending_checkpoint is not None and len(self.bulk_rows) == 0:
+            self.author_resolver.flush()
+            with self.db.cursor() as cursor:
+                self.write_checkpoint(cursor)
+        self.db.commit()
+        self.batch_size = 0
+        self.batch_started = time.monotonic()
+        self.savepoint_state = None
+
+    def dblp_mdate(self):
+        """
+        :return: the latest mdate of the records of the last DBLP dump that was parsed completely as an ISO date
+        string, None if no dump was parsed yet
+        """
+        cursor = self.db.cursor()
+        cursor.execute("SELECT dblp_mdate FROM properties LIMIT 1;")
+        row = cursor.fetchone()
+        return None if row is None or row[0] is None else row[0].isoformat()
+
+    def set_dblp_mdate(self, mdate):
+        """
+        Committed together with the last batch of records of the dump.
+        :param mdate: the latest mdate of the records of the dump as an ISO date string
+        """
+        with self.unit_of_work():
+            with self.db.cursor() as cursor:
+                cursor.execute("UPDATE properties SET dblp_mdate = GREATEST(dblp_mdate, %s);", [mdate])
 
     def update_version_and_date(self):
         if self.did_up_version:
             return
 
-        with self.db:
+        with self.unit_of_work():
             with self.db.cursor() as cursor:
                 cursor.execute("UPDATE properties SET version = version + 1, last_modified = %s;", [date.today()])
                 self.did_up_version = True
@@ -591,56 +1205,138 @@ class DatabaseManager(object):
                 uvfile.write("{0}, {1}\n".format(k, v))
 
     def did_parse_file(self, file_path):
-        BUF_SIZE = 2 ** 20
-        x = xxhash.xxh32()
-        with open(file_path, 'rb') as f:
-            while True:
-                data = f.read(BUF_SIZE)
-                if not data:
-                    break
-                x.update(data)
-
-        hash = x.intdigest()
+        """
+        Checks whether the file was parsed before without reading it completely.
+        :return: the FileFingerprint of the file, to read the file through and to pass to add_parsed_file, and
+        whether the file was parsed before
+        """
+        fingerprint = FileFingerprint(file_path)
         cursor = self.db.cursor()
-        cursor.execute("SELECT * from parsed_files WHERE hash = %s;", [hash])
-        query_result = cursor.fetchone()
-        if not query_result:
-            return hash, False
-        else:
-            return hash, True
+        cursor.execute("SELECT 1 FROM parsed_files WHERE size = %s AND mtime_ns = %s AND sample_hash = %s;",
+                       [fingerprint.size, fingerprint.mtime_ns, fingerprint.sample_hash])
+        if cursor.fetchone() is not None:
+            return fingerprint, True
+
+        # Files parsed before the fingerprints were introduced are only known by their content hash. Hashing every
+        # new file completely for them is the double read the fingerprints avoid, and the rows of files that are gone
+        # would never be fingerprinted, so they are only looked up with verify_full_hash.
+        if not self.verify_full_hash:
+            return fingerprint, False
+
+        cursor.execute("SELECT 1 from parsed_files WHERE hash = %s;", [fingerprint.full_hash()])
+        if cursor.fetchone() is None:
+            return fingerprint, False
+
+        # Store the fingerprint, so the file is recognized without the full hash next time
+        self.add_parsed_file(fingerprint)
+        return fingerprint, True
+
+    def resume_point(self, fingerprint, byte_range=None):
+        """
+        Starts checkpointing the parsing of the file, see checkpoint.
+        :param fingerprint: the FileFingerprint returned by did_parse_file
+        :param byte_range: the start and end of the part of the file that is parsed, None for the whole file
+        :return: the position, line and records committed of the last checkpoint of the file or range, the start to
+        start at the beginning
+        """
+        self.checkpoint_file = fingerprint
+        self.checkpoint_range = (0, None) if byte_range is None else tuple(byte_range)
+        self.pending_checkpoint = None
+        self.checkpoint_countdown = self.checkpoint_interval
 
-    def add_parsed_file(self, hash):
-        with self.db:
-            with self.db.cursor() as cursor:
-                cursor.execute("INSERT into parsed_files (hash) VALUES (%s);", [hash])
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT position, line, records FROM ingest_checkpoints
+                            WHERE size = %s AND mtime_ns = %s AND sample_hash = %s AND range_start = %s;''',
+                       [fingerprint.size, fingerprint.mtime_ns, fingerprint.sample_hash, self.checkpoint_range[0]])
+        row = cursor.fetchone()
+        return (self.checkpoint_range[0], 0, 0) if row is None else row
 
-    def insert_cites(self, publication_id, in_citations, out_citations):
-        with self.db:
-            with self.db.cursor() as cursor:
-                query = "SELECT id FROM publications WHERE semantic_scholar_id like %s;"
-                cursor.execute(query, [publication_id])
-                publication = cursor.fetchone()
+    def checkpoint(self, position, line, records):
+        """
+        Notes that all records of the file up to the position have been handed to the manager. The checkpoint is
+        written in the transaction that commits the writes of those records, so it never runs ahead of the data.
+        :param position: the byte offset after the last record
+        :param line: the number of the last record
+        :param records: the amount of records of the file that modified the database so far
+        """
+        if self.checkpoint_file is None:
+            return
 
-                if publication is None:
-                    return
+        self.pending_checkpoint = (position, line, records)
+        if not self.batching and not self.bulk_ingest:
+            # Every record is committed on its own
+            self.checkpoint_countdown -= 1
+            if self.checkpoint_countdown <= 0:
+                self.author_resolver.flush()
+                with self.unit_of_work():
+                    with self.db.cursor() as cursor:
+                        self.write_checkpoint(cursor)
+                self.checkpoint_countdown = self.checkpoint_interval
 
-                for in_citation in in_citations:
-                    query = "SELECT id FROM publications WHERE semantic_scholar_id like %s;"
-                    cursor.execute(query, [in_citation])
-                    citation = cursor.fetchone()
+    def write_checkpoint(self, cursor):
+        if self.pending_checkpoint is None:
+            return
 
-                    if citation is not None:
-                        cursor.execute('''INSERT INTO cites (paper_id, cited_paper_id) VALUES (%s,%s) ON CONFLICT 
-                                            (paper_id, cited_paper_id) DO NOTHING;''', (citation, publication))
+        fingerprint = self.checkpoint_file
+        cursor.execute('''INSERT INTO ingest_checkpoints (size, mtime_ns, sample_hash, range_start, range_end, path,
+                                                          position, line, records, last_modified)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, now())
+                            ON CONFLICT (size, mtime_ns, sample_hash, range_start) DO UPDATE SET
+                                range_end = EXCLUDED.range_end, path = EXCLUDED.path, position = EXCLUDED.position,
+                                line = EXCLUDED.line, records = EXCLUDED.records,
+                                last_modified = EXCLUDED.last_modified;''',
+                       [fingerprint.size, fingerprint.mtime_ns, fingerprint.sample_hash] + list(self.checkpoint_range)
+                       + [fingerprint.path] + list(self.pending_checkpoint))
+        self.pending_checkpoint = None
+
+    def parsed_ranges(self, fingerprint):
+        """
+        :param fingerprint: the FileFingerprint of a file parsed in byte ranges
+        :return: the amount of ranges of the file of which the last checkpoint is at the end of the range
+        """
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT COUNT(*) FROM ingest_checkpoints
+                            WHERE size = %s AND mtime_ns = %s AND sample_hash = %s AND position >= range_end;''',
+                       [fingerprint.size, fingerprint.mtime_ns, fingerprint.sample_hash])
+        return cursor.fetchone()[0]
 
-                for out_citation in out_citations:
-                    query = "SELECT id FROM publications WHERE semantic_scholar_id like %s;"
-                    cursor.execute(query, [out_citation])
-                    reference = cursor.fetchone()
+    def add_parsed_file(self, fingerprint, byte_range=None):
+        """
+        Committed together with the last batch of records of the file, which replaces the checkpoints of the file.
+        :param fingerprint: the FileFingerprint returned by did_parse_file, of which the content hash is completed
+        here if the file was read through it. A file that was not read from its start, e.g. resumed at a checkpoint,
+        is stored by its fingerprint only, unless verify_full_hash needs its content hash.
+        :param byte_range: the range of the file that was parsed. Its last checkpoint marks it done, the file is only
+        added once all its ranges are, see chunked_ingest.
+        """
+        self.author_resolver.flush()
+        if byte_range is not None:
+            with self.unit_of_work():
+                with self.db.cursor() as cursor:
+                    self.write_checkpoint(cursor)
+            self.commit_batch()
+            self.checkpoint_file = None
+            return
 
-                    if reference is not None:
-                        cursor.execute('''INSERT INTO cites (paper_id, cited_paper_id) VALUES (%s,%s) ON CONFLICT 
-                                            (paper_id, cited_paper_id) DO NOTHING;''', (publication, reference))
+        self.checkpoint_file = None
+        self.pending_checkpoint = None
+        with self.unit_of_work():
+            with self.db.cursor() as cursor:
+                cursor.execute("DELETE FROM ingest_checkpoints WHERE size = %s AND mtime_ns = %s AND sample_hash = %s;",
+                               [fingerprint.size, fingerprint.mtime_ns, fingerprint.sample_hash])
+                content_hash = fingerprint.full_hash() if self.verify_full_hash else fingerprint.read_hash()
+                if content_hash is None:
+                    cursor.execute('''INSERT INTO parsed_files (size, mtime_ns, sample_hash) SELECT %s, %s, %s
+                                        WHERE NOT EXISTS (SELECT 1 FROM parsed_files
+                                            WHERE size = %s AND mtime_ns = %s AND sample_hash = %s);''',
+                                   [fingerprint.size, fingerprint.mtime_ns, fingerprint.sample_hash] * 2)
+                else:
+                    cursor.execute('''INSERT INTO parsed_files (hash, size, mtime_ns, sample_hash)
+                                        VALUES (%s, %s, %s, %s)
+                                        ON CONFLICT (hash) DO UPDATE SET size = EXCLUDED.size,
+                                            mtime_ns = EXCLUDED.mtime_ns, sample_hash = EXCLUDED.sample_hash;''',
+                                   [content_hash, fingerprint.size, fingerprint.mtime_ns, fingerprint.sample_hash])
+        self.commit_batch()
 
     def process_data(self):
         print("Processing data")
@@ -737,10 +1433,4 @@ class DatabaseManager(object):
 
     @staticmethod
     def sanitize_string(string):
-        try:  # Sometimes the cleaning fails when things are very corrupt, just return the string then
-            doc = lxml.html.fromstring(string)
-            cleaner = lxml.html.clean.Cleaner(style=True)
-            doc = cleaner.clean_html(doc)
-            return doc.text_content()
-        except:
-            return string
+        return sanitizer.sanitize_string(string)
@@ -0,0 +1,156 @@
+import io
+import os
+
+import xxhash
+
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 2 ** 16
+BUF_SIZE = 2 ** 20
+
+
+def sample_hash(file, size, sample_count=SAMPLE_COUNT, sample_size=SAMPLE_SIZE):
+    """
+    Hashes the size and sample_count blocks spread evenly over the file, including the first and the last block. Files
+    that are not much larger than the samples are hashed completely.
+    :return: the hash as a signed 64-bit integer, to fit a BIGINT column
+    """
+    x = xxhash.xxh3_64()
+    x.update(size.to_bytes(8, "big"))
+    if size <= sample_count * sample_size:
+        offsets = [0]
+        sample_size = size
+    else:
+        step = (size - sample_size) // (sample_count - 1)
+        offsets = [i * step for i in range(sample_count)]
+
+    for offset in offsets:
+        file.seek(offset)
+        x.update(file.read(sample_size))
+    return int.from_bytes(x.digest(), "big", signed=True)
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Reads a binary file while hashing the bytes that pass through, so the content hash of a file is computed on the
+    bytes the parser reads anyway instead of in a separate pass. Wrap it in a BufferedReader, TextIOWrapper or
+    GzipFile as if it were the file itself.
+    """
+
+    def __init__(self, path, update, position=0):
+        """
+        :param update: called with the bytes read, in order, None to only read the file
+        :param position: the byte offset to start at
+        """
+        self.raw = open(path, "rb")
+        self.raw.seek(position)
+        self.update = update
+
+    @property
+    def name(self):
+        # lxml resolves the DTD relative to the name of the file
+        return self.raw.name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.raw.readinto(buffer)
+        if n and self.update is not None:
+            self.update(memoryview(buffer)[:n])
+        return n
+
+    def close(self):
+        # The wrappers close the reader when the parser is done, hash whatever the parser did not read first, e.g.
+        # trailing bytes behind the last record
+        if not self.closed:
+            while self.update is not None:
+                data = self.raw.read(BUF_SIZE)
+                if not data:
+                    break
+                self.update(data)
+            self.raw.close()
+        super().close()
+
+
+class FileFingerprint(object):
+    """
+    Identifies an input file by its size, modification time and a hash of sampled blocks, which takes a few reads
+    instead of reading the whole file. The full content hash, the hash column of parsed_files, is computed while the
+    file is parsed, see open and update. A file that is not read from its start, e.g. when parsing resumes at a
+    checkpoint, is only hashed completely if asked for, see unhashed and full_hash.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        with open(path, "rb") as file:
+            self.sample_hash = sample_hash(file, self.size)
+        self.hash = None
+        self.content_hash = xxhash.xxh32()  # None once the content is not hashed while it is read, see unhashed
+        self.hashed = 0
+        self.reader = None
+
+    def unhashed(self):
+        """
+        Notes that the content is not read from its start through the fingerprint, e.g. when the parsing resumes at a
+        checkpoint or the file is parsed in byte ranges. The content hash is then only computed by full_hash.
+        """
+        self.content_hash = None
+
+    def open(self, position=0):
+        """
+        :param position: the byte offset to start reading at, the bytes before it are not read
+        :return: the file as a binary file object that hashes the content while it is read from its start
+        """
+        if position > 0:
+            self.unhashed()
+        self.reader = HashingReader(self.path, self.update if self.content_hash is not None else None, position)
+        return io.BufferedReader(self.reader, buffer_size=BUF_SIZE)
+
+    def update(self, data):
+        """
+        Hashes the next bytes of the file, for parsers that do not read the file through open, see
+        util.iterload_mapped_lines.
+        """
+        if self.content_hash is None:
+            return
+        self.content_hash.update(data)
+        self.hashed += len(data)
+
+    def read_hash(self):
+        """
+        :return: the xxh32 hash of the content as far as it is computed while parsing, see finish, None if the file
+        was not read from its start
+        """
+        self.finish()
+        return self.hash
+
+    def full_hash(self):
+        """
+        :return: the xxh32 hash of the content, read from the file now as far as it was not hashed while parsing
+        """
+        self.finish()
+        if self.hash is None:
+            # The file was not read from its start, hash it in a separate pass
+            content_hash = xxhash.xxh32()
+            HashingReader(self.path, content_hash.update).close()
+            self.hash = content_hash.intdigest()
+        return self.hash
+
+    def finish(self):
+        # Also drops the open file, so the fingerprint can be sent to another process
+        if self.hash is not None:
+            return
+        if self.content_hash is None:
+            if self.reader is not None:
+                self.reader.close()  # Without hashing the rest
+            self.reader = None
+            return
+        if self.reader is None:
+            self.reader = HashingReader(self.path, self.update, self.hashed)
+        self.reader.close()
+        self.hash = self.content_hash.intdigest()
+        self.content_hash = None
+        self.reader = None
@@ -0,0 +1,230 @@
+import numpy as np
+import xxhash
+
+from util import title_key
+
+# Flags kept per publication
+HAS_ABSTRACT = 1
+HAS_DOI = 2
+
+# Outcomes of PublicationIndex.classify
+INSERT = "insert"  # No publication matches, the paper is new
+FILL_IN = "fill_in"  # A publication matches and may be complemented, let the database decide
+SKIP = "skip"  # A publication matches and the paper has nothing to add to it
+
+
+def key_of(string):
+    return xxhash.xxh3_64_intdigest(str(string).encode("utf-8", "surrogatepass"))
+
+
+def title_key_of(title):
+    # The title_key column is signed, the tables use unsigned keys
+    return title_key(title) & 0xFFFFFFFFFFFFFFFF
+
+
+def concatenate(arrays, dtype):
+    if len(arrays) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+class KeyTable(object):
+    """
+    Maps 64-bit keys to publication rows. The bulk of the keys lives in sorted NumPy arrays, keys added afterwards are
+    kept in a small dict until they are merged into the arrays.
+    """
+
+    def __init__(self, merge_threshold):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.rows = np.empty(0, dtype=np.int64)
+        self.pending = dict()
+        self.pending_count = 0
+        self.merge_threshold = merge_threshold
+
+    def load(self, keys, rows):
+        keys = np.asarray(keys, dtype=np.uint64)
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.rows = rows[order]
+
+    def find(self, key):
+        key = np.uint64(key)
+        start = np.searchsorted(self.keys, key, side="left")
+        end = np.searchsorted(self.keys, key, side="right")
+        rows = self.rows[start:end].tolist()
+        if key in self.pending:
+            rows.extend(self.pending[key])
+        return rows
+
+    def add(self, key, row):
+        key = np.uint64(key)
+        if key not in self.pending:
+            self.pending[key] = []
+        self.pending[key].append(row)
+        self.pending_count += 1
+
+        if self.pending_count >= self.merge_threshold:
+            self.merge()
+
+    def merge(self):
+        if self.pending_count == 0:
+            return
+
+        keys = np.empty(self.pending_count, dtype=np.uint64)
+        rows = np.empty(self.pending_count, dtype=np.int64)
+        i = 0
+        for key, key_rows in self.pending.items():
+            for row in key_rows:
+                keys[i] = key
+                rows[i] = row
+                i += 1
+
+        self.load(np.concatenate((self.keys, keys)), np.concatenate((self.rows, rows)))
+        self.pending = dict()
+        self.pending_count = 0
+
+    def __len__(self):
+        return len(self.keys) + self.pending_count
+
+
+class PublicationIndex(object):
+    """
+    Compact in-process index of the publications table used to classify incoming papers as insert, fill-in or skip
+    without querying the database. DOIs and titles are stored as 64-bit hashes and compared the way
+    update_or_insert_paper compares them, i.e. DOIs exactly and titles on their title_key.
+    """
+
+    def __init__(self, merge_threshold=100000):
+        self.doi_table = KeyTable(merge_threshold)
+        self.title_table = KeyTable(merge_threshold)
+        self.id_table = KeyTable(merge_threshold)
+        self.flags = np.empty(0, dtype=np.uint8)
+        self.new_flags = []  # Flags of publications added since the last load
+
+    @staticmethod
+    def from_database(db, batch_size=100000):
+        """
+        Preloads the index with all publications.
+        :param db: the psycopg2 connection to read from
+        :param batch_size: the amount of rows fetched per round trip
+        :return: the loaded PublicationIndex
+        """
+        index = PublicationIndex()
+
+        # Every fetched batch is turned into arrays right away, so no Python int per row is kept
+        id_keys, doi_keys, doi_rows, title_keys, flags = [], [], [], [], []
+        count = 0
+        with db:
+            # A named cursor streams the rows instead of materializing the whole table
+            with db.cursor(name="publication_index") as cursor:
+                cursor.execute('''SELECT id, doi, title_key, coalesce(abstract, '') <> '' FROM publications;''')
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        break
+
+                    n = len(rows)
+                    id_keys.append(np.fromiter((key_of(id) for id, _, _, _ in rows), dtype=np.uint64, count=n))
+                    # The title_key column is signed, the tables use unsigned keys
+                    title_keys.append(np.fromiter((key for _, _, key, _ in rows), dtype=np.int64,
+                                                  count=n).view(np.uint64))
+                    has_doi = np.fromiter((doi is not None for _, doi, _, _ in rows), dtype=bool, count=n)
+                    doi_keys.append(np.fromiter((key_of(doi) for _, doi, _, _ in rows if doi is not None),
+                                                dtype=np.uint64, count=int(has_doi.sum())))
+                    doi_rows.append(count + np.flatnonzero(has_doi))
+                    flags.append(np.fromiter(((HAS_ABSTRACT if has_abstract else 0) |
+                                              (HAS_DOI if doi is not None and len(doi) > 0 else 0)
+                                              for _, doi, _, has_abstract in rows), dtype=np.uint8, count=n))
+                    count += n
+
+        index.id_table.load(concatenate(id_keys, np.uint64), np.arange(count))
+        index.title_table.load(concatenate(title_keys, np.uint64), np.arange(count))
+        index.doi_table.load(concatenate(doi_keys, np.uint64), concatenate(doi_rows, np.int64))
+        index.flags = concatenate(flags, np.uint8)
+        return index
+
+    def get_flags(self, row):
+        if row < len(self.flags):
+            return int(self.flags[row])
+        return self.new_flags[row - len(self.flags)]
+
+    def set_flags(self, row, flags):
+        if row < len(self.flags):
+            self.flags[row] |= flags
+        else:
+            self.new_flags[row - len(self.flags)] |= flags
+
+    def classify(self, doi, title, abstract, is_semantic):
+        """
+        Mirrors the matching of update_or_insert_paper.
+        :return: INSERT, FILL_IN or SKIP
+        """
+        has_abstract = abstract is not None and len(abstract) > 0
+        has_doi = doi is not None and len(doi) > 0
+
+        if doi is not None:
+            rows = self.doi_table.find(key_of(doi))
+            if len(rows) > 0:
+                missing_abstract = any(self.get_flags(row) & HAS_ABSTRACT == 0 for row in rows)
+                if is_semantic or (missing_abstract and has_abstract):
+                    return FILL_IN
+                return SKIP
+
+        if not has_abstract and not has_doi:
+            return SKIP
+
+        rows = self.title_table.find(title_key_of(title))
+        if len(rows) == 0:
+            return INSERT
+        if len(rows) > 1:
+            return FILL_IN
+
+        flags = self.get_flags(rows[0])
+        if (flags & HAS_ABSTRACT == 0 and has_abstract) or (flags & HAS_DOI == 0 and has_doi):
+            return FILL_IN
+        return SKIP
+
+    def add(self, id, doi, title, abstract):
+        """
+        Adds a publication that was inserted (possibly by another worker), or merges it into the known one.
+        """
+        flags = HAS_ABSTRACT if abstract is not None and len(abstract) > 0 else 0
+        if doi is not None and len(doi) > 0:
+            flags |= HAS_DOI
+
+        rows = self.id_table.find(key_of(id))
+        if len(rows) > 0:
+            row = rows[0]
+            if doi is not None and self.get_flags(row) & HAS_DOI == 0:
+                self.doi_table.add(key_of(doi), row)
+            self.set_flags(row, flags)
+            return
+
+        row = len(self.flags) + len(self.new_flags)
+        self.new_flags.append(flags)
+        self.id_table.add(key_of(id), row)
+        self.title_table.add(title_key_of(title), row)
+        if doi is not None:
+            self.doi_table.add(key_of(doi), row)
+
+    def fill_in(self, doi, title, abstract):
+        """
+        Records that the publication matching the DOI, or else the title, was complemented with the given data.
+        """
+        flags = HAS_ABSTRACT if abstract is not None and len(abstract) > 0 else 0
+
+        rows = self.doi_table.find(key_of(doi)) if doi is not None else []
+        if len(rows) == 0:
+            rows = self.title_table.find(title_key_of(title))
+            if len(rows) != 1:
+                return
+            if doi is not None and len(doi) > 0 and self.get_flags(rows[0]) & HAS_DOI == 0:
+                flags |= HAS_DOI
+                self.doi_table.add(key_of(doi), rows[0])
+
+        for row in rows:
+            self.set_flags(row, flags)
+
+    def __len__(self):
+        return len(self.id_table)
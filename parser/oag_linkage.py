@@ -0,0 +1,90 @@
+import itertools
+
+import numpy as np
+
+from database_manager import copy_rows
+from util import iterload_file_lines, iterload_file_lines_gzip, iterload_file_lines_zip
+
+
+class OagLinkage(object):
+    """
+    The AMiner paper the Open Academic Graph links a MAG paper to, see load_linkage. The links are kept in a sorted key
+    table like the one of CitationLoader, so a MAG id is looked up without a query.
+    """
+
+    def __init__(self, links):
+        """
+        :param links: (MAG id, AMiner id) pairs
+        """
+        mag_ids, aminer_ids = [], []
+        for mag_id, aminer_id in links:
+            mag_ids.append(str(mag_id).encode("utf-8", "surrogatepass"))
+            aminer_ids.append(str(aminer_id))
+
+        self.keys = np.empty(0, dtype="S1")  # Sorted MAG ids
+        self.ids = np.empty(0, dtype=object)  # The AMiner id of every key
+        if len(mag_ids) == 0:
+            return
+
+        keys = np.array(mag_ids)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.ids = np.array(aminer_ids, dtype=object)[order]
+
+    def aminer_id(self, mag_id):
+        """
+        :return: the id of the AMiner paper linked to the MAG paper, None if it is not linked
+        """
+        if len(self.keys) == 0:
+            return None
+
+        key = str(mag_id).encode("utf-8", "surrogatepass")
+        row = np.searchsorted(self.keys, key)
+        if row < len(self.keys) and self.keys[row] == key:
+            return self.ids[row]
+        return None
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def load_linkage(path, database, batch_size=100000):
+    """
+    Loads the paper linking pairs of the Open Academic Graph, JSON lines with the MAG id as "mid" and the AMiner id as
+    "aid". The AMiner papers are inserted under their AMiner id, so only the links to the ids of publications in the
+    database are kept, which are few compared to the whole linkage. The pairs are copied into a temporary table and
+    joined with the publications in the database, so the ids of the publications are not loaded. Load it after the
+    AMiner files are parsed.
+    :param path: the linkage file, possibly gzipped or zipped
+    :param database: the DatabaseManager of the database
+    :param batch_size: the amount of pairs copied and fetched at once
+    :return: the OagLinkage
+    """
+    file_iterator_func = iterload_file_lines
+    if path.endswith("gz"):
+        file_iterator_func = iterload_file_lines_gzip
+    elif path.endswith("zip"):
+        file_iterator_func = iterload_file_lines_zip
+
+    # Corrupt JSON lines possibly. Skip them.
+    pairs = ((str(link["mid"]), str(link["aid"])) for link in file_iterator_func(path)
+             if link is not None and "mid" in link and "aid" in link)
+
+    links = []
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''CREATE TEMPORARY TABLE oag_links (mag_id TEXT NOT NULL, aminer_id TEXT NOT NULL)
+                                ON COMMIT DROP;''')
+            while True:
+                batch = list(itertools.islice(pairs, batch_size))
+                if len(batch) == 0:
+                    break
+                copy_rows(cursor, "oag_links", ["mag_id", "aminer_id"], batch)
+
+        # A named cursor streams the links instead of materializing them on the client at once
+        with database.db.cursor(name="oag_linkage") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute('''SELECT l.mag_id, l.aminer_id FROM oag_links AS l
+                                JOIN publications AS p ON p.id = l.aminer_id;''')
+            links.extend(cursor)
+    return OagLinkage(links)
@@ -0,0 +1,168 @@
+import logging
+
+from tqdm import tqdm
+
+from database_manager import DatabaseManager
+from pipeline import ingest_records, PublicationRecord, venue_prefilter
+from util import doi_from_url, LineReader
+
+logger = logging.getLogger(__name__)
+
+
+class OagFormat(object):
+    """
+    The JSON lines of the Open Academic Graph, the Aminer and the MAG files have the same structure.
+    """
+
+    def __init__(self, path, linkage=None):
+        """
+        :param linkage: the oag_linkage.OagLinkage of the MAG papers to the AMiner papers, for a MAG file
+        """
+        self.path = path
+        self.linkage = linkage
+
+    def start(self, resumed):
+        pass
+
+    def finish(self):
+        pass
+
+    def raw_venue(self, record):
+        # Try to match the publication to a venue we are interested in.
+        # Warning: contrary to the documentation, the key is "venue" NOT "venue.raw"!
+        if 'venue' not in record:
+            logger.warning("Skipping line missing venue: %s in %s.", record, self.path)
+            return None
+
+        if 'title' not in record:
+            logger.warning("Skipping line missing title: %s in %s.", record, self.path)
+            return None
+
+        venue_string = record['venue']
+
+        # Sometimes the venue string is yet another dict...
+        if isinstance(venue_string, dict) and "raw" in venue_string:
+            venue_string = venue_string["raw"]
+
+        return self.venue_string(venue_string)
+
+    def venue_string(self, venue_string):
+        """
+        :return: the raw venue string to resolve of the venue string of a record, also read from its raw bytes by the
+        pipeline.venue_prefilter. Empty venues are resolved as well, they are counted in the missing venues report.
+        """
+        return venue_string
+
+    def publication(self, record, venue):
+        # publication_keywords = record['keywords']
+        # citation_count = int(record['n_citation']) if "n_citation" in record else None
+        doi = record.get('doi')
+        # Sometimes in the urls, a doi link is used. If there is, we attempt to extract the doi from the link.
+        if doi is None or len(doi) == 0:
+            for url in record.get('url', []):
+                url_doi = doi_from_url(url)
+                if url_doi is not None:
+                    doi = url_doi
+                    break
+
+        linked_id = self.linkage.aminer_id(record['id']) if self.linkage is not None else None
+        return PublicationRecord(id=record['id'], doi=doi, title=str(record['title']).rstrip("."),
+                                 abstract=record.get('abstract', ""), venue=venue, year=record.get('year'),
+                                 volume=record.get('volume'), linked_id=linked_id)
+
+
+class SemanticScholarFormat(object):
+    """
+    The JSON lines of the Semantic Scholar corpus.
+    """
+
+    def __init__(self, edge_spill=None):
+        """
+        :param edge_spill: the citation_loader.EdgeSpill the citations of the accepted papers are written to, so the
+        citations are loaded without reading the file again
+        """
+        self.edge_spill = edge_spill
+
+    def start(self, resumed):
+        """
+        :param resumed: whether the file is parsed from a checkpoint on
+        """
+        if self.edge_spill is not None:
+            self.edge_spill.open(resumed)
+
+    def finish(self):
+        if self.edge_spill is not None:
+            self.edge_spill.close()
+
+    def raw_venue(self, record):
+        if "venue" not in record or "title" not in record:  # While parsing we sometimes get KeyError: 'venue'...
+            return None
+
+        # Wrap in str() as it sometimes is an int (???)
+        return self.venue_string(str(record['venue']))
+
+    def venue_string(self, venue_string):
+        """
+        :return: the raw venue string to resolve of the venue string of a record, also read from its raw bytes by the
+        pipeline.venue_prefilter. Empty venues are skipped.
+        """
+        if len(venue_string) == 0:
+            return None
+
+        return venue_string
+
+    def publication(self, record, venue):
+        # publication_keywords = record['entities']
+        doi = record['doi']
+        if doi is None or len(doi) == 0:
+            url_doi = doi_from_url(record['doiUrl'])
+            if url_doi is not None:
+                doi = url_doi
+
+        if self.edge_spill is not None:
+            self.edge_spill.add(record['id'], record.get('inCitations', []), record.get('outCitations', []))
+
+        return PublicationRecord(id=record['id'], doi=doi, title=record['title'], abstract=record['paperAbstract'],
+                                 venue=venue, year=record.get('year'),
+                                 volume=record['journalVolume'].replace(" ", "_"),  # Empty for conferences.
+                                 is_semantic=True)
+
+
+def parse_corpus_file(path, corpus_format, database_path="aip", logger_disabled=False, router=None, byte_range=None,
+                      progress=True, **database_options):
+    """
+    Parses a file of JSON lines into the database, the core of the Aminer, MAG and Semantic Scholar parsers.
+    :param corpus_format: the OagFormat or SemanticScholarFormat of the records
+    :param router: a PartitionRouter to hand the publications to instead of the database, see partitioned_ingest
+    :param byte_range: the start and end of the part of the file to parse, see chunked_ingest
+    :param progress: show a progress bar
+    :return: whether the file was parsed
+    """
+    logger.disabled = logger_disabled
+    # A PartitionRouter takes the place of the database in partitioned mode
+    database = router if router is not None else DatabaseManager(location=database_path, **database_options)
+
+    fingerprint, parsed = database.did_parse_file(path)
+    if parsed:
+        return True
+
+    # The json files contain stacked json objects, which is bad practice. It should be wrapped in a JSON array.
+    # Libraries will throw errors if you attempt to load the file, so now we lazy load each object line by line.
+    # Read through the fingerprint, which hashes the content on the way, from the last checkpoint of the file on.
+    # Only the lines in byte_range if the file is parsed in parts, see chunked_ingest. The lines of venues we are not
+    # interested in are not decoded.
+    resume_point = database.resume_point(fingerprint, byte_range)
+    publication_iterator = LineReader(path, fingerprint, resume_point, None if byte_range is None else byte_range[1],
+                                      venue_prefilter(database, corpus_format))
+
+    corpus_format.start(resumed=resume_point[1] > 0)
+    try:
+        ingest_records(database, tqdm(publication_iterator) if progress else publication_iterator, corpus_format,
+                       reader=publication_iterator)
+    finally:
+        corpus_format.finish()
+    # database.flush_missing_venues()
+    database.flush_bulk_ingest()
+    database.add_parsed_file(fingerprint, byte_range)
+    database.close()
+    return True
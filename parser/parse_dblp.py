@@ -1,100 +1,325 @@
+import collections
+import gzip
+import io
+import multiprocessing
+import os
 import re
 import sys
+import time
 from tqdm import tqdm
 
 from lxml import etree
 
 from database_manager import DatabaseManager
+from util import BackgroundReader, doi_from_url
 
+RECORD_TAGS = ('article', 'inproceedings', 'proceedings')
+# The start of a record of the tags we are interested in. The records are
+# children of the root and every record starts on a new line.
+RECORD_START = re.compile(rb"\n<(?:article|inproceedings|proceedings)[\s>]")
 
-def parse(dblp_file, database_path="aip"):
-    database = DatabaseManager(location=database_path)
 
-    hash, parsed = database.did_parse_file(dblp_file)
+def iter_records(source, validate=False):
+    """
+    :param source: the DBLP dump as a binary file
+    :param validate: validate the dump against its DTD, which keeps the whole
+    document in memory
+    :return: the record elements of the tags we are interested in, cleared
+    after the next record is requested
+    """
+    if validate:
+        for event, element in etree.iterparse(source, load_dtd=True,
+                                              dtd_validation=True):
+            if element.tag not in RECORD_TAGS:
+                continue
+            yield element
+            element.clear()
+        return
+
+    # Only the end events of the record tags. The DTD is still loaded to
+    # resolve the character entities DBLP uses in names and titles.
+    for event, element in etree.iterparse(source, events=('end',),
+                                          tag=RECORD_TAGS, load_dtd=True,
+                                          resolve_entities=True,
+                                          huge_tree=True):
+        # A cleared record is still a child of the root, delete it together
+        # with the skipped records after it, e.g. the www and phdthesis ones
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        yield element
+        element.clear(keep_tail=True)
+
+
+def split_dump(path, chunk_size, start=0):
+    """
+    Splits the uncompressed DBLP dump into chunks of records, to parse them
+    in parallel, see parse_chunk.
+    :param start: the byte offset of a record to start at, e.g. the end of a
+    chunk that was parsed before
+    :return: the header of the dump up to and including the start tag of the
+    root, with the path of the DTD made absolute, and the (start, end) byte
+    ranges of chunks of about chunk_size that start at a record
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        head = file.read(2 ** 16)
+        header_end = head.index(b">", head.index(b"<dblp")) + 1
+        file.seek(max(size - 2 ** 16, 0))
+        tail = file.read()
+        end = size - len(tail) + tail.rindex(b"</dblp>")
+
+        ranges = []
+        start = max(start, header_end)
+        while start < end:
+            boundary = end
+            position = start + chunk_size
+            while position < end:
+                file.seek(position)
+                block = file.read(2 ** 20)
+                match = RECORD_START.search(block)
+                if match is not None:
+                    boundary = min(position + match.start() + 1, end)
+                    break
+                # Overlap the blocks, a record start may span two of them
+                position += max(len(block) - 64, 1)
+            ranges.append((start, boundary))
+            start = boundary
+
+    # The chunks are parsed from memory, not next to the DTD
+    directory = os.path.dirname(os.path.abspath(path)).encode()
+    header = re.sub(rb'SYSTEM\s+"([^"]+)"',
+                    lambda match: b'SYSTEM "%s"' % os.path.join(
+                        directory, match.group(1)),
+                    head[:header_end])
+    return header, ranges
+
+
+def parse_chunk(path, header, byte_range, since=None):
+    """
+    Parses a chunk of records of the dump as a standalone document.
+    :param header: the header of the dump, see split_dump
+    :return: the _read_record of every record in the chunk
+    """
+    start, end = byte_range
+    with open(path, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+    source = io.BytesIO(header + data + b"</dblp>\n")
+    return [_read_record(element, since) for element in iter_records(source)]
+
+
+def iter_parsed_chunks(path, jobs, chunk_size, since=None, start=0):
+    """
+    :param start: the byte offset of the record to start at, see split_dump
+    :return: the start, the end and the _read_record of every record of every
+    chunk of the dump, in the order of the dump, parsed by jobs processes
+    """
+    header, ranges = split_dump(path, chunk_size, start)
+    if jobs <= 1:
+        for byte_range in ranges:
+            yield byte_range + (parse_chunk(path, header, byte_range, since),)
+        return
+
+    with multiprocessing.Pool(jobs) as pool:
+        # A few chunks ahead, not the whole dump in memory
+        pending = collections.deque()
+        for byte_range in ranges:
+            pending.append((byte_range, pool.apply_async(
+                parse_chunk, (path, header, byte_range, since))))
+            if len(pending) >= 2 * jobs:
+                byte_range, records = pending.popleft()
+                yield byte_range + (records.get(),)
+        while pending:
+            byte_range, records = pending.popleft()
+            yield byte_range + (records.get(),)
+
+
+def iter_chunk_checkpoints(chunks):
+    """
+    :param chunks: the chunks of the dump, see iter_parsed_chunks
+    :return: the checkpoint after every record together with the record: the
+    start of its chunk and the number of records of the chunk done, or the
+    end of the chunk and 0 after its last record
+    """
+    for start, end, records in chunks:
+        for done, record in enumerate(records, 1):
+            yield ((end, 0) if done == len(records) else (start, done)), record
+
+
+def _read_record(element, since=None):
+    """
+    :param since: an ISO date, the records last modified before it are not
+    parsed
+    :return: the key, the mdate and the _parse_record of the record, None for
+    the latter if the record was not modified since the given date
+    """
+    mdate = element.get('mdate')
+    # Checked on the attribute, before looking at any of the child elements
+    if since is not None and mdate is not None and mdate < since:
+        return element.get('key'), mdate, None
+    return element.get('key'), mdate, _parse_record(element)
+
+
+def _parse_record(element):
+    """
+    :return: the keyword arguments of update_or_insert_paper except for the
+    id and the authors of the record, or None if it misses its title, year or
+    venue
+    """
+    title = element.find('title')  # type: Optional[str]
+    if title is not None:
+        title = str(title.text).rstrip(".")
+    year = element.find('year')  # type: Optional[int]
+    if year is not None:
+        try:
+            year = int(re.search(r'\d+', str(year.text)).group())
+            if 20 < year < 100:  # Weird cases like 92-93
+                year += 1900
+            elif year < 20:  # weird cases like '12
+                year += 2000
+        except:
+            year = None
+    volume = element.find('volume')  # type: Optional[int]
+    if volume is not None:
+        try:
+            volume = int(volume.text)
+        except:
+            volume = None
+    # authors = element.find('author')  # type: Optional[str]
+    venue = element.find('booktitle')  # type: Optional[str]
+    if venue is None and len(element.findall('journal')) > 0:
+        venue = element.find('journal')
+
+    if venue is not None and venue.text is not None:
+        venue = str(venue.text)
+    else:
+        venue = None
+
+    doi = None
+    for ee in element.findall('ee'):
+        doi = doi_from_url(str(ee.text))
+        if doi is not None:
+            break
+
+    if title is None or year is None or venue is None:
+        return None
+
+    # Get the authors for this paper
+    authors = []  # tuples of ID, orcid, position
+    for i, author_element in enumerate(element.findall('author')):
+        orcid = None
+        if "orcid" in author_element.attrib:
+            orcid = str(author_element.attrib['orcid'])
+
+        # print(DatabaseManager.sanitize_string(
+        # author_element.text.encode("ISO-8859-1"))) authors.append(
+        # (DatabaseManager.sanitize_string(
+        # author_element.text.encode("utf-8")), orcid)) print(
+        # author_element.text)
+        authors.append((author_element.text, orcid, i+1))
+
+    paper = dict(doi=doi, title=title, abstract="", raw_venue_string=venue,
+                 year=year, volume=volume)
+    return paper, authors
+
+
+def parse(dblp_file, database_path="aip", validate=False, jobs=1,
+          chunk_size=2 ** 26, incremental=False, **database_options):
+    """
+    :param validate: parse the dump the way it used to be, validating it
+    against the DTD, see iter_records
+    :param jobs: the number of processes parsing an uncompressed dump in
+    chunks of chunk_size bytes, see split_dump, 1 to parse the chunks in this
+    process. The records are still written in the order of the dump by this
+    process.
+    :param incremental: only apply the records modified since the latest
+    mdate of the last dump that was parsed, for the monthly refreshes of DBLP
+    """
+    database = DatabaseManager(location=database_path, **database_options)
+
+    fingerprint, parsed = database.did_parse_file(dblp_file)
     if parsed:
         return True
 
     counter = 0  # counter for new keys.
+    # Resume after the records of the last checkpoint of the file: the
+    # records after its position of which the first skip are done already.
+    # An uncompressed dump is parsed in chunks that start at a record, so the
+    # position is the end of the last chunk done and parsing starts there. A
+    # gzipped dump cannot be seeked into, its position is always 0 and the
+    # records before the checkpoint are parsed again, but not written again.
+    resume_position, skip, added = database.resume_point(fingerprint)
+    read = 0
+    since = database.dblp_mdate() if incremental else None
+    latest = None
 
     # dtd = etree.DTD(file="/media/lfdversluis/datastore/dblp.dtd")
-    for event, element in tqdm(etree.iterparse(dblp_file, load_dtd=True,
-                                               dtd_validation=True)):
-        if element.tag not in ['article', 'inproceedings', 'proceedings']:
-            continue
+    # A gzipped or validated dump is read through the fingerprint, which
+    # hashes the content on the way. A gzipped dump is decompressed in a
+    # background thread, the DTD is still looked up next to it.
+    if not dblp_file.endswith("gz") and (resume_position > 0 or (
+            skip == 0 and not validate)):
+        # The chunks are read by the processes, not through the fingerprint
+        fingerprint.unhashed()
+        source = None
+        records = iter_chunk_checkpoints(iter_parsed_chunks(
+            dblp_file, jobs, chunk_size, since, resume_position))
+    else:
+        source = fingerprint.open()
+        if dblp_file.endswith("gz"):
+            source = io.BufferedReader(BackgroundReader(gzip.open(source)))
+        records = (((0, done), _read_record(element, since))
+                   for done, element in enumerate(
+                       iter_records(source, validate), 1))
 
-        if 'key' in element.attrib:
-            id = str(element.attrib['key'])
+    start = time.time()
+    for (position, done), (key, mdate, record) in tqdm(records,
+                                                       unit=" records"):
+        if mdate is not None and (latest is None or mdate > latest):
+            latest = mdate
+
+        if key is not None:
+            id = str(key)
         else:
             id = "id" + str(counter)
             print("new key added")
             counter += 1
-        title = element.find('title')  # type: Optional[str]
-        if title is not None:
-            title = str(title.text).rstrip(".")
-        year = element.find('year')  # type: Optional[int]
-        if year is not None:
-            try:
-                year = int(re.search(r'\d+', str(year.text)).group())
-                if 20 < year < 100:  # Weird cases like 92-93
-                    year += 1900
-                elif year < 20:  # weird cases like '12
-                    year += 2000
-            except:
-                year = None
-        volume = element.find('volume')  # type: Optional[int]
-        if volume is not None:
-            try:
-                volume = int(volume.text)
-            except:
-                volume = None
-        # authors = element.find('author')  # type: Optional[str]
-        venue = element.find('booktitle')  # type: Optional[str]
-        if venue is None and len(element.findall('journal')) > 0:
-            venue = element.find('journal')
-
-        if venue is not None and venue.text is not None:
-            venue = str(venue.text)
-        else:
-            venue = None
-
-        doi = None
-        for ee in element.findall('ee'):
-            ee_str = str(ee.text)
-            if ee is not None and "doi.org" in ee_str:
-                doi = ee_str[ee_str.index("doi.org/") + len("doi.org/"):]
-                break
-
-        if title is not None and year is not None and venue is not None:
-            # Clean the title which may have HTML elements
-            addedPaper = \
-                database.update_or_insert_paper(id=id, doi=doi,
-                                            title=title, abstract="",
-                                            raw_venue_string=venue,
-                                            year=year,
-                                            volume=volume)
-
-            # Get the authors for this paper and add them to the database
-            authors = []  # tuples of ID, orcid, position
-            for i, author_element in enumerate(element.findall('author')):
-                orcid = None
-                if "orcid" in author_element.attrib:
-                    orcid = str(author_element.attrib['orcid'])
-
-                # print(DatabaseManager.sanitize_string(
-                # author_element.text.encode("ISO-8859-1"))) authors.append(
-                # (DatabaseManager.sanitize_string(
-                # author_element.text.encode("utf-8")), orcid)) print(
-                # author_element.text)
-                authors.append((author_element.text, orcid, i+1))
-
-            if addedPaper:
-                database.add_authors_for_article(authors=authors,
-                                                 article_id=id)
-
-        element.clear()
+
+        read += 1
+        if position == resume_position and done <= skip:
+            continue
+
+        if record is not None:
+            paper, authors = record
+            # The paper and its authors are committed together, a resumed
+            # parse does not add the authors of a paper that exists
+            with database.record_transaction():
+                if since is not None and database.update_paper(id=id,
+                                                               **paper):
+                    # A record modified since the last dump is applied as a
+                    # whole, update_or_insert_paper only fills in missing
+                    # fields
+                    added += 1
+                    database.replace_authors_for_article(authors=authors,
+                                                         article_id=id)
+                # Clean the title which may have HTML elements
+                elif database.update_or_insert_paper(id=id, **paper):
+                    # Add the authors of this paper to the database
+                    added += 1
+                    database.add_authors_for_article(authors=authors,
+                                                     article_id=id)
+
+        database.checkpoint(position, done, added)
 
         # database.flush_missing_venues()
-    database.add_parsed_file(hash)
+    if source is not None:
+        source.close()
+    elapsed = time.time() - start
+    print("Parsed {0} DBLP records in {1:.1f}s, {2:.0f} records/s".format(
+        read, elapsed, read / max(elapsed, 1e-9)))
+    if latest is not None:
+        database.set_dblp_mdate(latest)
+    database.add_parsed_file(fingerprint)
     database.close()
     return True
 
@@ -102,8 +327,11 @@ def parse(dblp_file, database_path="aip"):
 if __name__ == '__main__':
     xml_file = "C:/Users/ktoka/Desktop/CSE2020-21/Y2Q4SP/raw-data/dblp2021.xml"
     # xml_file = "c:/Users/L/Downloads/dblp-2021-04-01.xml"
-    if len(sys.argv) == 2:
+    if len(sys.argv) >= 2:
         xml_file = sys.argv[1]
 
-    parse(xml_file)
+    # Pass --validate to validate the dump against the DTD while parsing,
+    # --incremental to only apply the records modified since the last dump
+    parse(xml_file, validate="--validate" in sys.argv[2:],
+          incremental="--incremental" in sys.argv[2:])
     print("Done parsing DBLP")
@@ -2,93 +2,88 @@ import os
 import re
 import sys
 
+from citation_loader import CitationLoader, edge_spills, EdgeSpill, incomplete_edge_spills, read_edge_spill
 from database_manager import DatabaseManager
-from util import iterload_file_lines, iterload_file_lines_gzip
+from parse_corpus import parse_corpus_file, SemanticScholarFormat
+from util import iterload_file_lines, iterload_file_lines_gzip, \
+    iterload_file_lines_zip
 
 
 # from tqdm import tqdm
 
-def parse_semantic_scholar_corpus_file(path, database_path="aip"):
+def parse_semantic_scholar_corpus_file(path, database_path="aip", router=None, byte_range=None, edge_spill_dir=None,
+                                       **database_options):
     # print("Parsing Semantic Scholar")
-    database = DatabaseManager(location=database_path)
-
-    hash, parsed = database.did_parse_file(path)
-    if parsed:
-        return True
-
-    file_iterator_func = iterload_file_lines_gzip if path.endswith(
-        "gz") else iterload_file_lines
-    # print(corpus_file)
-    # The json files contain stacked json objects, which is bad practice. It should be wrapped in a JSON array.
-    # Libraries will throw errors if you attempt to load the file, so now we lazy load each object line by line.
-    publication_iterator = file_iterator_func(path)
-    for publication in publication_iterator:
-        if publication is None:  # Corrupt JSON line possibly. Skip it.
+    # With an edge_spill_dir the citations of the accepted papers are spilled while parsing, see
+    # add_semantic_scholar_cites
+    edge_spill = None
+    if edge_spill_dir is not None:
+        edge_spill = EdgeSpill(edge_spill_dir, path, 0 if byte_range is None else byte_range[0])
+    return parse_corpus_file(path, SemanticScholarFormat(edge_spill), database_path, router=router,
+                             byte_range=byte_range, progress=False, **database_options)
+
+
+def add_semantic_scholar_cites_data(path, database_path="aip",
+                                    **database_options):
+    return add_semantic_scholar_cites([path], database_path,
+                                      **database_options)
+
+
+def add_semantic_scholar_cites(paths, database_path="aip", batch_size=1000000,
+                               edge_spill_dir=None, **database_options):
+    # Resolves the citations of all files against one in-memory map of the
+    # semantic scholar ids, so the publications are read only once.
+    # The citations of a file spilled to the edge_spill_dir while it was
+    # parsed are loaded from the spill files instead of the file, which are
+    # deleted once loaded. Both sides of an edge we can load are papers we
+    # accepted, so the spills hold all edges of the file we are interested in.
+    # A file of which a spill is marked incomplete is read instead, see
+    # EdgeSpill.open.
+    database = DatabaseManager(location=database_path, **database_options)
+    loader = CitationLoader(database.db, batch_size=batch_size)
+
+    spill_files = []
+    for path in paths:
+        spills, incomplete = [], []
+        if edge_spill_dir is not None:
+            spills = edge_spills(edge_spill_dir, path)
+            incomplete = incomplete_edge_spills(edge_spill_dir, path)
+        spill_files.extend(spills + incomplete)
+        if len(spills) > 0 and len(incomplete) == 0:
+            for spill in spills:
+                for edges in read_edge_spill(spill, batch_size):
+                    loader.add_edges(edges["citing"], edges["cited"])
             continue
 
-        if "venue" not in publication or "title" not in publication:  # While parsing we sometimes get KeyError: 'venue'...
-            continue
-
-        # Try to match the publication to a venue we are interested in.
-        # Wrap in str() as it sometimes is an int (???)
-        venue_string = str(publication['venue'])
-        if len(venue_string) == 0:
-            continue
-
-        # Check if any of the venue strings are a substring of the mentioned value, add it to that set.
-        publication_title = publication['title']
-        publication_abstract = publication['paperAbstract']
-        publication_year = publication[
-            'year'] if 'year' in publication else None
-        publication_journal_volume = publication['journalVolume'].replace(" ",
-                                                                          "_")  # Empty for conferences.
-        # publication_keywords = publication['entities']
-        publication_id = publication['id']
-
-        # num_citations = None
-        # if "inCitations" in publication and len(publication["inCitations"]) != 0:
-        #     num_citations = len(publication["inCitations"])
-
-        publication_doi = publication['doi']
-        if publication_doi is None or len(publication_doi) == 0:
-            publication_doi_url = publication['doiUrl']
-            if "doi.org/" in publication_doi_url:
-                publication_doi = publication['doiUrl'][
-                                  publication['doiUrl'].index(
-                                      "doi.org/") + len("doi.org/"):]
-
-        database.update_or_insert_paper(id=publication_id, doi=publication_doi,
-                                        title=publication_title,
-                                        abstract=publication_abstract,
-                                        raw_venue_string=venue_string,
-                                        year=publication_year,
-                                        volume=publication_journal_volume,
-                                        is_semantic=True)
-
-    # database.flush_missing_venues()
-    database.add_parsed_file(hash)
-    database.close()
-    return True
+        file_iterator_func = iterload_file_lines
+        if path.endswith("gz"):
+            file_iterator_func = iterload_file_lines_gzip
+        elif path.endswith("zip"):
+            file_iterator_func = iterload_file_lines_zip
+        publication_iterator = file_iterator_func(path)
 
+        for publication in publication_iterator:
+            if publication is None:  # Corrupt JSON line possibly. Skip it.
+                continue
 
-def add_semantic_scholar_cites_data(path, database_path="aip"):
-    database = DatabaseManager(location=database_path)
-    file_iterator_func = iterload_file_lines_gzip if path.endswith(
-        "gz") else iterload_file_lines
-    publication_iterator = file_iterator_func(path)
+            publication_id = publication['id']
+            in_citations = []
+            out_citations = []
 
-    for publication in publication_iterator:
-        publication_id = publication['id']
-        in_citations = []
-        out_citations = []
+            if "inCitations" in publication:
+                in_citations = publication["inCitations"]
 
-        if "inCitations" in publication:
-            in_citations = publication["inCitations"]
+            if "outCitations" in publication:
+                out_citations = publication["outCitations"]
 
-        if "outCitations" in publication:
-            out_citations = publication["outCitations"]
+            loader.add(publication_id, in_citations, out_citations)
 
-        database.insert_cites(publication_id, in_citations, out_citations)
+    loader.flush()
+    for spill in spill_files:
+        os.remove(spill)
+    if edge_spill_dir is not None and os.path.isdir(edge_spill_dir) \
+            and len(os.listdir(edge_spill_dir)) == 0:
+        os.rmdir(edge_spill_dir)
 
     # TODO: add hashing of the file so that is doesn't re compute already
     #  computed files in case of multiple restarts??
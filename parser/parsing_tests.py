@@ -1,9 +1,35 @@
 from database_manager import DatabaseManager
-from parse_semantic_scholar import parse_semantic_scholar_corpus_file
+from parse_semantic_scholar import parse_semantic_scholar_corpus_file, \
+    add_semantic_scholar_cites, add_semantic_scholar_cites_data
 from parse_aminer import parse_aminer_corpus_file
 from parse_mag import parse_mag_corpus_file
 import renew_data_locally
+import partitioned_ingest
 import parse_dblp
+import lookup_index
+import sanitizer
+import os
+import tempfile
+import shutil
+import zipfile
+from venue_matcher import VenueMatcher
+from util import title_key, iterload_file_lines, LineReader, \
+    iterload_file_lines_gzip, split_lines, iterload, iterload_mapped_lines, \
+    line_ranges, iterload_zip_lines, probe_venue
+import io
+import gzip
+from pipeline import ingest_records, venue_prefilter, PublicationRecord, \
+    parse_record
+from parse_corpus import OagFormat, SemanticScholarFormat
+from itertools import islice
+from fingerprint import FileFingerprint
+from citation_loader import CitationLoader, edge_spills, read_edge_spill, \
+    EdgeSpill, incomplete_edge_spills
+from oag_linkage import load_linkage
+import xxhash
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 database = DatabaseManager(location="aip_test")
 
@@ -140,6 +166,39 @@ def add_citations_test():
     db_cleanup()
 
 
+def citation_loader_test():
+    parse_dblp.parse("test_files/dblp1_test.xml", database_path="aip_test")
+    parse_semantic_scholar_corpus_file("test_files/s2-corpus-000-test",
+                                       database_path="aip_test")
+    add_semantic_scholar_cites_data("test_files/s2-corpus-000-test",
+                                    database_path="aip_test")
+    # The edges are resolved against the semantic scholar ids in memory, an
+    # edge listed by both of its papers is written once
+    cites = [('d9b98accbacb753312f0dc0efb1bd446577670a4',
+              'journals/concurrency/SubhlokNGR18'),
+             ('journals/concurrency/WoodwardJLD09',
+              'd9b98accbacb753312f0dc0efb1bd446577670a4')]
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT paper_id, cited_paper_id FROM cites
+                              ORDER BY paper_id''')
+            assert cursor.fetchall() == cites
+
+    # Flushed in batches of one edge, the edges to unknown papers are dropped
+    loader = CitationLoader(database.db, batch_size=1)
+    loader.add("d9b98accbacb753312f0dc0efb1bd446577670a4",
+               ["06a3c80777b223586052ddddb5f67870dd819043", "unknown"],
+               ["f242df2fd7615820660f6c56e2994fddef076885"])
+    loader.flush()
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT paper_id, cited_paper_id FROM cites
+                              ORDER BY paper_id''')
+            assert cursor.fetchall() == cites
+
+    db_cleanup()
+
+
 def process_data_test():
     renew_data_locally.run(file_locations="test_files", db_name="aip_test")
     # Check if the right amount of words has been added, these
@@ -195,6 +254,1030 @@ def combined_simple_test():
     db_cleanup()
 
 
+def bulk_ingest_test():
+    renew_data_locally.run(file_locations="test_files", db_name="aip_test",
+                           bulk_ingest=True)
+    # Merging the papers in bulk should give exactly the same database as
+    # inserting them one by one, see combined_simple_test
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            res = cursor.fetchone()[0]
+            assert res == 8
+
+            cursor.execute('''SELECT COUNT(*) FROM cites''')
+            res = cursor.fetchone()[0]
+            assert res == 2
+
+            cursor.execute('''SELECT COUNT(*) FROM words''')
+            res = cursor.fetchone()[0]
+            assert res == 216
+
+            cursor.execute(
+                '''SELECT COUNT(*) FROM publications
+                 WHERE semantic_scholar_id IS NOT NULL''')
+            res = cursor.fetchone()[0]
+            assert res == 4
+
+    db_cleanup()
+
+
+def record_transaction_test():
+    # Without batching the authors of a paper are committed with the paper,
+    # not with the next batch of authors
+    manager = DatabaseManager(location="aip_test", author_batch_size=1000)
+    with manager.record_transaction():
+        assert manager.update_or_insert_paper_with_venue(
+            id="a", doi="10.1/a", title="A title", abstract="", venue="ICPE",
+            year=2020, volume="1")
+        manager.add_authors_for_article(authors=[("Author A", None, 0)],
+                                        article_id="a")
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM author_paper_pairs
+                              WHERE paper_id = 'a' ''')
+            assert cursor.fetchone()[0] == 1
+
+    # A failing record is rolled back as a whole
+    try:
+        with manager.record_transaction():
+            manager.update_or_insert_paper_with_venue(
+                id="b", doi="10.1/b", title="B title", abstract="",
+                venue="ICPE", year=2020, volume="1")
+            raise ValueError()
+    except ValueError:
+        pass
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            assert cursor.fetchone()[0] == 1
+    manager.close()
+
+    db_cleanup()
+
+
+def staged_semantic_id_test():
+    # Like when the papers are merged one by one, a paper matched on its
+    # title only sets its semantic scholar id if it fills something in
+    results = []
+    for bulk_ingest in [False, True]:
+        manager = DatabaseManager(location="aip_test", bulk_ingest=bulk_ingest)
+        for id, doi, abstract in [("a", "10.1/a", "text"),
+                                  ("b", "10.1/b", "text"), ("c", None, "")]:
+            manager.insert_new_article(
+                id=id, title="Title " + id, abstract=abstract, doi=doi,
+                venue="ICPE", year=2020, volume="1", is_semantic=False,
+                original_id=None)
+        for id, doi, title in [("s1", None, "Title a"),
+                               ("s2", "10.1/b", "Other"),
+                               ("s3", None, "Title c")]:
+            manager.update_or_insert_paper_with_venue(
+                id=id, doi=doi, title=title, abstract="More text",
+                venue="ICPE", year=2020, volume="1", is_semantic=True)
+        manager.close()
+
+        with database.db:
+            with database.db.cursor() as cursor:
+                cursor.execute('''SELECT id, semantic_scholar_id
+                                  FROM publications ORDER BY id''')
+                results.append(cursor.fetchall())
+        db_cleanup()
+
+    assert results[0] == results[1] == \
+        [("a", None), ("b", "s2"), ("c", "s3")]
+
+
+def staged_batch_test():
+    # A batch of the size of a real flush, with repeated titles and DOIs, is
+    # merged like the papers would be one by one and without a quadratic
+    # self-join, which takes minutes at this size
+    n = 20000
+    papers = [("p%d" % i, "10.1/%d" % (i // 2),
+               "Title %d" % (i % (n - n // 7))) for i in range(n)]
+    dois, titles, expected = set(), set(), set()
+    for id, doi, title in papers:
+        if doi not in dois and title not in titles:
+            expected.add(id)
+            dois.add(doi)
+            titles.add(title)
+
+    manager = DatabaseManager(location="aip_test", bulk_ingest=True,
+                              bulk_batch_size=n + 1)
+    for id, doi, title in papers:
+        manager.update_or_insert_paper_with_venue(
+            id=id, doi=doi, title=title, abstract="text", venue="ICPE",
+            year=2020, volume="1")
+    start = time.time()
+    manager.flush_bulk_ingest()
+    assert time.time() - start < 30
+    manager.close()
+
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT id FROM publications''')
+            assert {id for id, in cursor.fetchall()} == expected
+
+    db_cleanup()
+
+
+def lookup_index_test():
+    index = lookup_index.PublicationIndex()
+    index.add(id="a", doi=None, title="Some title", abstract="")
+
+    # Unknown titles are inserted, papers without an abstract or DOI are not
+    assert index.classify(doi=None, title="Other title", abstract="text",
+                          is_semantic=False) == lookup_index.INSERT
+    assert index.classify(doi=None, title="Other title", abstract="",
+                          is_semantic=False) == lookup_index.SKIP
+
+    # The publication lacks an abstract and a DOI, so it can be complemented
+    assert index.classify(doi="10.1/x", title="Some title", abstract="",
+                          is_semantic=False) == lookup_index.FILL_IN
+    index.fill_in(doi="10.1/x", title="Some title", abstract="")
+
+    # Now the DOI matches, but only an abstract can still be added
+    assert index.classify(doi="10.1/x", title="Unrelated", abstract="",
+                          is_semantic=False) == lookup_index.SKIP
+    assert index.classify(doi="10.1/x", title="Unrelated", abstract="text",
+                          is_semantic=False) == lookup_index.FILL_IN
+
+    # Keys added after the initial load survive merging into the arrays
+    index.doi_table.merge()
+    index.title_table.merge()
+    assert index.classify(doi="10.1/x", title="Unrelated", abstract="",
+                          is_semantic=False) == lookup_index.SKIP
+    assert len(index) == 1
+
+    renew_data_locally.run(file_locations="test_files", db_name="aip_test",
+                           use_lookup_index=True)
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            res = cursor.fetchone()[0]
+            assert res == 8
+
+    # Loaded in batches straight into the arrays
+    index = lookup_index.PublicationIndex.from_database(database.db,
+                                                        batch_size=3)
+    assert len(index) == 8
+    assert (str(index.id_table.keys.dtype), str(index.flags.dtype)) == \
+        ("uint64", "uint8")
+    assert index.classify(doi="10.1145/2103656.2103661", title="Unrelated",
+                          abstract="text", is_semantic=False) == \
+        lookup_index.SKIP
+    assert index.classify(doi=None, title="Ferroresonance", abstract="text",
+                          is_semantic=False) == lookup_index.FILL_IN
+
+    # An insert of the same title by another worker holds the lock of the
+    # title until it commits, the insert waits for it and finds the paper
+    worker = DatabaseManager(location="aip_test")
+    with database.db.cursor() as cursor:
+        cursor.execute(
+            '''SELECT pg_advisory_xact_lock(%s);
+            INSERT INTO publications (id, venue, year, volume, title,
+                                      title_key, abstract)
+            VALUES ('x', 'ICPE', 2020, '1', 'Guarded', %s, 'text');''',
+            [title_key("Guarded")] * 2)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        inserted = executor.submit(
+            worker.insert_new_article_if_unmatched, id="y", title="Guarded",
+            abstract="text", doi=None, venue="ICPE", year=2020, volume="1",
+            is_semantic=False)
+        time.sleep(0.5)
+        assert not inserted.done()
+        database.db.commit()
+        assert not inserted.result()
+    worker.close()
+
+    db_cleanup()
+
+
+def unit_of_work_test():
+    batched = DatabaseManager(location="aip_test", commit_records=100)
+    batched.update_or_insert_paper(id="a", doi="10.1/a", title="First",
+                                   abstract="", raw_venue_string="ICDCS",
+                                   year=2020, volume=None)
+
+    # A failing record is rolled back to its savepoint, the batch survives
+    batched.begin_record()
+    failed = False
+    try:
+        batched.insert_new_article(id="a", title="Duplicate", abstract="",
+                                   doi=None, venue="ICDCS", year=2020,
+                                   volume=None, is_semantic=False,
+                                   original_id="a")
+    except Exception:
+        failed = True
+    assert failed
+
+    batched.update_or_insert_paper(id="b", doi="10.1/b", title="Second",
+                                   abstract="", raw_venue_string="ICDCS",
+                                   year=2020, volume=None)
+
+    # Nothing is visible to other connections before the batch is committed
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            assert cursor.fetchone()[0] == 0
+
+    batched.close()
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT id FROM publications ORDER BY id''')
+            assert cursor.fetchall() == [("a",), ("b",)]
+
+    db_cleanup()
+
+
+def author_resolver_test():
+    resolver = DatabaseManager(location="aip_test", author_batch_size=100)
+    resolver.update_or_insert_paper(id="a", doi="10.1/a", title="First",
+                                    abstract="", raw_venue_string="ICDCS",
+                                    year=2020, volume=None)
+    resolver.update_or_insert_paper(id="b", doi="10.1/b", title="Second",
+                                    abstract="", raw_venue_string="ICDCS",
+                                    year=2020, volume=None)
+
+    # Authors created earlier in the batch are matched by the ones after it
+    resolver.add_authors_for_article(
+        authors=[("Alice", "0000-1", 0), ("Bob", None, 1),
+                 ("Bob", None, 2)], article_id="a")
+    resolver.add_authors_for_article(
+        authors=[("Alice B.", "0000-1", 0), ("Bob", None, 1)],
+        article_id="b")
+    resolver.close()
+
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT name, orcid FROM authors ORDER BY id''')
+            assert cursor.fetchall() == [("Alice", "0000-1"), ("Bob", None)]
+            cursor.execute('''SELECT a.name, p.paper_id, p.author_position
+                              FROM author_paper_pairs p
+                              JOIN authors a ON a.id = p.author_id
+                              ORDER BY p.paper_id, p.author_position''')
+            assert cursor.fetchall() == [("Alice", "a", 0), ("Bob", "a", 1),
+                                         ("Alice", "b", 0), ("Bob", "b", 1)]
+
+    db_cleanup()
+
+
+def sanitizer_test():
+    strings = ["A Survey", "  Leading whitespace", " ", "",
+               "Fast <i>in situ</i> analysis", "CO<sub>2</sub> &amp; H<sub>2",
+               "n < 10 &lt; m", "AT&T &x; &amp", "<p>One</p><p>Two</p>",
+               "<script>x</script>Text", "<i>x</i> ", "Control\x01",
+               "&#39;quoted&#x27;"]
+    # The fast paths give the same result as cleaning every string with lxml
+    for string in strings:
+        assert sanitizer.sanitize_string(string) == \
+            sanitizer.sanitize_html(string)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert sanitizer.sanitize_batch(strings, executor, chunk_size=2) == \
+            [sanitizer.sanitize_html(string) for string in strings]
+
+
+def venue_matcher_test():
+    strings = ["ICDCS", "International Conference on Distributed Computing "
+               "Systems, 2019", "Unknown Venue", " Unknown Venue ", "CVPR (1)"]
+    cache_path = os.path.join(tempfile.mkdtemp(), "venues.sqlite")
+
+    matcher = VenueMatcher(cache_size=2, cache_path=cache_path)
+    assert [matcher.match(s) for s in strings] == \
+        ["ICDCS", "ICDCS", None, None, "CVPR"]
+    # Strings that only differ in surrounding whitespace are memoized as one,
+    # unknown venues included
+    assert matcher.stats["memo_hits"] == 1
+    assert matcher.unknown_counts == {"Unknown Venue": 2}
+    matcher.close()
+
+    # A new matcher, e.g. of another worker, finds the matches on disk
+    matcher = VenueMatcher(cache_path=cache_path)
+    assert [matcher.match(s) for s in strings] == \
+        ["ICDCS", "ICDCS", None, None, "CVPR"]
+    assert matcher.stats["misses"] == 0
+    matcher.close()
+
+
+def title_key_test():
+    db = DatabaseManager(location="aip_test")
+    db.update_or_insert_paper(id="a", doi="", title="Scheduling in the Cloud.",
+                              abstract="An abstract", raw_venue_string="ICDCS",
+                              year=2020, volume=None)
+    # Case, punctuation and encoded characters do not prevent a match
+    db.update_or_insert_paper(id="b", doi="10.1/a",
+                              title="scheduling  in the&nbsp;cloud",
+                              abstract="Another", raw_venue_string="ICDCS",
+                              year=2020, volume=None)
+    db.close()
+
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT id, doi, abstract FROM publications''')
+            assert cursor.fetchall() == [("a", "10.1/a", "An abstract")]
+
+            # Existing rows get their key when the schema is updated
+            cursor.execute(
+                '''ALTER TABLE publications DROP COLUMN title_key''')
+            cursor.execute(
+                '''ALTER TABLE parsed_files DROP COLUMN size,
+                 DROP COLUMN mtime_ns, DROP COLUMN sample_hash''')
+            cursor.execute('''DROP TABLE ingest_checkpoints''')
+            cursor.execute('''ALTER TABLE properties DROP COLUMN dblp_mdate''')
+            cursor.execute('''UPDATE properties SET db_schema_version = 10''')
+
+    DatabaseManager(location="aip_test").close()
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT title_key FROM publications''')
+            assert cursor.fetchall() == \
+                [(title_key("Scheduling in the Cloud."),)]
+
+    db_cleanup()
+
+
+def shared_connection_test():
+    # A closed manager hands its connection to the next one
+    first = DatabaseManager(location="aip_test")
+    connection = first.db
+    first.close()
+    second = DatabaseManager(location="aip_test")
+    assert second.db is connection
+    second.close()
+
+    shared = DatabaseManager.get_shared("aip_test")
+    assert DatabaseManager.get_shared("aip_test") is shared
+    shared.close()
+    assert DatabaseManager.get_shared("aip_test") is not shared
+
+
+def partitioned_ingest_test():
+    # The DOI decides the partition if there is one, else the title
+    assert partitioned_ingest.partition_of("10.1/X ", "a", 4) == \
+        partitioned_ingest.partition_of("10.1/x", "b", 4)
+    assert partitioned_ingest.partition_of(None, "Some Title.", 4) == \
+        partitioned_ingest.partition_of("", "some title", 4)
+
+    # Routing the papers to their owners should give the same database as
+    # parsing the files in parallel, see combined_simple_test
+    renew_data_locally.run(file_locations="test_files", db_name="aip_test",
+                           partitions=2)
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            res = cursor.fetchone()[0]
+            assert res == 8
+
+            cursor.execute('''SELECT COUNT(*) FROM cites''')
+            res = cursor.fetchone()[0]
+            assert res == 2
+
+            cursor.execute('''SELECT COUNT(*) FROM words''')
+            res = cursor.fetchone()[0]
+            assert res == 216
+
+            cursor.execute('''SELECT COUNT(*) FROM parsed_files''')
+            res = cursor.fetchone()[0]
+            assert res == 4
+
+    db_cleanup()
+
+
+def fingerprint_test():
+    path = "test_files/mag_papers_0_test.txt"
+    with open(path, "rb") as f:
+        content_hash = xxhash.xxh32(f.read()).intdigest()
+
+    # The content hash is computed on the bytes the parser reads
+    fingerprint = FileFingerprint(path)
+    assert len(list(iterload_file_lines(path, fingerprint.open()))) > 0
+    assert fingerprint.full_hash() == content_hash
+    # Also if the parser stops before the end of the file
+    fingerprint = FileFingerprint(path)
+    next(iterload_file_lines(path, fingerprint.open()))
+    assert fingerprint.full_hash() == content_hash
+    assert FileFingerprint(path).sample_hash == fingerprint.sample_hash
+
+    db = DatabaseManager(location="aip_test")
+    fingerprint, parsed = db.did_parse_file(path)
+    assert not parsed
+    db.add_parsed_file(fingerprint)
+    assert db.did_parse_file(path)[1]
+
+    # Files parsed before the fingerprints are only recognized by their
+    # content if asked for, new files are not hashed completely for them
+    with db.db:
+        with db.db.cursor() as cursor:
+            cursor.execute('''UPDATE parsed_files SET hash = %s, size = NULL,
+                             mtime_ns = NULL, sample_hash = NULL''',
+                           [content_hash])
+    fingerprint, parsed = db.did_parse_file(path)
+    assert not parsed and fingerprint.hash is None
+    db.close()
+    db = DatabaseManager(location="aip_test", verify_full_hash=True)
+    assert db.did_parse_file(path)[1]
+    with db.db:
+        with db.db.cursor() as cursor:
+            cursor.execute('''SELECT hash, size FROM parsed_files''')
+            assert cursor.fetchall() == [(content_hash, os.path.getsize(path))]
+    db.close()
+
+    db_cleanup()
+
+
+def checkpoint_test():
+    path = "test_files/mag_papers_0_test.txt"
+    with open(path, "rb") as f:
+        first_line = len(f.readline())
+
+    # Commit the first record of the file only, as if the parser crashed
+    db = DatabaseManager(location="aip_test", commit_records=10)
+    fingerprint, parsed = db.did_parse_file(path)
+    reader = LineReader(path, fingerprint, db.resume_point(fingerprint))
+    ingest_records(db, islice(reader, 1), OagFormat(path), reader=reader)
+    db.commit_batch()
+    db.close()
+
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT position, line FROM ingest_checkpoints''')
+            assert cursor.fetchall() == [(first_line, 1)]
+
+    # The next run continues after the first record and drops the checkpoint.
+    # The lines before it are not read, the content is only hashed when asked.
+    fingerprint = FileFingerprint(path)
+    assert len(list(LineReader(path, fingerprint, (first_line, 1, 0)))) == 3
+    assert fingerprint.read_hash() is None
+    with open(path, "rb") as f:
+        assert fingerprint.full_hash() == xxhash.xxh32(f.read()).intdigest()
+    parse_mag_corpus_file(path, database_path="aip_test")
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            assert cursor.fetchone()[0] == 2
+            cursor.execute('''SELECT COUNT(*) FROM ingest_checkpoints''')
+            assert cursor.fetchone()[0] == 0
+            cursor.execute('''SELECT COUNT(*) FROM parsed_files''')
+            assert cursor.fetchone()[0] == 1
+
+    db_cleanup()
+
+
+def gzip_reader_test():
+    lines = ['{"title": "Caf\u00e9"}', '{"title": "Café"}',
+             "{'title': 'literal'}", '{"title": ', '{"title": "last"}']
+    path = os.path.join(tempfile.mkdtemp(), "s2-corpus-000.gz")
+    with gzip.open(path, "wb") as f:
+        f.write("\n".join(lines).encode("utf-8"))
+
+    # UTF-8 is decoded as such, corrupt lines are skipped
+    assert [record["title"] for record in iterload_file_lines_gzip(path)] == \
+        ["Café", "Café", "literal", "last"]
+    # Lines can span the chunks
+    assert list(split_lines([b"a\nb", b"c", b"\nd"])) == \
+        [b"a\n", b"bc\n", b"d"]
+
+    # Stopping early does not wait for the rest of the file
+    records = iterload_file_lines_gzip(path)
+    next(records)
+    records.close()
+
+
+def iterload_test():
+    data = '{"a": 1}\n{"b": 2, oops}\n{"c":\n{"d": 3}}{"e": "\u00e9"}\n[4]'
+    # The same values and skipped ranges for every chunk size
+    for chunk_size in [1, 4, 1024]:
+        skipped = []
+        values = list(iterload(io.BytesIO(data.encode("utf-8")),
+                               chunk_size=chunk_size, skipped=skipped))
+        assert values == [{"a": 1}, None, {"c": {"d": 3}}, {"e": "\u00e9"},
+                          [4]]
+        assert skipped == [(9, 24)]
+
+    assert list(iterload('{"a": 1} {"b": "unterminated')) == [{"a": 1}, None]
+
+
+def mapped_lines_test():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "aminer_papers_0.txt")
+    with open(path, "wb") as f:
+        f.write(b'{"a": 1}\r\n\n{"b": "\xc3\xa9"}')
+
+    # Every line with the offset after it, the last line has no newline
+    lines = [(end, bytes(line)) for end, line in iterload_mapped_lines(path)]
+    assert lines == [(10, b'{"a": 1}\r\n'), (11, b"\n"),
+                     (22, b'{"b": "\xc3\xa9"}')]
+    assert list(iterload_file_lines(path)) == [{"a": 1}, {"b": "\u00e9"}]
+    assert [end for end, _ in iterload_mapped_lines(path, 10)] == [11, 22]
+
+    empty = os.path.join(directory, "empty.txt")
+    open(empty, "wb").close()
+    assert list(iterload_mapped_lines(empty)) == []
+
+
+def chunked_ingest_test():
+    # The ranges cover the file and start at the start of a line
+    path = "test_files/mag_papers_0_test.txt"
+    ranges = line_ranges(path, 500)
+    assert ranges == [(0, 1031), (1031, 1966)]
+    assert ranges[-1][1] == os.path.getsize(path)
+    with open(path, "rb") as file:
+        file.seek(ranges[1][0] - 1)
+        assert file.read(1) == b"\n"
+
+    # Parsing the files in ranges should give the same database as parsing
+    # them whole, see combined_simple_test
+    renew_data_locally.run(file_locations="test_files", db_name="aip_test",
+                           chunk_size=500)
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            res = cursor.fetchone()[0]
+            assert res == 8
+
+            cursor.execute('''SELECT COUNT(*) FROM words''')
+            res = cursor.fetchone()[0]
+            assert res == 216
+
+            # The ranges of the files are replaced by the files
+            cursor.execute('''SELECT COUNT(*) FROM parsed_files''')
+            res = cursor.fetchone()[0]
+            assert res == 4
+
+            # The split files are not hashed completely, like the DBLP dump
+            # that is parsed in chunks
+            cursor.execute('''SELECT size FROM parsed_files
+                              WHERE hash IS NULL''')
+            res = sorted(size for (size,) in cursor.fetchall())
+            assert res == sorted(os.path.getsize(os.path.join("test_files",
+                                                              name))
+                                 for name in os.listdir("test_files")
+                                 if name != "dblp.dtd")
+
+            cursor.execute('''SELECT COUNT(*) FROM ingest_checkpoints''')
+            res = cursor.fetchone()[0]
+            assert res == 0
+
+    db_cleanup()
+
+
+def archive_ingest_test():
+    # The sources as they are downloaded: DBLP gzipped, Aminer zipped and
+    # semantic scholar gzipped. The MAG archive was extracted already, so
+    # only the extracted file is parsed.
+    directory = tempfile.mkdtemp()
+    shutil.copy("test_files/dblp.dtd", directory)
+    with open("test_files/dblp1_test.xml", "rb") as source, \
+            gzip.open(os.path.join(directory, "dblp.xml.gz"), "wb") as file:
+        shutil.copyfileobj(source, file)
+    with open("test_files/s2-corpus-000-test", "rb") as source, \
+            gzip.open(os.path.join(directory, "s2-corpus-000.gz"),
+                      "wb") as file:
+        shutil.copyfileobj(source, file)
+    with zipfile.ZipFile(os.path.join(directory, "aminer_papers_0.zip"),
+                         "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write("test_files/aminer_papers_0_test.txt",
+                      "aminer_papers_0.txt")
+    with zipfile.ZipFile(os.path.join(directory, "mag_papers_0.zip"),
+                         "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write("test_files/mag_papers_0_test.txt",
+                      "mag_papers_0.txt")
+    shutil.copy("test_files/mag_papers_0_test.txt",
+                os.path.join(directory, "mag_papers_0.txt"))
+
+    lines = list(iterload_zip_lines(
+        os.path.join(directory, "aminer_papers_0.zip")))
+    with open("test_files/aminer_papers_0_test.txt", "rb") as file:
+        assert lines == file.readlines()
+
+    # The same database as when parsing the extracted files, see
+    # combined_simple_test
+    renew_data_locally.run(file_locations=directory, db_name="aip_test")
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            res = cursor.fetchone()[0]
+            assert res == 8
+
+            cursor.execute('''SELECT COUNT(*) FROM authors''')
+            res = cursor.fetchone()[0]
+            assert res == 8
+
+            cursor.execute('''SELECT COUNT(*) FROM cites''')
+            res = cursor.fetchone()[0]
+            assert res == 2
+
+            cursor.execute('''SELECT COUNT(*) FROM words''')
+            res = cursor.fetchone()[0]
+            assert res == 216
+
+            cursor.execute('''SELECT size FROM parsed_files''')
+            res = sorted(size for (size,) in cursor.fetchall())
+            names = ["dblp.xml.gz", "s2-corpus-000.gz", "aminer_papers_0.zip",
+                     "mag_papers_0.txt"]
+            assert res == sorted(os.path.getsize(os.path.join(directory, name))
+                                 for name in names)
+
+    shutil.rmtree(directory)
+    db_cleanup()
+
+
+def dblp_stream_test():
+    # Records of other tags in between and an entity from the DTD
+    dtd = os.path.abspath("test_files/dblp.dtd")
+    xml = ('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+           '<!DOCTYPE dblp SYSTEM "{0}">\n<dblp>\n'.format(dtd))
+    for i in range(5):
+        xml += ('<www key="homepages/{0}"><author>A</author>'
+                '<title>Home Page</title></www>\n'
+                '<article key="journals/x/{0}"><author>J&uuml;rgen</author>'
+                '<title>Paper {0}.</title><year>2020</year>'
+                '<journal>J</journal></article>\n'.format(i))
+    xml += '</dblp>\n'
+
+    keys = []
+    for element in parse_dblp.iter_records(io.BytesIO(xml.encode())):
+        keys.append(element.get("key"))
+        # The records before are freed
+        assert element.getprevious() is None
+        assert element.findtext("author") == "J\u00fcrgen"
+    assert keys == ["journals/x/{0}".format(i) for i in range(5)]
+
+    # The validating parser reads the same records
+    path = "test_files/dblp1_test.xml"
+    with open(path, "rb") as file:
+        streamed = [(element.get("key"), element.findtext("title"))
+                    for element in parse_dblp.iter_records(file)]
+    with open(path, "rb") as file:
+        validated = [(element.get("key"), element.findtext("title"))
+                     for element in parse_dblp.iter_records(file, True)]
+    assert streamed == validated and len(streamed) == 3
+
+    parse_dblp.parse(path, database_path="aip_test", validate=True)
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            res = cursor.fetchone()[0]
+            assert res == 2
+
+            cursor.execute('''SELECT COUNT(*) FROM authors''')
+            res = cursor.fetchone()[0]
+            assert res == 8
+
+    db_cleanup()
+
+
+def dblp_chunks_test():
+    # Every chunk starts at a record and the chunks cover all records
+    path = "test_files/dblp1_test.xml"
+    header, ranges = parse_dblp.split_dump(path, 200)
+    assert header.endswith(b"<dblp>")
+    assert os.path.abspath("test_files/dblp.dtd").encode() in header
+    with open(path, "rb") as file:
+        data = file.read()
+    assert [data[start:end].lstrip().startswith(b"<article")
+            for start, end in ranges] == [True] * 3
+    assert data[ranges[-1][1]:] == b"</dblp>\n"
+
+    # The chunks give the same records in the same order as the dump
+    chunked = list(parse_dblp.iter_parsed_chunks(path, 2, 200))
+    with open(path, "rb") as file:
+        serial = [(element.get("key"), parse_dblp._parse_record(element))
+                  for element in parse_dblp.iter_records(file)]
+    assert [(key, record) for _, _, records in chunked
+            for key, _, record in records] == serial
+
+    parse_dblp.parse(path, database_path="aip_test", jobs=2, chunk_size=200)
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM publications''')
+            res = cursor.fetchone()[0]
+            assert res == 2
+
+            cursor.execute('''
+            SELECT author_position FROM author_paper_pairs''')
+            res = [pos for app in cursor.fetchall() for pos in app]
+            assert res == [1, 2, 3, 4, 1, 2, 3, 4]
+
+            cursor.execute('''SELECT COUNT(*) FROM parsed_files''')
+            res = cursor.fetchone()[0]
+            assert res == 1
+
+    db_cleanup()
+
+
+def dblp_resume_test():
+    # A crash after the first chunk, of the first record: the parse starts
+    # at the second chunk
+    path = "test_files/dblp1_test.xml"
+    _, ranges = parse_dblp.split_dump(path, 200)
+    fingerprint = FileFingerprint(path)
+    db = DatabaseManager(location="aip_test")
+    with db.db:
+        with db.db.cursor() as cursor:
+            cursor.execute('''INSERT INTO ingest_checkpoints (size, mtime_ns,
+                              sample_hash, range_start, position, line,
+                              records, last_modified)
+                              VALUES (%s, %s, %s, 0, %s, 0, 0, now())''',
+                           [fingerprint.size, fingerprint.mtime_ns,
+                            fingerprint.sample_hash, ranges[1][0]])
+    db.close()
+
+    parse_dblp.parse(path, database_path="aip_test", chunk_size=200)
+    with database.db:
+        with database.db.cursor() as cursor:
+            # The record of the first chunk is not written
+            cursor.execute('''SELECT id FROM publications''')
+            res = cursor.fetchall()
+            assert res == [("journals/concurrency/SubhlokNGR18",)]
+
+            # The dump was not read from its start, so it is known by its
+            # fingerprint only
+            cursor.execute('''SELECT hash, size FROM parsed_files''')
+            res = cursor.fetchall()
+            assert res == [(None, fingerprint.size)]
+
+    db_cleanup()
+
+
+def dblp_incremental_test():
+    path = "test_files/dblp1_test.xml"
+    parse_dblp.parse(path, database_path="aip_test")
+    assert database.dblp_mdate() == "2020-06-25"
+
+    # The next dump: an old record changed without a new mdate, which is not
+    # applied, a record changed with a new mdate, which is applied as a
+    # whole, and a new record
+    directory = tempfile.mkdtemp()
+    shutil.copy("test_files/dblp.dtd", directory)
+    with open(path, "rb") as file:
+        xml = file.read()
+    xml = xml.replace(b"First experience", b"Second experience")
+    xml = xml.replace(b"cpe.1494", b"cpe.1495")
+    xml = xml.replace(b'mdate="2020-03-02" key="journals/concurrency/Subhlok',
+                      b'mdate="2020-06-30" key="journals/concurrency/Subhlok')
+    xml = xml.replace(b"volunteer PC grids", b"volunteer grids")
+    xml = xml.replace(b"<year>2018</year>", b"<year>2019</year>")
+    xml = xml.replace(b"<author>Edgar Gabriel</author>\n", b"")
+    xml = xml.replace(b"</dblp>", b'''<article mdate="2020-07-01" key="x/y">
+<author>Paul R. Woodward</author>
+<title>A new article.</title>
+<year>2020</year>
+<journal>Concurr. Comput. Pract. Exp.</journal>
+<ee>https://doi.org/10.1002/cpe.9999</ee>
+</article>
+</dblp>''')
+    with open(os.path.join(directory, "dblp.xml"), "wb") as file:
+        file.write(xml)
+
+    parse_dblp.parse(os.path.join(directory, "dblp.xml"),
+                     database_path="aip_test", incremental=True)
+    assert database.dblp_mdate() == "2020-07-01"
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT id FROM publications ORDER BY id''')
+            res = [id for (id,) in cursor.fetchall()]
+            assert res == ["journals/concurrency/SubhlokNGR18",
+                           "journals/concurrency/WoodwardJLD09", "x/y"]
+
+            cursor.execute('''SELECT title, year, doi FROM publications
+                              WHERE id LIKE 'journals/%' ORDER BY id''')
+            res = cursor.fetchall()
+            assert res == [("Resilient parallel computing on volunteer grids",
+                            2019, "10.1002/cpe.4478"),
+                           ("First experience of compressible gas dynamics "
+                            "simulation on the Los Alamos roadrunner machine",
+                            2009, "10.1002/cpe.1494")]
+
+            cursor.execute('''SELECT author_position FROM author_paper_pairs
+                              WHERE paper_id =
+                              'journals/concurrency/SubhlokNGR18'
+                              ORDER BY author_position''')
+            res = [position for (position,) in cursor.fetchall()]
+            assert res == [1, 2, 3]
+
+            cursor.execute('''SELECT COUNT(*) FROM authors''')
+            res = cursor.fetchone()[0]
+            assert res == 8
+
+    shutil.rmtree(directory)
+    db_cleanup()
+
+
+def venue_probe_test():
+    # The regular forms are read from the bytes, also with escapes
+    assert probe_venue(b'{"title": "T", "venue": "IC\\u00e9"}') == "ICé"
+    assert probe_venue(b'{"title": "T", "venue": {"raw": "A\\"B"}}') == 'A"B'
+    # A line is searched in place, within its offsets
+    line = b'{"venue": "B"}\n{"title": "T", "venue": "A"}\n{"title": "T"}'
+    assert probe_venue(line, 15, 44) == "A"
+    assert probe_venue(line, 0, 15) is None
+    # A quoted key in a string is escaped, so it is not a key
+    assert probe_venue(b'{"title": "\\"venue\\": \\"A\\"", "venue": "B"}') \
+        == "B"
+    # The others have to be decoded
+    assert probe_venue(b'{"title": "T", "venue": 12}') is None
+    assert probe_venue(b'{"title": "T", "venue": {"id": 1, "raw": "A"}}') \
+        is None
+    assert probe_venue(b'{"title": "T", "venue": "A", "x": {"venue": "B"}}') \
+        is None
+    assert probe_venue(b'{"venue": "A"}') is None
+
+    # The lines of other venues are not decoded, but still counted
+    class Venues(object):
+        resolved = 0
+
+        def resolve_venue(self, raw_venue_string):
+            self.resolved += 1
+            return "ICPE" if raw_venue_string == "ICPE" else None
+
+    path = os.path.join(tempfile.mkdtemp(), "s2-corpus-000")
+    with open(path, "wb") as file:
+        file.write(b'{"title": "T", "venue": "ICPE", "id": 1}\n'
+                   b'{"title": "T", "venue": "Other", "id": 2}\n'
+                   b'{"title": "T", "venue": {"id": 4, "raw": ""}, "id": 3}\n'
+                   b'{"title": "T", "venue": "", "id": 4}\n')
+    venues = Venues()
+    reader = LineReader(path, FileFingerprint(path),
+                        keep=venue_prefilter(venues, OagFormat(path)))
+    records = [(record, reader.venue) for record in reader]
+    assert [None if record is None else record["id"]
+            for record, _ in records] == [1, None, 3, None]
+    assert reader.line == 4 and reader.position == os.path.getsize(path)
+
+    # The venue resolved by the probe is carried into the publication
+    assert [venue for _, venue in records] == ["ICPE", None, None, None]
+    assert venues.resolved == 3
+    publication = parse_record(venues, records[0][0], OagFormat(path),
+                               records[0][1])
+    assert publication.venue == "ICPE" and venues.resolved == 3
+
+    # Like for the decoded records, an empty venue is resolved and counted
+    # for the OAG files but not for Semantic Scholar
+    line = b'{"title": "T", "venue": "", "id": 4}'
+    venues = Venues()
+    assert venue_prefilter(venues, SemanticScholarFormat())(line, 0, None) \
+        is None
+    assert venues.resolved == 0
+
+
+def corpus_format_test():
+    # Both sources end up as the same record, the DOI taken from a link
+    oag = OagFormat("aminer_papers_0.txt")
+    record = {"id": "1", "title": "A title.", "venue": {"raw": "ICPE"},
+              "url": ["https://example.com", "https://doi.org/10.1/a"]}
+    assert oag.raw_venue(record) == "ICPE"
+    publication = oag.publication(record, "ICPE")
+    assert isinstance(publication, PublicationRecord)
+    assert (publication.doi, publication.title, publication.abstract) == \
+        ("10.1/a", "A title", "")
+    assert not hasattr(publication, "__dict__")
+
+    s2 = SemanticScholarFormat()
+    record = {"id": "2", "title": "A title.", "venue": "", "doi": "",
+              "doiUrl": "https://doi.org/10.1/b", "paperAbstract": "",
+              "journalVolume": "1 2"}
+    assert s2.raw_venue(record) is None
+    publication = s2.publication(record, "ICPE")
+    assert (publication.doi, publication.volume, publication.is_semantic) \
+        == ("10.1/b", "1_2", True)
+
+
+def citation_spill_test():
+    # The citations are spilled while parsing, the corpus file is not read
+    # again to load them
+    directory = tempfile.mkdtemp()
+    spill_dir = os.path.join(directory, "edges")
+    path = os.path.join(directory, "s2-corpus-000")
+    shutil.copy("test_files/s2-corpus-000-test", path)
+    parse_dblp.parse("test_files/dblp1_test.xml", database_path="aip_test")
+    parse_semantic_scholar_corpus_file(path, database_path="aip_test",
+                                       edge_spill_dir=spill_dir)
+
+    spills = edge_spills(spill_dir, path)
+    assert len(spills) == 1
+    edges = [edge for batch in read_edge_spill(spills[0]) for edge in batch]
+    paper = bytes.fromhex("d9b98accbacb753312f0dc0efb1bd446577670a4")
+    assert len(edges) > 0
+    assert any(paper in (citing, cited) for citing, cited in edges)
+
+    open(path, "w").close()
+    add_semantic_scholar_cites([path], "aip_test", edge_spill_dir=spill_dir)
+    with database.db:
+        with database.db.cursor() as cursor:
+            # The same citations as in add_citations_test
+            cursor.execute('''SELECT COUNT(*) FROM cites''')
+            res = cursor.fetchone()[0]
+            assert res == 2
+
+    assert len(edge_spills(spill_dir, path)) == 0
+    shutil.rmtree(directory)
+    db_cleanup()
+
+
+def citation_spill_resume_test():
+    # A parse that resumes without the spill of the parse before marks the
+    # spills of the file incomplete, the citations are read from the file
+    directory = tempfile.mkdtemp()
+    spill_dir = os.path.join(directory, "edges")
+    path = os.path.join(directory, "s2-corpus-000")
+    shutil.copy("test_files/s2-corpus-000-test", path)
+    parse_dblp.parse("test_files/dblp1_test.xml", database_path="aip_test")
+    parse_semantic_scholar_corpus_file(path, database_path="aip_test")
+
+    complete = EdgeSpill(spill_dir, path, 0)
+    complete.open(resumed=False)
+    complete.close()
+    resumed = EdgeSpill(spill_dir, path, 100)
+    resumed.open(resumed=True)
+    resumed.add("d9b98accbacb753312f0dc0efb1bd446577670a4", [], [])
+    resumed.close()
+    assert len(edge_spills(spill_dir, path)) == 1
+    assert len(incomplete_edge_spills(spill_dir, path)) == 1
+
+    add_semantic_scholar_cites([path], "aip_test", edge_spill_dir=spill_dir)
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT COUNT(*) FROM cites''')
+            res = cursor.fetchone()[0]
+            assert res == 2
+
+    assert not os.path.exists(spill_dir)
+    shutil.rmtree(directory)
+    db_cleanup()
+
+
+def oag_linkage_test():
+    # A MAG paper linked to an AMiner paper fills it in, even though its
+    # title differs, instead of being inserted as a new publication
+    directory = tempfile.mkdtemp()
+    for name in ["dblp1_test.xml", "dblp.dtd", "aminer_papers_0_test.txt"]:
+        shutil.copy(os.path.join("test_files", name), directory)
+    mag_path = os.path.join(directory, "mag_papers_0.txt")
+    linkage_path = os.path.join(directory, "paper_linking_pairs.txt")
+    venue = {"raw": "IBM Journal of Research and Development"}
+    with open(mag_path, "w") as file:
+        file.write(json.dumps({"id": "2000000001", "title": "Ferro-resonance",
+                               "venue": venue, "abstract": "Linked."}) + "\n")
+        file.write(json.dumps({"id": "2000000002", "title": "Flash-Print",
+                               "venue": venue,
+                               "abstract": "Not linked."}) + "\n")
+    with open(linkage_path, "w") as file:
+        file.write(json.dumps({"mid": "2000000001",
+                               "aid": "53e99784b7602d9701f3f72f"}) + "\n")
+        # The AMiner paper is not in the database, the link is not kept
+        file.write(json.dumps({"mid": "2000000002",
+                               "aid": "53e99784b7602d9701f3f731"}) + "\n")
+
+    for options in [{}, {"bulk_ingest": True}, {"use_lookup_index": True}]:
+        aminer_path = os.path.join(directory, "aminer_papers_0_test.txt")
+        parse_aminer_corpus_file(aminer_path, database_path="aip_test",
+                                 **options)
+        linkage = load_linkage(linkage_path, database)
+        assert len(linkage) == 1
+        assert linkage.aminer_id("2000000001") == "53e99784b7602d9701f3f72f"
+        assert linkage.aminer_id("2000000002") is None
+
+        parse_mag_corpus_file(mag_path, database_path="aip_test",
+                              linkage=linkage, **options)
+        with database.db:
+            with database.db.cursor() as cursor:
+                cursor.execute('''SELECT abstract FROM publications
+                                  WHERE id = '53e99784b7602d9701f3f72f';''')
+                res = cursor.fetchone()[0]
+                assert res == "Linked."
+
+                cursor.execute('''SELECT id FROM publications
+                                  WHERE id LIKE '2%';''')
+                res = cursor.fetchall()
+                assert res == [("2000000002",)]
+
+        db_cleanup()
+
+    # The AMiner files are parsed first when running with the linkage
+    renew_data_locally.run(file_locations=directory, db_name="aip_test",
+                           linkage_path=linkage_path)
+    with database.db:
+        with database.db.cursor() as cursor:
+            cursor.execute('''SELECT abstract FROM publications
+                              WHERE id = '53e99784b7602d9701f3f72f';''')
+            res = cursor.fetchone()[0]
+            assert res == "Linked."
+
+            cursor.execute('''SELECT COUNT(*) FROM publications
+                              WHERE id = '2000000001';''')
+            res = cursor.fetchone()[0]
+            assert res == 0
+
+            # The linkage file is not parsed as a corpus file
+            cursor.execute('''SELECT COUNT(*) FROM parsed_files''')
+            res = cursor.fetchone()[0]
+            assert res == 3
+
+    shutil.rmtree(directory)
+    db_cleanup()
+
+
 if __name__ == '__main__':
     db_cleanup()
 
@@ -204,8 +1287,37 @@ if __name__ == '__main__':
     semantic_scholar_simple_test()
 
     add_citations_test()
+    citation_loader_test()
     process_data_test()
 
     combined_simple_test()
+    bulk_ingest_test()
+    record_transaction_test()
+    staged_semantic_id_test()
+    staged_batch_test()
+    lookup_index_test()
+    unit_of_work_test()
+    author_resolver_test()
+    sanitizer_test()
+    venue_matcher_test()
+    title_key_test()
+    shared_connection_test()
+    partitioned_ingest_test()
+    fingerprint_test()
+    checkpoint_test()
+    gzip_reader_test()
+    iterload_test()
+    mapped_lines_test()
+    chunked_ingest_test()
+    archive_ingest_test()
+    dblp_stream_test()
+    dblp_chunks_test()
+    dblp_resume_test()
+    dblp_incremental_test()
+    venue_probe_test()
+    corpus_format_test()
+    citation_spill_test()
+    citation_spill_resume_test()
+    oag_linkage_test()
 
     print("All tests pass successful!")
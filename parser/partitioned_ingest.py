@@ -0,0 +1,182 @@
+import multiprocessing
+
+import xxhash
+
+from database_manager import DatabaseManager
+from sanitizer import sanitize_string
+from util import title_key
+
+# The queues of the partition owners, set in every reader process by init_reader
+reader_queues = None
+reader_process_file = None
+
+
+def partition_key(doi, title):
+    """
+    :return: the key a paper is matched on first: its normalized DOI, else its normalized title
+    """
+    if doi is not None and len(str(doi).strip()) > 0:
+        return "doi:" + str(doi).strip().lower()
+    return "title:{0}".format(title_key(title))
+
+
+def partition_of(doi, title, partitions):
+    return xxhash.xxh3_64_intdigest(partition_key(doi, title).encode("utf-8", "surrogatepass")) % partitions
+
+
+class PartitionRouter(object):
+    """
+    Stands in for the DatabaseManager of a corpus parser. The records are not written, but resolved, sanitized and
+    sent to the process owning the partition of their match key, so every paper is matched and inserted by one
+    process only.
+    """
+
+    def __init__(self, queues, database_path="aip", batch_size=1000):
+        """
+        :param queues: the queue of every partition owner
+        :param database_path: the database, used to check whether a file was parsed before
+        :param batch_size: the amount of papers sent to an owner at once
+        """
+        self.database = DatabaseManager(location=database_path)
+        self.queues = queues
+        self.batch_size = batch_size
+        self.batches = [[] for _ in queues]
+        self.parsed_files = []
+
+    def did_parse_file(self, file_path):
+        return self.database.did_parse_file(file_path)
+
+    def resolve_venue(self, raw_venue_string):
+        return self.database.resolve_venue(raw_venue_string)
+
+    def update_or_insert_paper_with_venue(self, id, doi, title, abstract, venue, year, volume, is_semantic=False,
+                                          linked_id=None):
+        # Sanitizing here spreads the work over the readers, the key has to be computed from the sanitized title
+        title = sanitize_string(title)
+        if len(title) > 512:
+            return False
+        abstract = sanitize_string(abstract)
+
+        partition = partition_of(doi, title, len(self.queues))
+        self.batches[partition].append(dict(id=id, doi=doi, title=title, abstract=abstract, venue=venue, year=year,
+                                            volume=volume, is_semantic=is_semantic, linked_id=linked_id))
+        if len(self.batches[partition]) >= self.batch_size:
+            self.send(partition)
+        return True
+
+    def add_publications(self, publications):
+        modified = 0
+        for publication in publications:
+            if self.update_or_insert_paper_with_venue(id=publication.id, doi=publication.doi, title=publication.title,
+                                                      abstract=publication.abstract, venue=publication.venue,
+                                                      year=publication.year, volume=publication.volume,
+                                                      is_semantic=publication.is_semantic,
+                                                      linked_id=publication.linked_id):
+                modified += 1
+        return modified
+
+    def send(self, partition):
+        if len(self.batches[partition]) > 0:
+            self.queues[partition].put(self.batches[partition])
+            self.batches[partition] = []
+
+    def flush_bulk_ingest(self):
+        for partition in range(len(self.queues)):
+            self.send(partition)
+
+    def resume_point(self, fingerprint, byte_range=None):
+        # The papers are written by the owners, so a reader cannot know up to where they are committed
+        return 0 if byte_range is None else byte_range[0], 0, 0
+
+    def checkpoint(self, position, line, records):
+        pass
+
+    def add_parsed_file(self, fingerprint, byte_range=None):
+        # The file can only be marked once the owners wrote its papers, see ingest_partitioned
+        self.flush_bulk_ingest()
+        fingerprint.finish()
+        self.parsed_files.append(fingerprint)
+
+    def close(self):
+        self.flush_bulk_ingest()
+        self.database.close()  # Closing twice is fine
+
+
+def own_partition(papers, database_path, database_options):
+    """
+    Writes the papers of one partition until it receives None.
+    """
+    database = DatabaseManager(location=database_path, **database_options)
+    failed = False
+    while True:
+        batch = papers.get()
+        if batch is None:
+            break
+        if failed:  # Keep draining the queue, so the readers do not block on it
+            continue
+
+        try:
+            for paper in batch:
+                database.update_or_insert_paper_with_venue(sanitized=True, **paper)
+        except Exception as e:
+            print("Writing a partition failed: {0}: {1}".format(type(e).__name__, e))
+            failed = True
+
+    database.close()
+    if failed:
+        exit(-1)
+
+
+def init_reader(queues, process_file):
+    global reader_queues, reader_process_file
+    reader_queues = queues
+    reader_process_file = process_file
+
+
+def read_file(path, database_path):
+    router = PartitionRouter(reader_queues, database_path)
+    try:
+        succeeded = reader_process_file(path, database_path, router=router)
+    finally:
+        router.close()
+    return succeeded, router.parsed_files
+
+
+def ingest_partitioned(paths, process_file, database_path="aip", partitions=4, readers=4, queue_size=64,
+                       **database_options):
+    """
+    Parses the files with a pool of readers that route every paper to the owner of the partition of its match key,
+    see partition_of. Each of the owners writes the papers of its partition only, so two processes never race to
+    match or insert the same paper.
+    :param paths: the files to parse
+    :param process_file: the function parsing a file, taking the path, the database path and a router
+    :param database_path: the database to write to
+    :param partitions: the number of owner processes
+    :param readers: the number of reader processes
+    :param queue_size: the maximum number of batches waiting for an owner
+    :param database_options: the options of the DatabaseManager of each owner
+    :return: whether all files were parsed and written
+    """
+    queues = [multiprocessing.Queue(maxsize=queue_size) for _ in range(partitions)]
+    owners = [multiprocessing.Process(target=own_partition, args=(queues[i], database_path, database_options))
+              for i in range(partitions)]
+    for owner in owners:
+        owner.start()
+
+    try:
+        with multiprocessing.Pool(readers, initializer=init_reader, initargs=(queues, process_file)) as pool:
+            results = pool.starmap(read_file, [(path, database_path) for path in paths], chunksize=1)
+    finally:
+        for papers in queues:
+            papers.put(None)
+        for owner in owners:
+            owner.join()
+
+    succeeded = all(owner.exitcode == 0 for owner in owners) and all(result for result, _ in results)
+    if succeeded:
+        database = DatabaseManager(location=database_path)
+        for _, parsed_files in results:
+            for fingerprint in parsed_files:
+                database.add_parsed_file(fingerprint)
+        database.close()
+    return succeeded
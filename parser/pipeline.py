@@ -0,0 +1,97 @@
+from util import probe_venue
+
+
+class PublicationRecord(object):
+    """
+    A publication of a corpus file of which the venue is resolved, with the fields of
+    DatabaseManager.update_or_insert_paper_with_venue. A file has millions of records, so the record is slotted.
+    """
+    __slots__ = ("id", "doi", "title", "abstract", "venue", "year", "volume", "is_semantic", "linked_id")
+
+    def __init__(self, id, doi, title, abstract, venue, year, volume, is_semantic=False, linked_id=None):
+        self.id = id
+        self.doi = doi
+        self.title = title
+        self.abstract = abstract
+        self.venue = venue
+        self.year = year
+        self.volume = volume
+        self.is_semantic = is_semantic
+        self.linked_id = linked_id
+
+
+def venue_prefilter(database, corpus_format):
+    """
+    :param database: the DatabaseManager or PartitionRouter resolving the venues
+    :param corpus_format: the format of the lines, which decides which venue strings are resolved, see parse_corpus
+    :return: a keep function for util.LineReader, rejecting the lines of which the venue read from the raw bytes is not
+    one we are interested in, see util.probe_venue. The lines of which the venue cannot be read that way are kept.
+    For the others the resolved venue is returned, so it is not resolved again for the record, see parse_record.
+    """
+    def keep(buffer, start, end):
+        venue = probe_venue(buffer, start, end)
+        if venue is None:
+            return True
+        # Resolved and counted in the missing venues report like the venue of the decoded record
+        venue = corpus_format.venue_string(venue)
+        if venue is None:
+            return None
+        return database.resolve_venue(venue)
+
+    return keep
+
+
+def ingest_records(database, records, corpus_format, reader=None, batch_size=1000):
+    """
+    Feeds the records of a corpus file to the database. Resolving the venue is the first stage: the vast majority of
+    the records is of a venue we are not interested in, so those are rejected before their title and abstract are
+    sanitized, their DOI is extracted or the database is queried. The unknown venues are still counted by the
+    database for flush_missing_venues. The publications are handed to the database in batches, see
+    DatabaseManager.add_publications.
+    :param database: the DatabaseManager or PartitionRouter to write to
+    :param records: an iterable of the parsed records, None for a corrupt record
+    :param corpus_format: the format of the records, see parse_corpus
+    :param reader: the util.LineReader the records come from, to checkpoint the position after every record
+    :param batch_size: the amount of publications handed to the database at once
+    :return: the amount of records that modified the database
+    """
+    modified = 0
+    batch = []
+    for record in records:
+        publication = parse_record(database, record, corpus_format, None if reader is None else reader.venue)
+        if publication is not None:
+            batch.append(publication)
+            if len(batch) >= batch_size:
+                modified += database.add_publications(batch)
+                batch = []
+
+        # Only once the records before the position are handed to the database
+        if reader is not None and len(batch) == 0:
+            database.checkpoint(reader.position, reader.line, reader.records + modified)
+
+    if len(batch) > 0:
+        modified += database.add_publications(batch)
+        if reader is not None:
+            database.checkpoint(reader.position, reader.line, reader.records + modified)
+
+    return modified
+
+
+def parse_record(database, record, corpus_format, venue=None):
+    """
+    :param venue: the venue already resolved from the raw bytes of the record, see util.LineReader.venue
+    :return: the PublicationRecord of the record, None to skip the record
+    """
+    if record is None:  # Corrupt JSON line possibly. Skip it.
+        return None
+
+    if venue is None:
+        raw_venue_string = corpus_format.raw_venue(record)
+        if raw_venue_string is None:
+            return None
+
+        venue = database.resolve_venue(raw_venue_string)
+        if venue is None:
+            return None
+
+    return corpus_format.publication(record, venue)
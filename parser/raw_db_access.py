@@ -4,7 +4,7 @@ from database_manager import DatabaseManager
 def get_papers(db_name):
     # Returns list of dictionaries containing ids,
     # titles and abstracts of all publications
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute('''select id, title, abstract from publications''')
@@ -27,7 +27,7 @@ def get_papers(db_name):
 
 def get_citations_pairs(db_name):
     # Returns all paper-paper citation pairs
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute('select paper_id, cited_paper_id from cites')
@@ -43,7 +43,7 @@ def get_citations_pairs(db_name):
 
 def get_paper_authors(paper_id, db_name):
     # Returns all the authors of the paper with the given id
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute('''select author_id from author_paper_pairs
@@ -54,7 +54,7 @@ def get_paper_authors(paper_id, db_name):
 
 def get_paper_citations(db_name):
     # Returns a dictionary paper ids to the number of their citations
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute('''select id, n_citations from publications''')
@@ -67,7 +67,7 @@ def get_paper_citations(db_name):
 def get_paper_citations_years(db_name):
     # Returns a dictionary paper ids to the number of their citations
     # and publication year
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute(
@@ -81,7 +81,7 @@ def get_paper_citations_years(db_name):
 
 def get_paper_years(db_name):
     # Returns a dictionary mapping paper ids to their publication years
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute('''select id, year from publications''')
@@ -93,7 +93,7 @@ def get_paper_years(db_name):
 
 def get_authors(db_name):
     # Returns the list of authors
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute('''select id from authors''')
@@ -103,7 +103,7 @@ def get_authors(db_name):
 
 def calculate_authors_n_citations(db_name):
     # Calculates and returns numbers of citations of each authors
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             n_citations = dict()
@@ -120,7 +120,7 @@ def calculate_authors_n_citations(db_name):
 
 
 def get_publications_per_year(db_name):
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             year_p_count_dict = dict()
@@ -137,7 +137,7 @@ def get_publications_per_year(db_name):
 
 
 def get_citations_per_year(db_name):
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             year_cit_dict = dict()
@@ -153,7 +153,7 @@ def get_citations_per_year(db_name):
 
 
 def get_empty_citation_dicts(db_name):
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute('select max(year) from publications')
@@ -170,7 +170,7 @@ def get_empty_citation_dicts(db_name):
 
 
 def get_pub_citations_years(db_name):
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             pub_cit_years_dict = get_empty_citation_dicts(db_name)
@@ -190,7 +190,7 @@ def get_pub_citations_years(db_name):
 
 
 def get_all_citations_year_range(year, dt, db_name):
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute('''select count(*) from cites c
@@ -206,7 +206,7 @@ def get_all_citations_year_range(year, dt, db_name):
 
 
 def get_words_popularity(word, db_name):
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             cursor.execute('''select pub.year, sum(pairs.cnt)
@@ -223,7 +223,7 @@ def get_words_popularity(word, db_name):
 
 
 def get_papers_authors(db_name):
-    database = DatabaseManager(location=db_name)
+    database = DatabaseManager.get_shared(db_name)
     with database.db:
         with database.db.cursor() as cursor:
             paper_authors = dict()
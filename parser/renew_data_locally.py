@@ -2,6 +2,8 @@ import multiprocessing
 import os
 import re
 import time
+import zipfile
+from functools import partial
 from os.path import isfile
 
 from joblib import delayed, Parallel
@@ -11,33 +13,82 @@ import parse_aminer
 import parse_dblp
 import parse_mag
 import parse_semantic_scholar
+import chunked_ingest
+import oag_linkage
+import partitioned_ingest
 from database_manager import DatabaseManager
+from util import ARCHIVE_EXTENSIONS
 
 aip_name = "aip"
 file_location = "C:/Users/ktoka/Desktop/raw-data"
 
 
-def process_file(path, db_file=aip_name):
-    if re.match(".*dblp[\w-]+\.xml", path):
-        return parse_dblp.parse(path, db_file)
+def process_file(path, db_file=aip_name, validate_dblp=False, dblp_jobs=1, incremental_dblp=False,
+                 edge_spill_dir=None, linkage=None, **database_options):
+    if re.match(".*dblp[\w-]*\.xml", path):
+        # DBLP is always parsed per record as its authors are linked to the inserted articles
+        database_options.pop("bulk_ingest", None)
+        return parse_dblp.parse(path, db_file, validate=validate_dblp, jobs=dblp_jobs, incremental=incremental_dblp,
+                                **database_options)
     elif "aminer_papers" in path:
         start = time.time()
-        ret = parse_aminer.parse_aminer_corpus_file(path, db_file, logger_disabled=True)
+        ret = parse_aminer.parse_aminer_corpus_file(path, db_file, logger_disabled=True, **database_options)
         print("Aminer parse time:", time.time() - start)
         return ret
     elif "mag_papers" in path:
         start = time.time()
-        ret = parse_mag.parse_mag_corpus_file(path, db_file, logger_disabled=True)
+        ret = parse_mag.parse_mag_corpus_file(path, db_file, logger_disabled=True, linkage=linkage,
+                                              **database_options)
         print("MAG parse time:", time.time() - start)
         return ret
     elif "s2-corpus" in path:
-        return parse_semantic_scholar.parse_semantic_scholar_corpus_file(path, db_file)
+        return parse_semantic_scholar.parse_semantic_scholar_corpus_file(path, db_file, edge_spill_dir=edge_spill_dir,
+                                                                         **database_options)
 
     return True  # Nothing that should be done.
 
 
-def run(file_locations=file_location, db_name=aip_name):
+def is_extracted(path):
+    """
+    :param path: a gzip file or zip archive
+    :return: whether the content of the archive is stored next to it, e.g. dblp.xml next to dblp.xml.gz
+    """
+    directory = os.path.dirname(path)
+    if path.endswith("zip"):
+        with zipfile.ZipFile(path) as archive:
+            members = [member.filename for member in archive.infolist() if not member.is_dir()]
+    else:
+        members = [os.path.basename(path).rsplit(".", 1)[0]]
+    return all(isfile(os.path.join(directory, member)) for member in members)
+
+
+def run(file_locations=file_location, db_name=aip_name, partitions=0, chunk_size=0, validate_dblp=False,
+        incremental_dblp=False, edge_spill_dir=None, linkage_path=None, **database_options):
+    # The database_options are passed on to every DatabaseManager, for example:
+    # - bulk_ingest merges the papers of the non-DBLP sources with COPY and set-based statements instead of per record.
+    # - use_lookup_index keeps the DOIs and titles of all publications in memory to avoid most match queries. With
+    #   commit_records or commit_interval_ms, parallel workers can insert the same paper twice unless partitions > 0.
+    # - commit_records and commit_interval_ms group the writes of many records into one transaction.
+    # - venue_cache_path keeps the venue of every raw venue string in a SQLite file shared by all workers and runs.
+    # - verify_full_hash also recognizes parsed files by their full content hash, not only by their fingerprint. Use
+    #   it once to recognize the files parsed before the fingerprints were introduced.
+    # - checkpoint_interval is the amount of records between the checkpoints of a file without commit_records or
+    #   bulk_ingest, a crashed parse resumes at the last checkpoint of the file.
+    # With partitions > 0 the non-DBLP files are read by num_cores processes that hand every paper to one of the
+    # given number of writer processes, chosen by its DOI or title, so no two processes match the same paper.
+    # Else with chunk_size > 0 the uncompressed non-DBLP files are parsed in parallel in ranges of chunk_size bytes.
+    # With validate_dblp the DBLP dump is validated against its DTD while parsing, which keeps it in memory.
+    # With incremental_dblp only the DBLP records modified since the previous dump that was parsed are applied.
+    # The citations of the accepted Semantic Scholar papers are spilled to files in the edge_spill_dir while parsing,
+    # by default a directory next to the data files that survives a reboot, so the citations are loaded without a
+    # second pass over the corpus.
+    # With the linkage_path of the OAG paper linking pairs, the AMiner files are parsed before the MAG files and the
+    # MAG papers linked to an AMiner paper that was accepted fill it in instead of being matched again, see
+    # oag_linkage.
     num_cores = multiprocessing.cpu_count()
+    if edge_spill_dir is None:
+        edge_spill_dir = os.path.join(file_locations, "aip-citation-edges-" + db_name)
+    process_semantic_file = partial(process_file, edge_spill_dir=edge_spill_dir)
 
     # We are processing dblp first as they have author information and a nice identifier. This is just a preference
     # and the articles can be parsed in no particular order, yet as we do not override an id, the final id in the
@@ -46,12 +97,18 @@ def run(file_locations=file_location, db_name=aip_name):
     other_data_files = []
     semantic_data_files = []
 
-    # Create a list of all the files we want to parse. Skip the compressed sources if they are still lingering around
+    # Create a list of all the files we want to parse. The gzip files and zip archives are parsed without extracting
+    # them, unless they were extracted already.
     for path, subdirs, files in os.walk(file_locations):
+        # The spill files are named after the corpus files they are spilled from
+        subdirs[:] = [name for name in subdirs
+                      if os.path.abspath(os.path.join(path, name)) != os.path.abspath(edge_spill_dir)]
         for name in files:
-            if isfile(os.path.join(path, name)) and not name.endswith(("zip", "tar")):
-                file_path = os.path.join(path, name)
-                if re.match("dblp[\w-]+\.xml", name):
+            file_path = os.path.join(path, name)
+            if isfile(file_path) and not name.endswith("tar") \
+                    and not (name.endswith(ARCHIVE_EXTENSIONS) and is_extracted(file_path)) \
+                    and not (linkage_path is not None and os.path.abspath(file_path) == os.path.abspath(linkage_path)):
+                if re.match("dblp[\w-]*\.xml", name):
                     dblp_file = file_path
                 elif re.match("s2-corpus[\w-]+", name):
                     semantic_data_files.append(file_path)
@@ -66,26 +123,47 @@ def run(file_locations=file_location, db_name=aip_name):
 
     start = time.time()
     startDBLP = time.time()
-    if not process_file(dblp_file, db_file=db_name):
+    # The chunks of the dump are parsed by all cores, the records are still written in the order of the dump
+    if not process_file(dblp_file, db_file=db_name, validate_dblp=validate_dblp, dblp_jobs=num_cores,
+                        incremental_dblp=incremental_dblp, **database_options):
         print("Error during parsing DBLP file {}".format(dblp_file))
         exit(-1)
     print("DBLP parse time:", time.time() - startDBLP)
     # Create one task per file.
     print("Processing other files  ...")
 
-    input_list = tqdm(other_data_files)
-    input_list_semantic = tqdm(semantic_data_files)
-
-    processed_list = Parallel(n_jobs=num_cores)(delayed(process_file)(i, db_name) for i in input_list)
+    def parse_files(paths, process):
+        if partitions > 0:
+            return [partitioned_ingest.ingest_partitioned(paths, process, db_name, partitions=partitions,
+                                                          readers=num_cores, **database_options)]
+        elif chunk_size > 0:
+            return [chunked_ingest.ingest_chunked(paths, process, db_name, chunk_size=chunk_size, jobs=num_cores,
+                                                  **database_options)]
+        return Parallel(n_jobs=num_cores)(delayed(process)(i, db_name, **database_options) for i in tqdm(paths))
+
+    if linkage_path is not None:
+        aminer_files = [path for path in other_data_files if "aminer_papers" in path]
+        processed_list = parse_files(aminer_files, process_file)
+        database = DatabaseManager(location=db_name)
+        linkage = oag_linkage.load_linkage(linkage_path, database)
+        database.close()
+        print("Linked MAG papers of the AMiner papers:", len(linkage))
+        processed_list += parse_files([path for path in other_data_files if path not in aminer_files],
+                                      partial(process_file, linkage=linkage))
+    else:
+        processed_list = parse_files(other_data_files, process_file)
     print("Time for parsing all other sources:", time.time() - start)
 
     semantic_start = time.time()
-    processed_list_semantic = Parallel(n_jobs=num_cores)(delayed(process_file)(i, db_name) for i in input_list_semantic)
+    processed_list_semantic = parse_files(semantic_data_files, process_semantic_file)
     print("Time for parsing Semantic sources:", time.time() - semantic_start)
 
     print("Adding cites data ...")  # Add the cites data after all papers have been added to the db
     cites_time = time.time()
-    processed_list_cited = Parallel(n_jobs=num_cores)(delayed(parse_semantic_scholar.add_semantic_scholar_cites_data)(i, db_name) for i in input_list_semantic)
+    # All files are loaded by a single process, which keeps one semantic_scholar_id -> id map in memory. The files of
+    # which the citations were spilled are not read again.
+    processed_list_cited = [parse_semantic_scholar.add_semantic_scholar_cites(semantic_data_files, db_name,
+                                                                              edge_spill_dir=edge_spill_dir)]
     print("Time for citing all data:", time.time() - cites_time)
 
     process_time = time.time()
@@ -0,0 +1,137 @@
+import re
+from html.entities import name2codepoint
+
+import lxml
+import lxml.html
+import lxml.html.clean
+
+# Control characters, BOMs, surrogates and non-characters are dropped or replaced by lxml, leave those strings to it
+IRREGULAR = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufdd0-\ufdef\ufeff\ufffe\uffff]")
+
+# Inline tags that only wrap text, e.g. <i>Drosophila</i> or CO<sub>2</sub>. Anything else goes through lxml.
+INLINE_TAGS = ("i", "b", "u", "em", "strong", "sub", "sup", "tt", "small", "big", "br")
+TOKEN = re.compile(r"<(/?)([A-Za-z][A-Za-z0-9]*)\s*(/?)>|<[A-Za-z/!?]|&#[xX]([0-9A-Fa-f]{1,6});|&#([0-9]{1,7});|&#"
+                   r"|&([A-Za-z][A-Za-z0-9]*);|(<)")
+
+# The whitespace the HTML parser drops at the start of the document
+LEADING_WHITESPACE = " \t\n\r"
+
+ENTITIES = dict(name2codepoint, apos=ord("'"))
+
+CLEANER = lxml.html.clean.Cleaner(style=True)
+
+
+def sanitize_html(string):
+    """
+    Strips the markup from a string the way lxml does, extracting the text content. The Cleaner is shared by all
+    calls as it keeps no state between documents.
+    """
+    try:  # Sometimes the cleaning fails when things are very corrupt, just return the string then
+        doc = lxml.html.fromstring(string)
+        doc = CLEANER.clean_html(doc)
+        return doc.text_content()
+    except Exception:
+        return string
+
+
+def sanitize_inline(string):
+    """
+    Strips simple inline tags and decodes entities without building a tree.
+    :return: the sanitized string, or None if the string holds markup this cannot handle.
+    """
+    parts = []
+    segment = []  # The text since the last tag
+    after_tag = False
+    content = False  # Whether any text precedes the match, the parser treats the start of a document differently
+    start = 0
+    for match in TOKEN.finditer(string):
+        text = string[start:match.start()]
+        start = match.end()
+        segment.append(text)
+        content = content or len(text.strip(LEADING_WHITESPACE)) > 0
+
+        closing, tag, self_closing, hex_code, dec_code, name, less_than = match.groups()
+        if tag is not None:
+            tag = tag.lower()
+            if tag not in INLINE_TAGS or (closing and (self_closing or tag == "br" or not content)):
+                return None
+            if not end_segment(parts, segment, after_tag):
+                return None
+            segment = []
+            after_tag = True
+        elif less_than is not None:
+            if not content:
+                return None
+            segment.append(less_than)
+        elif name is not None:
+            # Unknown entities are kept as is
+            segment.append(chr(ENTITIES[name]) if name in ENTITIES else match.group())
+            content = True
+        elif hex_code is None and dec_code is None:  # Another tag, a comment or a malformed character reference
+            return None
+        else:
+            code = int(hex_code, 16) if hex_code is not None else int(dec_code)
+            if code <= 0x20 or 0x7f <= code <= 0x9f or 0xd800 <= code <= 0xdfff or code == 0xfeff or code >= 0xfdd0:
+                return None
+            segment.append(chr(code))
+            content = True
+
+    segment.append(string[start:])
+    if not end_segment(parts, segment, after_tag):
+        return None
+
+    parts[0] = parts[0].lstrip(LEADING_WHITESPACE)
+    return "".join(parts)
+
+
+def end_segment(parts, segment, after_tag):
+    text = "".join(segment)
+    # The parser drops text consisting of whitespace only after a tag, leave those cases to lxml
+    if after_tag and text.isspace():
+        return False
+    parts.append(text)
+    return True
+
+
+def sanitize_string(string):
+    """
+    Extracts the text of a title or abstract that may contain HTML. Plain strings are returned without parsing and
+    simple inline markup is stripped directly, only real HTML is parsed and cleaned by lxml. The result is the same
+    as cleaning every string with lxml.
+    """
+    if not isinstance(string, str):
+        return sanitize_html(string)
+
+    if IRREGULAR.search(string) is None:
+        if "<" not in string and "&" not in string:
+            text = string.lstrip(LEADING_WHITESPACE)
+            # An empty document cannot be parsed, in which case the string is returned as is
+            return text if len(text) > 0 else string
+
+        text = sanitize_inline(string)
+        if text is not None and len(text) > 0:
+            return text
+
+    return sanitize_html(string)
+
+
+def sanitize_strings(strings):
+    return [sanitize_string(string) for string in strings]
+
+
+def sanitize_batch(strings, executor=None, chunk_size=1000):
+    """
+    Sanitizes a batch of strings, optionally spread over the workers of an executor.
+    :param strings: a list of strings to sanitize
+    :param executor: a concurrent.futures executor, i.e. a thread or a process pool, or None to sanitize in this thread
+    :param chunk_size: the amount of strings handed to a worker at once
+    :return: a list containing the sanitized strings in the same order
+    """
+    if executor is None:
+        return sanitize_strings(strings)
+
+    chunks = [strings[i:i + chunk_size] for i in range(0, len(strings), chunk_size)]
+    result = []
+    for chunk in executor.map(sanitize_strings, chunks):
+        result.extend(chunk)
+    return result
@@ -1,70 +1,544 @@
 import ast
+import contextlib
 import gzip
+import html
+import io
 import json
 import logging
+import mmap
+import os
+import queue
+import re
+import threading
+import unicodedata
+import zipfile
+from collections import OrderedDict
 from json.decoder import WHITESPACE
 
 import orjson
+import xxhash
 
 logger = logging.getLogger(__name__)
 
+# The compressed inputs that are parsed without extracting them first
+ARCHIVE_EXTENSIONS = ("gz", "zip")
 
-def iterload(string_or_fp, cls=json.JSONDecoder, **kwargs):
+# The value of the "venue" key of a JSON line, either a string or the string of the "raw" key of a venue object as
+# in the OAG files, see probe_venue
+VENUE_VALUE = re.compile(rb'"venue"\s*:\s*(\{\s*"raw"\s*:\s*)?"([^"\\]*(?:\\.[^"\\]*)*)"')
+
+# Everything but letters, digits, + and # (C++, C#) separates the words of a title
+TITLE_SEPARATORS = re.compile(r"(?:[^\w+#]|_)+")
+
+
+def normalize_title(title):
+    """
+    Folds the differences between the sources in how they write a title: case, encoded characters, punctuation such
+    as the trailing dot of DBLP titles, and whitespace.
     """
-    Source: https://stackoverflow.com/questions/6886283/how-i-can-i-lazily
-    -read-multiple-json-values-from-a-file-stream-in-python
+    title = unicodedata.normalize("NFKC", html.unescape(str(title))).casefold()
+    return TITLE_SEPARATORS.sub(" ", title).strip()
+
+
+def title_key(title):
     """
+    :return: the 64-bit hash of the normalized title as a signed integer, the title_key column of publications
+    """
+    digest = xxhash.xxh3_64_digest(normalize_title(title).encode("utf-8", "surrogatepass"))
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class LRUCache(object):
+    """
+    A dict-like cache holding at most max_size entries, evicting the least recently used entry first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Whitespace between JSON values, as bytes
+JSON_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+
+# The plausible start of the next value in a stream of concatenated objects, an object at the start of a line
+OBJECT_START = b"\n{"
+
+
+def iterload_chunks(string_or_fp, chunk_size):
     if isinstance(string_or_fp, str):
-        string = str(string_or_fp)
-    else:
-        string = string_or_fp.read()
+        yield string_or_fp.encode("utf-8", "surrogatepass")
+        return
+    if isinstance(string_or_fp, (bytes, bytearray, memoryview)):
+        yield bytes(string_or_fp)
+        return
 
+    while True:
+        chunk = string_or_fp.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk.encode("utf-8", "surrogatepass") if isinstance(chunk, str) else chunk
+
+
+def iterload(string_or_fp, cls=json.JSONDecoder, chunk_size=2 ** 20, max_value_size=2 ** 24, skipped=None,
+             **kwargs):
+    """
+    Lazily decodes concatenated JSON values, e.g. objects separated by newlines, from a string, bytes or a text or
+    binary file, reading chunk_size at a time. A value is decoded by orjson if it ends where the next object starts on
+    a new line, else the decoder of cls finds where it ends.
+
+    Corrupt data is skipped up to the next start of an object on a new line in a single scan, yielding None in its
+    place. Values larger than max_value_size are treated as corrupt, which bounds the buffer.
+    :param skipped: a list to append the (start, end) byte ranges of the skipped data to
+    """
     decoder = cls(**kwargs)
-    idx = WHITESPACE.match(string, 0).end()
-    while idx < len(string):
-        retry_count = 3
-        obj, end = None, None
-        while retry_count > 0:
-            try:
-                obj, end = decoder.raw_decode(string, idx)
-                break
-            except Exception as e:
-                retry_count -= 1
+    chunks = iterload_chunks(string_or_fp, chunk_size)
+    buffer = b""
+    base = 0  # The offset of the buffer in the stream
+    pos = 0
+    eof = False
 
-        yield obj
-        if obj is None:
-            idx = WHITESPACE.match(string, idx + 1).end()
+    while True:
+        pos = JSON_WHITESPACE.match(buffer, pos).end()
+        # The next object delimits the value, read until it is in the buffer
+        boundary = buffer.find(OBJECT_START, pos + 1)
+        if (boundary < 0 or pos == len(buffer)) and not eof and len(buffer) - pos < max_value_size:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+            else:
+                buffer, base, pos = buffer[pos:] + chunk, base + pos, 0
+            continue
+        if pos == len(buffer):
+            return
+
+        try:
+            value = orjson.loads(buffer[pos:boundary if boundary >= 0 else len(buffer)])
+        except orjson.JSONDecodeError:
+            pass
         else:
-            idx = WHITESPACE.match(string, end).end()
+            yield value
+            pos = boundary if boundary >= 0 else len(buffer)
+            continue
 
+        # Several values on a line, a value with an object on a new line inside or corrupt data. ISO-8859-1 maps the
+        # bytes one to one on characters, so the decoder finds the extent of the values in the buffer.
+        text = buffer[pos:].decode("ISO-8859-1")
+        i = 0
+        error = None
+        while True:
+            i = WHITESPACE.match(text, i).end()
+            if i == len(text) or (i > 0 and buffer[pos + i - 1:pos + i + 1] == OBJECT_START):
+                break  # Back to the fast path
+            try:
+                fallback, j = decoder.raw_decode(text, i)
+            except json.JSONDecodeError as e:
+                error = e
+                break
 
-def iterload_file_lines(path):
-    with open(path, "r", encoding='ISO-8859-1') as json_file:
-        for line in json_file:
             try:
-                json_object = orjson.loads(line)
+                yield orjson.loads(buffer[pos + i:pos + j])
+            except orjson.JSONDecodeError:
+                yield fallback  # Not UTF-8
+            i = j
+
+        pos += i
+        if error is None:
+            continue
+
+        truncated = error.pos >= len(text.rstrip()) or error.msg.startswith("Unterminated string")
+        if truncated and not eof and len(text) - i < max_value_size:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+            else:
+                buffer, base, pos = buffer[pos:] + chunk, base + pos, 0
+            continue
+
+        # Resynchronize on the next object, reading on without keeping the skipped data
+        start = base + pos
+        pos += 1
+        while True:
+            boundary = buffer.find(OBJECT_START, pos)
+            if boundary >= 0:
+                pos = boundary + 1
+                break
+            if eof:
+                pos = len(buffer)
+                break
+            pos = max(pos, len(buffer) - 1)  # The newline of the next object may end the buffer
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+            else:
+                buffer, base, pos = buffer[pos:] + chunk, base + pos, 0
+
+        logger.warning("Skipped corrupt JSON from byte %d to %d: %s", start, base + pos, error.msg)
+        if skipped is not None:
+            skipped.append((start, base + pos))
+        yield None
+
+
+def iterload_file_lines(path, file=None):
+    """
+    :param file: the file at path opened in binary mode, e.g. by FileFingerprint.open, instead of mapping the path
+    """
+    if file is None:
+        lines = (line for _, line in iterload_mapped_lines(path))
+    else:
+        lines = file
+
+    with contextlib.closing(lines):
+        for line in lines:
+            json_object = load_line(line)
+            if json_object is not None:
                 yield json_object
-            except Exception as e:
-                try:
-                    json_object = ast.literal_eval(line)
-                    yield json_object
-                except Exception as e2:
-                    logger.warning(
-                        "Could not parse line: %s. Errors: %s and: %s", line,
-                        e,
-                        e2)
-                    continue
-
-
-def iterload_file_lines_gzip(gz_file):
-    with gzip.open(gz_file, mode='rt', encoding="ISO-8859-1") as f:
-        for line in f.readlines():
+
+
+def iterload_mapped_lines(path, position=0, update=None, block_size=2 ** 20, end=None):
+    """
+    Memory-maps the file and yields the byte offset after every line together with the line, from position on. The
+    newlines are found with mmap.find and the lines are memoryviews of the mapping, orjson decodes them without a
+    copy or a decode to str in between and the page cache does the reading.
+    :param update: called with consecutive blocks of the file from its start as the lines pass, e.g.
+    FileFingerprint.update to hash the content
+    :param end: the byte offset to stop at, which should be the start of a line, see line_ranges
+    """
+    if os.path.getsize(path) == 0:  # Empty files cannot be mapped
+        return
+
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        line = None
+        try:
+            size = len(mapped) if end is None else min(end, len(mapped))
+            find = mapped.find
+            hashed = 0
+            while position < size:
+                end = find(b"\n", position)
+                end = size if end < 0 else end + 1
+                if update is not None and end - hashed >= block_size:
+                    update(view[hashed:end])
+                    hashed = end
+
+                line = view[position:end]
+                position = end
+                yield position, line
+
+            if update is not None:
+                update(view[hashed:size])  # The rest of the file is hashed by FileFingerprint.finish
+        finally:
+            # The mapping can only be closed once no views of it are left
+            if line is not None:
+                line.release()
+            view.release()
+
+
+def load_line(line):
+    """
+    :param line: the raw bytes of the line, which orjson decodes as UTF-8 without an intermediate str
+    :return: the JSON object on the line, or None if the line cannot be parsed
+    """
+    try:
+        return orjson.loads(line)
+    except Exception as e:
+        # Only the lines that are not valid UTF-8 JSON take the slow path, as text like the files used to be read
+        line = str(line, "ISO-8859-1")  # Decodes a memoryview without copying it to bytes first
+        try:
+            return orjson.loads(line)
+        except Exception:
+            pass
+        try:
+            return ast.literal_eval(line)
+        except Exception as e2:
+            logger.warning("Could not parse line: %s. Errors: %s and: %s", line, e, e2)
+            return None
+
+
+def doi_from_url(url):
+    """
+    :return: the DOI of a doi.org link, None if the url is not one
+    """
+    index = url.find("doi.org/")
+    if index < 0:
+        return None
+    return url[index + len("doi.org/"):]
+
+
+def probe_venue(buffer, start=0, end=None):
+    """
+    Reads the venue of a JSON line from its raw bytes, without decoding the line, which is mostly title, abstract and
+    citations. Only the regular forms are read: a string, or an object of which the first key is "raw" with a string
+    value. The quotes around a key in a line can only be the quotes of a key, the quotes in a string are escaped.
+    :param buffer: the line as bytes, or the mmap of a file the line is in, which is searched in place
+    :param start: the offset of the line in the buffer
+    :param end: the offset after the line in the buffer, its end by default
+    :return: the venue string, None if the line has to be decoded to know it: no or more than one "venue" key, another
+    form of venue, more than one "raw" key or no title
+    """
+    if end is None:
+        end = len(buffer)
+    # find is much faster than a regular expression scanning the line
+    key = buffer.find(b'"venue"', start, end)
+    if key < 0 or buffer.find(b'"venue"', key + 7, end) >= 0 or buffer.find(b'"title"', start, end) < 0:
+        return None
+    match = VENUE_VALUE.match(buffer, key, end)
+    if match is None:
+        return None
+    if match.group(1) is not None and buffer.find(b'"raw"', buffer.find(b'"raw"', start, end) + 5, end) >= 0:
+        return None
+
+    value = match.group(2)
+    try:
+        if b"\\" in value:
+            return orjson.loads(b'"' + value + b'"')
+        return value.decode("utf-8")
+    except ValueError:  # Also UnicodeDecodeError
+        return None
+
+
+def read_in_background(read, chunk_size=2 ** 20, queue_size=8):
+    """
+    Calls read(chunk_size) in a background thread until it returns no data and yields the chunks. zlib releases the
+    GIL while inflating, so reading a gzip file this way overlaps the decompression with the parsing of the previous
+    chunks. At most queue_size chunks are buffered, which bounds the memory used.
+    """
+    chunks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
             try:
-                json_object = orjson.loads(line)
-                yield json_object
-            except:
-                try:
-                    json_object = ast.literal_eval(line)
-                    yield json_object
-                except:
-                    continue
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            while not stop.is_set():
+                chunk = read(chunk_size)
+                put(chunk)
+                if not chunk:
+                    return
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        # Also when the consumer stops early
+        stop.set()
+        thread.join()
+
+
+def split_lines(chunks):
+    """
+    :return: the lines in the chunks of bytes, including the line ending, lines can span chunks
+    """
+    rest = b""
+    for chunk in chunks:
+        data = rest + chunk if rest else chunk
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end < 0:
+                break
+            yield data[start:end + 1]
+            start = end + 1
+        rest = data[start:]
+    if rest:
+        yield rest
+
+
+def iterload_gzip_lines(file):
+    """
+    :param file: a gzip file opened in binary mode
+    :return: the raw lines of the decompressed file, decompressed in a background thread, see read_in_background
+    """
+    with gzip.open(file, mode="rb") as f:
+        yield from split_lines(read_in_background(f.read))
+
+
+def iterload_zip_lines(file):
+    """
+    :param file: a zip archive, its path or a seekable binary file
+    :return: the raw lines of the files in the archive in the order of the archive, decompressed in a background
+    thread, see read_in_background
+    """
+    with zipfile.ZipFile(file) as archive:
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+            with archive.open(member) as f:
+                # Per member, the last line of a member does not continue in the next one
+                yield from split_lines(read_in_background(f.read))
+
+
+def iterload_archive_lines(path, fingerprint=None):
+    """
+    :param path: a gzip file or zip archive, see ARCHIVE_EXTENSIONS
+    :param fingerprint: the FileFingerprint of the file, to hash the content while it is read
+    :return: the raw lines of the decompressed file
+    """
+    if path.endswith("zip"):
+        # The directory of a zip archive is at its end, so it cannot be read front to back through the fingerprint.
+        # FileFingerprint.finish hashes it in a separate pass.
+        return iterload_zip_lines(path)
+    return iterload_gzip_lines(path if fingerprint is None else fingerprint.open())
+
+
+class BackgroundReader(io.RawIOBase):
+    """
+    Reads a binary file ahead in a background thread, see read_in_background, e.g. to decompress a gzip file while
+    lxml parses the previous chunks. Wrap it in a BufferedReader as if it were the file itself.
+    """
+
+    def __init__(self, file, chunk_size=2 ** 20, queue_size=8):
+        self.file = file
+        self.chunks = read_in_background(file.read, chunk_size, queue_size)
+        self.chunk = memoryview(b"")
+
+    @property
+    def name(self):
+        # lxml resolves the DTD relative to the name of the file
+        return self.file.name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.chunk:
+            self.chunk = memoryview(next(self.chunks, b""))
+        n = min(len(buffer), len(self.chunk))
+        buffer[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.chunks.close()  # Stops the thread
+            self.file.close()
+        super().close()
+
+
+class LineReader(object):
+    """
+    Iterates the JSON objects of a file with one object per line, optionally in a gzip file or zip archive, like
+    iterload_file_lines and iterload_file_lines_gzip. The reader keeps track of the byte offset and the number of the
+    last line read, so the parsing of the file can be checkpointed and resumed, see DatabaseManager.resume_point. Lines
+    that cannot be parsed are yielded as None, to keep the position of the consumer in sync.
+    """
+
+    def __init__(self, path, fingerprint, checkpoint=(0, 0, 0), end=None, keep=None):
+        """
+        :param path: the file to read
+        :param fingerprint: the FileFingerprint of the file, hashing the content while it is read
+        :param checkpoint: the position, line and records committed to resume from
+        :param end: the byte offset to stop at for uncompressed files, see line_ranges. The content is not hashed then.
+        :param keep: called with the buffer holding a line and the offsets of the line in it, the line is only decoded
+        if it returns True or the venue of the line, else None is yielded for it, see pipeline.venue_prefilter. The
+        buffer is the decompressed line itself or the mmap of an uncompressed file, so the lines that are rejected are
+        never copied.
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.position, self.line, self.records = checkpoint
+        self.end = end
+        self.keep = keep
+        self.venue = None  # The venue keep returned for the last line, None if it is left to the consumer to resolve
+
+    def load(self, line, buffer, start):
+        self.venue = None
+        if self.keep is not None:
+            kept = self.keep(buffer, start, start + len(line))
+            if not kept:
+                return None
+            if kept is not True:
+                self.venue = kept
+        return load_line(line)
+
+    def __iter__(self):
+        if self.path.endswith(ARCHIVE_EXTENSIONS):
+            # A compressed stream cannot be seeked into, decompress the lines before the checkpoint without parsing
+            # them. The position is the offset in the decompressed content.
+            skip, self.line, self.position = self.line, 0, 0
+            lines = iterload_archive_lines(self.path, self.fingerprint)
+            with contextlib.closing(lines):
+                for line in lines:
+                    self.position += len(line)
+                    self.line += 1
+                    if self.line > skip:
+                        yield self.load(line, line, 0)
+        else:
+            # Seek straight to the checkpoint, the content is only hashed if the whole file is read
+            if self.position > 0 or self.end is not None:
+                self.fingerprint.unhashed()
+            lines = iterload_mapped_lines(self.path, self.position, self.fingerprint.update, end=self.end)
+            with contextlib.closing(lines):
+                start = self.position
+                for self.position, line in lines:
+                    self.line += 1
+                    # The line is a view of the mmap of the file
+                    yield self.load(line, line.obj, start)
+                    start = self.position
+
+
+def line_ranges(path, chunk_size):
+    """
+    Splits an uncompressed file into byte ranges of about chunk_size that start at the start of a line, to parse
+    the ranges of a large file in parallel.
+    :return: a list of (start, end) tuples
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as file:
+        start = 0
+        while start < size:
+            file.seek(start + chunk_size)
+            file.readline()  # Up to and including the next newline
+            end = min(file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def iterload_file_lines_gzip(gz_file, file=None):
+    # Streams the lines, the whole file used to be decompressed into memory first
+    for line in iterload_gzip_lines(gz_file if file is None else file):
+        json_object = load_line(line)
+        if json_object is not None:
+            yield json_object
+
+
+def iterload_file_lines_zip(zip_file):
+    for line in iterload_zip_lines(zip_file):
+        json_object = load_line(line)
+        if json_object is not None:
+            yield json_object
@@ -0,0 +1,146 @@
+import re
+import sqlite3
+
+import xxhash
+from venue_mapper.venue_mapper import MatchType, VenueMapper
+
+from util import LRUCache
+
+UNCACHED = object()
+
+
+def normalize_venue(raw_venue_string):
+    # Stripped only, like the raw strings VenueMapper was always given, so the matches and the unknown venues report
+    # stay the same
+    return str(raw_venue_string).strip()
+
+
+class VenueMatcher(object):
+    """
+    Matches raw venue strings to venue abbreviations with the same result as VenueMapper.get_abbreviation, which tries
+    all exact, prefix, suffix, substring and regex patterns of all venues in turn. The same raw strings repeat
+    millions of times, so the matcher puts three layers in front of it:
+    - an exact dictionary of the EXACT patterns,
+    - a bounded memo of the raw strings seen before, including the ones without a venue,
+    - optionally, an on-disk SQLite cache shared by the workers of a run and by later runs.
+    Strings that miss all layers are checked against combined prefilters of all patterns first, only the few strings
+    that pass them are handed to VenueMapper for the ordered match.
+
+    The counts of the unknown venues for the missing venues report are kept here as well.
+    """
+
+    def __init__(self, mapper=None, cache_size=1000000, cache_path=None):
+        """
+        :param mapper: the VenueMapper to use, a new one by default
+        :param cache_size: the maximum number of raw strings kept in the memo
+        :param cache_path: path of the SQLite file to cache the matches in, None disables the on-disk cache
+        """
+        self.mapper = mapper if mapper is not None else VenueMapper()
+        self.memo = LRUCache(cache_size)
+        self.unknown_counts = dict()
+        self.stats = dict(exact_hits=0, memo_hits=0, disk_hits=0, misses=0)
+
+        self.exact = dict()
+        prefixes, suffixes, substrings = [], [], []
+        for venue_abbreviation, match_tuples in self.mapper.venues.items():
+            for match_line, matchtype in match_tuples:
+                if matchtype == MatchType.EXACT:
+                    self.exact[match_line] = venue_abbreviation
+                elif matchtype == MatchType.STARTS_WITH:
+                    prefixes.append(match_line)
+                elif matchtype == MatchType.ENDS_WITH:
+                    suffixes.append(match_line)
+                elif matchtype == MatchType.CONTAINS:
+                    substrings.append(match_line)
+
+        # A stripped string never equals an EXACT pattern with surrounding whitespace, keep those out of the
+        # dictionary so they go through the mapper as before.
+        self.exact = {line: venue for line, venue in self.exact.items() if normalize_venue(line) == line}
+        self.prefixes = tuple(prefixes)
+        self.suffixes = tuple(suffixes)
+        self.substrings = re.compile("|".join(re.escape(s) for s in substrings)) if len(substrings) > 0 else None
+        self.regexes = [regex for regex in self.mapper.compiled_regexes.values()]
+
+        self.disk = None
+        self.disk_pending = []
+        if cache_path is not None:
+            self.open_disk_cache(cache_path)
+
+    def open_disk_cache(self, cache_path):
+        # The cache is only valid for the patterns it was built with
+        patterns = sorted((venue, sorted((line, matchtype.value) for line, matchtype in lines))
+                          for venue, lines in self.mapper.venues.items())
+        version = xxhash.xxh64(repr(patterns).encode("utf-8")).hexdigest()
+
+        self.disk = sqlite3.connect(cache_path, timeout=60)
+        with self.disk:
+            self.disk.execute('''CREATE TABLE IF NOT EXISTS venue_cache (raw TEXT PRIMARY KEY, venue TEXT);''')
+            self.disk.execute('''CREATE TABLE IF NOT EXISTS venue_cache_version (version TEXT);''')
+            row = self.disk.execute('''SELECT version FROM venue_cache_version;''').fetchone()
+            if row is None or row[0] != version:
+                self.disk.execute('''DELETE FROM venue_cache;''')
+                self.disk.execute('''DELETE FROM venue_cache_version;''')
+                self.disk.execute('''INSERT INTO venue_cache_version (version) VALUES (?);''', [version])
+
+    def match(self, raw_venue_string):
+        """
+        :return: the abbreviation of the venue, or None if the venue is unknown
+        """
+        venue_string = normalize_venue(raw_venue_string)
+
+        venue = self.exact.get(venue_string)
+        if venue is not None:
+            self.stats["exact_hits"] += 1
+            return venue
+
+        venue = self.memo.get(venue_string, UNCACHED)
+        if venue is not UNCACHED:
+            self.stats["memo_hits"] += 1
+        else:
+            venue = self.lookup_disk_cache(venue_string)
+            if venue is not UNCACHED:
+                self.stats["disk_hits"] += 1
+            else:
+                self.stats["misses"] += 1
+                venue = self.match_patterns(venue_string)
+                if self.disk is not None:
+                    self.disk_pending.append((venue_string, venue))
+                    if len(self.disk_pending) >= 1000:
+                        self.flush()
+            self.memo.put(venue_string, venue)
+
+        # If we cannot match the venue, we will keep the count to later analyze if we missed important venues
+        if venue is None:
+            self.unknown_counts[venue_string] = self.unknown_counts.get(venue_string, 0) + 1
+
+        return venue
+
+    def match_patterns(self, venue_string):
+        if not venue_string.startswith(self.prefixes) and not venue_string.endswith(self.suffixes) \
+                and (self.substrings is None or self.substrings.search(venue_string) is None) \
+                and not any(regex.search(venue_string) for regex in self.regexes):
+            return self.mapper.cache.get(venue_string)  # Only an EXACT pattern can match
+
+        return self.mapper.get_abbreviation(venue_string)
+
+    def lookup_disk_cache(self, venue_string):
+        if self.disk is None:
+            return UNCACHED
+
+        row = self.disk.execute('''SELECT venue FROM venue_cache WHERE raw = ?;''', [venue_string]).fetchone()
+        return UNCACHED if row is None else row[0]
+
+    def flush(self):
+        if self.disk is None or len(self.disk_pending) == 0:
+            return
+
+        with self.disk:
+            self.disk.executemany('''INSERT OR IGNORE INTO venue_cache (raw, venue) VALUES (?, ?);''',
+                                  self.disk_pending)
+        self.disk_pending = []
+
+    def close(self):
+        self.flush()
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None